@@ -103,7 +103,7 @@ if __name__ == "__main__":
     setup_google_error_log()
 
     with open("apto/apto_collection_log.log", "a") as error_log:
-        apto_collection_script = subprocess.run(" ".join(['python3', 'apto/get_and_set_apto_comps.py']), shell=True, stderr=error_log)
+        apto_collection_script = subprocess.run(" ".join(['python3', 'apto/get_and_set_apto_comps.py', '--mode', 'created']), shell=True, stderr=error_log)
         if apto_collection_script.returncode != 0:
             email_exit_status(False)
         else:
@@ -2,11 +2,17 @@ from simple_salesforce import Salesforce
 from salesforce_bulk import SalesforceBulk
 import pandas as pd
 import numpy as np
-import time, io, os, requests
+import time, os, sys, re, csv, json, atexit, argparse, hashlib, sqlite3, requests, threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+from scipy.spatial import cKDTree
 import certifi
 from dotenv import load_dotenv
+# Helpers shared with costar/src
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'costar', 'src'))
+from spatial_index import geojson_lon_lat, lon_lat_to_unit_xyz, meters_to_chord
 
 import smtplib
 from email.mime.multipart import MIMEMultipart
@@ -17,14 +23,49 @@ from email import encoders
 
 
 ############################################################
+# One pooled MongoClient per process, shared by every function that talks to partners-edge
+mongo_client = None
+
+def get_mongo_client():
+    global mongo_client
+    if mongo_client is None:
+        load_dotenv()
+        mongo_connection_str = os.environ.get("PARTNERSDB_URI")
+        mongo_client = MongoClient(mongo_connection_str, tlsCAFile=certifi.where())
+    return mongo_client
+
 def write_to_log_file(message):
     with open("apto/apto_collection_log.log", "a") as f:
         f.write(str(message) + "\n")
 
+# Google errors are buffered and appended to the csv in batches (and at exit), never rewritten. Geocoding threads
+# share the buffer, so access is serialized.
+GOOGLE_ERROR_LOG_PATH = "apto/google_error_log.csv"
+GOOGLE_ERROR_LOG_COLUMNS = ["Error", "Exception", "Comp Address", "Google Response"]
+GOOGLE_ERROR_LOG_BATCH_SIZE = 100
+google_error_log_buffer = []
+google_error_log_lock = threading.Lock()
+
 def write_to_google_error_log(error_line):
-    error_df = pd.read_csv("apto/google_error_log.csv")
-    error_df.loc[len(error_df)] = error_line
-    error_df.to_csv("apto/google_error_log.csv", index=False)
+    with google_error_log_lock:
+        google_error_log_buffer.append(error_line)
+        if len(google_error_log_buffer) < GOOGLE_ERROR_LOG_BATCH_SIZE:
+            return
+    flush_google_error_log()
+
+def flush_google_error_log():
+    with google_error_log_lock:
+        if not google_error_log_buffer:
+            return
+        write_header = not os.path.exists(GOOGLE_ERROR_LOG_PATH) or os.path.getsize(GOOGLE_ERROR_LOG_PATH) == 0
+        with open(GOOGLE_ERROR_LOG_PATH, "a", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=GOOGLE_ERROR_LOG_COLUMNS, extrasaction="ignore")
+            if write_header:
+                writer.writeheader()
+            writer.writerows(google_error_log_buffer)
+        google_error_log_buffer.clear()
+
+atexit.register(flush_google_error_log)
 
 def send_missing_costarID_email(aptoID):
     load_dotenv()
@@ -54,7 +95,9 @@ def send_missing_costarID_email(aptoID):
 
 
 ############################################################
-def get_apto_comps():
+# Pull Comp_Search__c records. By default comps created since the last collection date (apto_collection_dates.csv);
+# with since_modified (an ISO datetime), every comp modified at or after that time instead.
+def get_apto_comps(since_modified=None):
     load_dotenv()
     salesforce_username = os.environ.get("SALESFORCE_USERNAME")
     salesforce_password = os.environ.get("SALESFORCE_PASSWORD")
@@ -72,13 +115,13 @@ def get_apto_comps():
     comp_search_report_id = '00OKa000003AxtcMAC'
     report = sf.restful(f'analytics/reports/{comp_search_report_id}')
     comp_search_columns = [col.split(".")[1] for col in report['reportMetadata']['detailColumns']]
-    comp_search_fields = ""
-    for col in comp_search_columns:
-        # FOR SOME REASON, REPORT RETURNS FIELD THAT IS NOT PRESENT IN OBJECT ("RecordType" instead of "Record_Type__c")
-        if col == "RecordType":
-            col = "Record_Type__c"
-        comp_search_fields += f"{col},"
-    comp_search_fields = comp_search_fields[:-1] # Remove trailing comma
+    # FOR SOME REASON, REPORT RETURNS FIELD THAT IS NOT PRESENT IN OBJECT ("RecordType" instead of "Record_Type__c")
+    comp_search_columns = ["Record_Type__c" if col == "RecordType" else col for col in comp_search_columns]
+    # LastModifiedDate is needed for the incremental sync watermark
+    if "LastModifiedDate" not in comp_search_columns:
+        comp_search_columns.append("LastModifiedDate")
+    comp_search_fields = ",".join(comp_search_columns)
+    comp_search_dtypes = get_comp_search_dtypes(report)
 
     # Get latest apto collection date for filter
     apto_collection_dates = pd.read_csv("apto/apto_collection_dates.csv")
@@ -89,38 +132,129 @@ def get_apto_comps():
         latest_collection_date = apto_collection_dates.iloc[0]["Collection Date"]
 
     # Use Bulk API to query "Comp Search" object
+    if since_modified is None:
+        date_filter = f"Created_Date__c >= {latest_collection_date}"
+    else:
+        date_filter = f"LastModifiedDate >= {since_modified}"
+        latest_collection_date = since_modified[:10]
     comp_search_soql_query = f"""
     SELECT {comp_search_fields} 
     FROM Comp_Search__c
     WHERE Property_Type_Formula__c = 'Industrial' 
-    AND Created_Date__c >= {latest_collection_date}
+    AND {date_filter}
     """
  
 
-    comp_search_job = bulk.create_query_job("Comp_Search__c", contentType='CSV')
-
-    comp_search_batch = bulk.query(comp_search_job, comp_search_soql_query)
-    while not bulk.is_batch_done(comp_search_batch):
-        time.sleep(10)
-
-    comp_search_results = bulk.get_all_results_for_query_batch(comp_search_batch)
+    # PK chunk large date ranges (backfills) so Salesforce splits the extract into parallel batches
+    days_since_collection = (datetime.now() - datetime.strptime(str(latest_collection_date), "%Y-%m-%d")).days
+    pk_chunking = PK_CHUNK_SIZE if days_since_collection > PK_CHUNKING_MIN_DAYS else False
 
     # Get results into a dataframe and rename columns
-    comp_search_csv_data = '\n'.join(item.read().decode() for item in comp_search_results)
-    comp_search_df = pd.read_csv(io.StringIO(comp_search_csv_data))
-    for col in comp_search_df.columns:
-        new_col_name = col[:-3] if col[-3:] == "__c" else col
-        comp_search_df.rename(columns={col: new_col_name}, inplace=True)
+    comp_search_df = run_bulk_query(bulk, "Comp_Search__c", comp_search_soql_query, comp_search_dtypes, comp_search_columns, pk_chunking=pk_chunking)
+    comp_search_df.columns = [col[:-3] if col[-3:] == "__c" else col for col in comp_search_df.columns]
 
     return comp_search_df
 
 
+# Column dtypes for the Bulk CSV from the report's detail column types: numeric types as float64 (nullable), text
+# types as str. Dates and anything else are left to read_csv.
+NUMERIC_REPORT_TYPES = ("double", "currency", "percent", "int")
+TEXT_REPORT_TYPES = ("string", "textarea", "picklist", "multipicklist", "url", "email", "phone", "id", "reference", "combobox")
+
+def get_comp_search_dtypes(report):
+    detail_column_info = report.get('reportExtendedMetadata', {}).get('detailColumnInfo', {})
+    dtypes = {}
+    for col, info in detail_column_info.items():
+        field = col.split(".")[-1]
+        if field == "RecordType":
+            field = "Record_Type__c"
+        data_type = info.get('dataType')
+        if data_type in NUMERIC_REPORT_TYPES:
+            dtypes[field] = "float64"
+        elif data_type in TEXT_REPORT_TYPES:
+            dtypes[field] = str
+    return dtypes
+
+
+# Parse each Bulk result chunk as it streams in (each chunk carries its own header)
+def read_bulk_chunks(results, dtypes):
+    chunk_dfs = []
+    for result in results:
+        chunk_df = pd.read_csv(result, dtype=dtypes)
+        # Empty chunks come back as "Records not found for this query"
+        if not chunk_df.empty:
+            chunk_dfs.append(chunk_df)
+    return chunk_dfs
+
+
+# Run a Bulk API query job and return its results as one dataframe. With pk_chunking (a chunk size), Salesforce
+# marks the submitted batch NotProcessed and splits the query into chunk batches; each chunk is downloaded as soon
+# as it completes while the others are still running. Polling backs off exponentially from BULK_POLL_MIN_SECONDS.
+PK_CHUNK_SIZE = 50000
+PK_CHUNKING_MIN_DAYS = 90
+BULK_POLL_MIN_SECONDS = 0.5
+BULK_POLL_MAX_SECONDS = 30
+
+def run_bulk_query(bulk, object_name, soql_query, dtypes, columns, pk_chunking=False):
+    tic = time.perf_counter()
+    job = bulk.create_query_job(object_name, contentType='CSV', pk_chunking=pk_chunking)
+    submitted_batch = bulk.query(job, soql_query)
+
+    chunk_dfs = []
+    downloaded_batches = set()
+    poll_seconds = BULK_POLL_MIN_SECONDS
+    polls = 0
+    first_result_time = None
+    while True:
+        batches = bulk.get_batch_list(job)
+        polls += 1
+        downloaded = False
+        submitted_state = None
+        for batch in batches:
+            if batch['id'] == submitted_batch:
+                submitted_state = batch['state']
+                # The submitted batch of a PK chunked job is never processed itself
+                if pk_chunking and batch['state'] == "NotProcessed":
+                    continue
+            if batch['state'] in ("Failed", "NotProcessed"):
+                bulk.close_job(job)
+                raise Exception(f"Bulk batch {batch['id']} {batch['state']}: {batch.get('stateMessage')}")
+            if batch['state'] == "Completed" and batch['id'] not in downloaded_batches:
+                chunk_dfs += read_bulk_chunks(bulk.get_all_results_for_query_batch(batch['id'], job), dtypes)
+                downloaded_batches.add(batch['id'])
+                downloaded = True
+                if first_result_time is None:
+                    first_result_time = time.perf_counter()
+
+        # Done when every processed batch is downloaded (for PK chunking, once the query has been split)
+        processed_batches = [batch['id'] for batch in batches if not (pk_chunking and batch['id'] == submitted_batch)]
+        split_done = not pk_chunking or submitted_state == "NotProcessed"
+        if split_done and processed_batches and all(batch_id in downloaded_batches for batch_id in processed_batches):
+            break
+
+        # Poll at the minimum interval again after progress, otherwise back off
+        if downloaded:
+            poll_seconds = BULK_POLL_MIN_SECONDS
+        time.sleep(poll_seconds)
+        poll_seconds = min(poll_seconds * 2, BULK_POLL_MAX_SECONDS)
+
+    bulk.close_job(job)
+    toc = time.perf_counter()
+    rows = sum(len(chunk_df) for chunk_df in chunk_dfs)
+    first_result_seconds = first_result_time - tic if first_result_time is not None else toc - tic
+    write_to_log_file(f"Bulk query on {object_name}: {rows} rows from {len(downloaded_batches)} batches (pk_chunking={pk_chunking}) in {toc - tic:0.2f} seconds, first results after {first_result_seconds:0.2f} seconds, {polls} polls")
+
+    if not chunk_dfs:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(chunk_dfs, ignore_index=True)
+
+
 
 
 
 ############################################################
 # Clean apto comps
-def clean_apto_comps(raw_df):
+def clean_apto_comps(raw_df, geocode_workers=8):
     clean_col_names = [
         # ID Data
         "aptoID", # Name
@@ -178,186 +312,121 @@ def clean_apto_comps(raw_df):
     ]
 
 
-    clean_df = pd.DataFrame(columns=clean_col_names)
-
-    for idx, raw_comp in raw_df.iterrows():
-        clean_comp = dict(zip(clean_col_names, [np.nan]*len(clean_col_names)))
+    for aptoID in raw_df.loc[raw_df["CoStar_Link"].isna(), "Name"]:
+        write_to_log_file(f"CoStar ID not found for {aptoID}")
+
+    # Drop comps without an address; every other step works on whole columns
+    raw_df = raw_df[raw_df["Address"] != "Not Provided"].reset_index(drop=True)
+    clean_df = pd.DataFrame(np.nan, index=raw_df.index, columns=clean_col_names, dtype=object)
+
+
+    ##########
+    # ID & Location Data
+    clean_df["aptoID"] = raw_df["Name"]
+
+    clean_df["costarID"] = raw_df["CoStar_Link"].astype(object).str.split("/").str[-2]
+
+    clean_df["transactionType"] = np.where(raw_df["Record_Type"].str.contains("Sale", regex=False, na=False), "Sale", "Lease")
+    clean_df["sourceType"] = np.where(raw_df["Record_Type"].str.contains("(External)", regex=False, na=False), "External", "Internal")
+
+    clean_df["address"] = raw_df["Address"]
+    clean_df["city"] = raw_df["City"]
+    clean_df["state"] = raw_df["State"]
+    has_zip = raw_df["Zip_Code"].notna() & (pd.to_numeric(raw_df["Zip_Code"], errors="coerce") != 0)
+    clean_df["zip"] = raw_df["Zip_Code"].astype(str).str[:5].where(has_zip, np.nan)
+    clean_df["market"] = raw_df["Market_ExternalComp"]
+    clean_df["submarket"] = raw_df["Sub_market"]
+    clean_df["latitude"] = raw_df["latitude"].astype(float)
+    clean_df["longitude"] = raw_df["Longitude"].astype(float)
+
+    # Get google data (the only per-comp step)
+    google_results = geocode_comps(dict(zip(clean_df.index, zip(clean_df["address"], clean_df["city"], clean_df["state"], clean_df["zip"]))), workers=geocode_workers)
+    google_results = [google_results[idx] for idx in clean_df.index]
+    has_google = pd.Series([bool(google_data) for google_data in google_results], index=clean_df.index)
+    if has_google.any():
+        google_df = pd.DataFrame([google_data if google_data else {} for google_data in google_results], index=clean_df.index)
+        for col in ["googleID", "latitude", "longitude", "address", "city", "state", "zip"]:
+            clean_df[col] = google_df[col].where(has_google, clean_df[col])
+
+    has_location = clean_df["latitude"].notna() & clean_df["longitude"].notna()
+    clean_df.loc[has_location, "loc_geojson"] = pd.Series(
+        [{"type": "Point", "coordinates": [longitude, latitude]} for longitude, latitude in zip(clean_df.loc[has_location, "longitude"], clean_df.loc[has_location, "latitude"])],
+        index=clean_df.index[has_location], dtype=object
+    )
+
+    clean_df["closeDate"] = coalesce_comp_columns(raw_df, clean_df, "Close_Date", "Close_Date_External", "Close Date")
+    clean_df["closeDatetime"] = pd.Series(list(pd.to_datetime(clean_df["closeDate"], format="mixed")), index=clean_df.index, dtype=object)
+
+    clean_df["primaryBroker"] = raw_df["Primary_Broker_Name"].where(raw_df["Primary_Broker_Name"] != " ", np.nan)
+
+    clean_df["transactionSF"] = np.trunc(coalesce_comp_columns(raw_df, clean_df, "Square_Footage", "Ext_Square_Footage", "Transaction SF").astype(float))
+
+
+    ##########
+    # Property Data
+    clean_df["propertyType"] = raw_df["Property_Type_Formula"]
+    clean_df["propertySF"] = np.trunc(raw_df["Property_SF"].astype(float))
+    clean_df["yearBuilt"] = np.trunc(raw_df["Year_Built"].astype(float))
+    clean_df["clearHeight"] = coalesce_comp_columns(raw_df, clean_df, "Clear_Height", "Max_Clear_Height", "Clear Height")
+    clean_df["propertyTenancy"] = raw_df["Property_Tenancy"]
+
+
+    ##########
+    # Lease Data
+    clean_df["monthlyOperatingExpenses"] = raw_df["Operating_Expenses_SF_Mo"].astype(float)
+    clean_df["yearlyOperatingExpenses"] = raw_df["Operating_Expenses"].astype(float)
+    clean_df["monthlyBaseRentalRate"] = raw_df["Base_Rental_Rate_SF_Mo"].astype(float)
+    clean_df["yearlyBaseRentalRate"] = raw_df["Base_Rental_Rate_SF_Yr"].astype(float)
+    clean_df["monthlyAvgRentalRateGross"] = raw_df["Average_Rental_Rate_SF_Mo_Gross"].astype(float)
+    clean_df["yearlyAvgRentalRateGross"] = raw_df["Average_Rental_Rate"].astype(float)
+    clean_df["leaseType"] = raw_df["Lease_Type"]
+    clean_df["directOrSublease"] = raw_df["Direct_Sublease"]
+    clean_df["leaseTerm"] = raw_df["Lease_Term_Months"].astype(float)
+    clean_df["leaseCommencementDate"] = raw_df["Lease_Commencement_Date"]
+    clean_df["leaseExpirationDate"] = raw_df["Lease_Expiration_Date"]
+    clean_df["freeRent"] = raw_df["Free_Rent_Months"].astype(float)
+    clean_df["freeRentType"] = raw_df["Free_Rent_Type"]
+    clean_df["rentEscalations"] = raw_df["Escalations"]
+
+
+    ##########
+    # Sale Data
+    clean_df["salePrice"] = raw_df["Sales_Price"].astype(float)
+    clean_df["salePricePerSF"] = raw_df["Price_SF_Formula"].astype(float)
+    clean_df["acres"] = raw_df["Acres"].astype(float)
+    clean_df["askingPrice"] = raw_df["Asking_Price"].astype(float)
+    clean_df["capRate"] = raw_df["CAP_Rate"].astype(float)
+    clean_df["occupancyAtListing"] = raw_df["Occupancy_at_Listing"].astype(float)
+    clean_df["occupancyAtClose"] = raw_df["Occupancy_at_Close"].astype(float)
+
+
+    ##########
+    # Landlord & Tenant Data (first of name/company that is present and not a placeholder)
+    clean_df["landlord"] = first_known_party(raw_df["Landlord"], raw_df["Landlord_Company"])
+    clean_df["tenant"] = first_known_party(raw_df["Tenant"], raw_df["Tenant_Company_External"])
+
+
+    ##########
+    # Misc
+    clean_df["compNotes"] = raw_df["Comp_Notes"]
 
-        ##########
-        # ID & Location Data
-
-        clean_comp["aptoID"] = raw_comp["Name"]
-
-        if pd.notna(raw_comp["CoStar_Link"]):
-            clean_comp["costarID"] = raw_comp["CoStar_Link"].split("/")[-2]
-        else:
-            write_to_log_file(f"CoStar ID not found for {clean_comp['aptoID']}")
-
-        if "Sale" in raw_comp["Record_Type"]:
-            clean_comp["transactionType"] = "Sale"
-        else:
-            clean_comp["transactionType"] = "Lease"
-        
-        if "(External)" in raw_comp["Record_Type"]:
-            clean_comp["sourceType"] = "External"
-        else:
-            clean_comp["sourceType"] = "Internal"
-        
-        if raw_comp["Address"] == "Not Provided":
-            continue
-        else:
-            clean_comp["address"] = raw_comp["Address"]
-        
-        clean_comp["city"] = raw_comp["City"]
-
-        clean_comp["state"] = raw_comp["State"]
-
-        if pd.notna(raw_comp["Zip_Code"]) and raw_comp['Zip_Code'] != 0:
-            clean_comp["zip"] = str(raw_comp["Zip_Code"])[:5]
-        
-        clean_comp["market"] = raw_comp["Market_ExternalComp"]
-
-        clean_comp["submarket"] = raw_comp["Sub_market"] 
-        clean_comp["latitude"] = float(raw_comp["latitude"])
-        clean_comp["longitude"] = float(raw_comp["Longitude"])
-
-        # Get google data
-        google_data = google_data_validation(clean_comp["address"], clean_comp["city"], clean_comp["state"], clean_comp["zip"])
-        if google_data:
-            clean_comp["googleID"] = google_data["googleID"]
-            clean_comp["latitude"] = google_data["latitude"]
-            clean_comp["longitude"] = google_data["longitude"]
-            clean_comp["address"] = google_data["address"]
-            clean_comp["city"] = google_data["city"]
-            clean_comp["state"] = google_data["state"]
-            clean_comp["zip"] = google_data["zip"]
-
-        if pd.notna(clean_comp['latitude']) and pd.notna(clean_comp['longitude']):
-            clean_comp["loc_geojson"] = {
-                "type": "Point",
-                "coordinates": [clean_comp['longitude'], clean_comp['latitude']]
-            }
+    return clean_df
 
-        if pd.notna(raw_comp["Close_Date"]) and pd.notna(raw_comp["Close_Date_External"]) and raw_comp["Close_Date"] != raw_comp["Close_Date_External"]:
-            write_to_log_file(f"Close Date mismatch at {clean_comp['address']}, {clean_comp['city']}, {clean_comp['state']}: {raw_comp['Close_Date']} vs {raw_comp['Close_Date_External']}")
-        if pd.notna(raw_comp["Close_Date"]):
-            clean_comp["closeDate"] = raw_comp["Close_Date"]
-            clean_comp["closeDatetime"] = pd.to_datetime(raw_comp["Close_Date"])
-        elif pd.notna(raw_comp["Close_Date_External"]):
-            clean_comp["closeDate"] = raw_comp["Close_Date_External"]
-            clean_comp["closeDatetime"] = pd.to_datetime(raw_comp["Close_Date_External"])
 
-    
-        if raw_comp['Primary_Broker_Name'] != ' ':
-            clean_comp["primaryBroker"] = raw_comp["Primary_Broker_Name"]
-        
-        if pd.notna(raw_comp["Square_Footage"]) and pd.notna(raw_comp["Ext_Square_Footage"]) and raw_comp["Square_Footage"] != raw_comp["Ext_Square_Footage"]:
-            write_to_log_file(f"Transaction SF mismatch at {clean_comp['address']}, {clean_comp['city']}, {clean_comp['state']}: {raw_comp['Square_Footage']} vs {raw_comp['Ext_Square_Footage']}")
-        if pd.notna(raw_comp["Square_Footage"]):
-            clean_comp["transactionSF"] = int(raw_comp["Square_Footage"])
-        elif pd.notna(raw_comp["Ext_Square_Footage"]):
-            clean_comp["transactionSF"] = int(raw_comp["Ext_Square_Footage"])
-
-
-        ##########
-        # Property Data
-        clean_comp["propertyType"] = raw_comp["Property_Type_Formula"]
-        if pd.notna(raw_comp["Property_SF"]):
-            clean_comp["propertySF"] = int(raw_comp["Property_SF"])
-        if pd.notna(raw_comp["Year_Built"]):
-            clean_comp["yearBuilt"] = int(raw_comp["Year_Built"])
-
-        if pd.notna(raw_comp["Clear_Height"]) and pd.notna(raw_comp["Max_Clear_Height"]) and raw_comp["Clear_Height"] != raw_comp["Max_Clear_Height"]:
-            write_to_log_file(f"Clear Height mismatch at {clean_comp['address']}, {clean_comp['city']}, {clean_comp['state']}: {raw_comp['Clear_Height']} vs {raw_comp['Max_Clear_Height']}")
-        if pd.notna(raw_comp["Clear_Height"]):
-            clean_comp["clearHeight"] = raw_comp["Clear_Height"]
-        elif pd.notna(raw_comp["Max_Clear_Height"]):
-            clean_comp["clearHeight"] = raw_comp["Max_Clear_Height"]
-        
-        clean_comp["propertyTenancy"] = raw_comp["Property_Tenancy"]
-
-
-        ##########
-        # Lease Data
-        if pd.notna(raw_comp["Operating_Expenses_SF_Mo"]):
-            clean_comp["monthlyOperatingExpenses"] = float(raw_comp["Operating_Expenses_SF_Mo"])
-        if pd.notna(raw_comp["Operating_Expenses"]):
-            clean_comp["yearlyOperatingExpenses"] = float(raw_comp["Operating_Expenses"])
-        if pd.notna(raw_comp["Base_Rental_Rate_SF_Mo"]):
-            clean_comp["monthlyBaseRentalRate"] = float(raw_comp["Base_Rental_Rate_SF_Mo"])
-        if pd.notna(raw_comp["Base_Rental_Rate_SF_Yr"]):
-            clean_comp["yearlyBaseRentalRate"] = float(raw_comp["Base_Rental_Rate_SF_Yr"])
-        if pd.notna(raw_comp["Average_Rental_Rate_SF_Mo_Gross"]):
-            clean_comp["monthlyAvgRentalRateGross"] = float(raw_comp["Average_Rental_Rate_SF_Mo_Gross"])
-        if pd.notna(raw_comp["Average_Rental_Rate"]):
-            clean_comp["yearlyAvgRentalRateGross"] = float(raw_comp["Average_Rental_Rate"])
-        clean_comp["leaseType"] = raw_comp["Lease_Type"]
-        clean_comp["directOrSublease"] = raw_comp["Direct_Sublease"]
-        if pd.notna(raw_comp["Lease_Term_Months"]):
-            clean_comp["leaseTerm"] = float(raw_comp["Lease_Term_Months"])
-        clean_comp["leaseCommencementDate"] = raw_comp["Lease_Commencement_Date"]
-        clean_comp["leaseExpirationDate"] = raw_comp["Lease_Expiration_Date"]
-        if pd.notna(raw_comp["Free_Rent_Months"]):
-            clean_comp["freeRent"] = float(raw_comp["Free_Rent_Months"])
-        clean_comp["freeRentType"] = raw_comp["Free_Rent_Type"]
-        clean_comp["rentEscalations"] = raw_comp["Escalations"]
-
-
-        ##########
-        # Sale Data
-        if pd.notna(raw_comp["Sales_Price"]):
-            clean_comp["salePrice"] = float(raw_comp["Sales_Price"])
-        if pd.notna(raw_comp["Price_SF_Formula"]):
-            clean_comp["salePricePerSF"] = float(raw_comp["Price_SF_Formula"])
-        if pd.notna(raw_comp["Acres"]):
-            clean_comp["acres"] = float(raw_comp["Acres"])
-        if pd.notna(raw_comp["Asking_Price"]):
-            clean_comp["askingPrice"] = float(raw_comp["Asking_Price"])
-        if pd.notna(raw_comp["CAP_Rate"]):
-            clean_comp["capRate"] = float(raw_comp["CAP_Rate"])
-        if pd.notna(raw_comp["Occupancy_at_Listing"]):
-            clean_comp["occupancyAtListing"] = float(raw_comp["Occupancy_at_Listing"])
-        if pd.notna(raw_comp["Occupancy_at_Close"]):
-            clean_comp["occupancyAtClose"] = float(raw_comp["Occupancy_at_Close"])
-
-
-        ##########
-        # Landlord & Tenant Data
-        if pd.notna(raw_comp["Landlord"]) and pd.notna(raw_comp["Landlord_Company"]):
-            if raw_comp["Landlord"] not in ["-", "Unknown", " "]:
-                clean_comp["landlord"] = raw_comp["Landlord"]
-            elif raw_comp["Landlord_Company"] not in ["-", "Unknown", " "]:
-                clean_comp["landlord"] = raw_comp["Landlord_Company"]
-        elif pd.notna(raw_comp["Landlord"]) and not pd.notna(raw_comp["Landlord_Company"]):
-            if raw_comp["Landlord"] not in ["-", "Unknown", " "]:
-                clean_comp["landlord"] = raw_comp["Landlord"]
-        elif pd.notna(raw_comp["Landlord_Company"]) and not pd.notna(raw_comp["Landlord"]):
-            if raw_comp["Landlord_Company"] not in ["-", "Unknown", " "]:
-                clean_comp["landlord"] = raw_comp["Landlord_Company"]
-
-        if pd.notna(raw_comp["Tenant"]) and pd.notna(raw_comp["Tenant_Company_External"]):
-            if raw_comp["Tenant"] not in ["-", "Unknown", " "]:
-                clean_comp["tenant"] = raw_comp["Tenant"]
-            elif raw_comp["Tenant_Company_External"] not in ["-", "Unknown", " "]:
-                clean_comp["tenant"] = raw_comp["Tenant_Company_External"]
-        elif pd.notna(raw_comp["Tenant"]) and not pd.notna(raw_comp["Tenant_Company_External"]):
-            if raw_comp["Tenant"] not in ["-", "Unknown", " "]:
-                clean_comp["tenant"] = raw_comp["Tenant"]
-        elif pd.notna(raw_comp["Tenant_Company_External"]) and not pd.notna(raw_comp["Tenant"]):
-            if raw_comp["Tenant_Company_External"] not in ["-", "Unknown", " "]:
-                clean_comp["tenant"] = raw_comp["Tenant_Company_External"]
-
-
-
-        
-
-        ##########
-        # Misc
-        clean_comp["compNotes"] = raw_comp["Comp_Notes"]
+# Primary column where present, otherwise fallback column; logs comps where both are present and disagree
+def coalesce_comp_columns(raw_df, clean_df, primary_col, fallback_col, label):
+    primary, fallback = raw_df[primary_col], raw_df[fallback_col]
+    mismatch = primary.notna() & fallback.notna() & (primary != fallback)
+    for idx in mismatch[mismatch].index:
+        write_to_log_file(f"{label} mismatch at {clean_df.at[idx, 'address']}, {clean_df.at[idx, 'city']}, {clean_df.at[idx, 'state']}: {primary[idx]} vs {fallback[idx]}")
+    return primary.where(primary.notna(), fallback)
 
-        clean_df.loc[len(clean_df)] = clean_comp
 
-    return clean_df
+def first_known_party(name, company):
+    placeholders = ["-", "Unknown", " "]
+    name_known = name.notna() & ~name.isin(placeholders)
+    company_known = company.notna() & ~company.isin(placeholders)
+    return name.where(name_known, company.where(company_known, np.nan))
 
 
 
@@ -365,9 +434,142 @@ def clean_apto_comps(raw_df):
 
 ############################################################
 # Validate comp location data using Google Places API
-def google_data_validation(address, city, state, zip):
+GOOGLE_GEOCODE_URL = os.environ.get("GOOGLE_GEOCODE_URL", "https://maps.googleapis.com/maps/api/geocode/json")
+
+# Spaces requests evenly across every geocoding thread (at most requests_per_second overall)
+class RateLimiter:
+    def __init__(self, requests_per_second):
+        self.interval = 1 / requests_per_second if requests_per_second else 0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+# On-disk geocode cache keyed by normalized "address, city, state, zip". Found addresses are kept for
+# GEOCODE_CACHE_TTL_DAYS; addresses google has no street address for are cached (as None) for GEOCODE_NEGATIVE_TTL_DAYS.
+GEOCODE_CACHE_PATH = "apto/geocode_cache.sqlite"
+GEOCODE_CACHE_TTL_DAYS = 180
+GEOCODE_NEGATIVE_TTL_DAYS = 30
+NEGATIVE_GEOCODE_STATUSES = ("ZERO_RESULTS", "NO ADDRESS RETURNED")
+
+def normalize_address(address, city, state, zip):
+    parts = [str(part) for part in (address, city, state, zip) if not pd.isna(part)]
+    normalized = ", ".join(parts).lower().replace(".", "")
+    return re.sub(r"\s+", " ", normalized).strip()
+
+
+class GeocodeCache:
+    def __init__(self, path=GEOCODE_CACHE_PATH, ttl_days=GEOCODE_CACHE_TTL_DAYS, negative_ttl_days=GEOCODE_NEGATIVE_TTL_DAYS):
+        self.ttl = ttl_days * 86400
+        self.negative_ttl = negative_ttl_days * 86400
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS geocodes (
+                normalized_address TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                place_id TEXT,
+                latitude REAL,
+                longitude REAL,
+                google_data TEXT,
+                cached_at REAL NOT NULL
+            )""")
+        self.evict_expired()
+
+    def evict_expired(self):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM geocodes WHERE (status = 'OK' AND cached_at < ?) OR (status != 'OK' AND cached_at < ?)",
+                              (now - self.ttl, now - self.negative_ttl))
+
+    # Returns (hit, status, google_data); google_data is None for negative entries
+    def get(self, normalized_address):
+        with self.lock:
+            row = self.conn.execute("SELECT status, google_data, cached_at FROM geocodes WHERE normalized_address = ?", (normalized_address,)).fetchone()
+            ttl = (self.ttl if row[0] == "OK" else self.negative_ttl) if row else 0
+            if row is None or row[2] < time.time() - ttl:
+                self.misses += 1
+                return False, None, None
+            self.hits += 1
+        return True, row[0], json.loads(row[1]) if row[1] else None
+
+    def set(self, normalized_address, status, google_data=None):
+        place_id = google_data["googleID"] if google_data else None
+        latitude = google_data["latitude"] if google_data else None
+        longitude = google_data["longitude"] if google_data else None
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (normalized_address, status, place_id, latitude, longitude, json.dumps(google_data) if google_data else None, time.time()))
+
+
+# One geocode cache per process
+geocode_cache = None
+
+def get_geocode_cache():
+    global geocode_cache
+    if geocode_cache is None:
+        geocode_cache = GeocodeCache()
+    return geocode_cache
+
+
+# Geocode a batch of comps concurrently over one keep-alive session. comps maps a comp key (e.g. the clean_df
+# index) to (address, city, state, zip); returns {key: google_data or None}.
+def geocode_comps(comps, workers=8, requests_per_second=40, max_retries=3):
     load_dotenv()
     google_api_key = os.environ["GOOGLE_API_KEY"]
+    rate_limiter = RateLimiter(requests_per_second)
+    cache = get_geocode_cache()
+    hits, misses = cache.hits, cache.misses
+    tic = time.perf_counter()
+
+    with requests.Session() as session:
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(workers, 1))
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            futures = {
+                key: executor.submit(google_data_validation, address, city, state, zip, session, google_api_key, rate_limiter, max_retries, cache)
+                for key, (address, city, state, zip) in comps.items()
+            }
+            google_results = {key: future.result() for key, future in futures.items()}
+
+    flush_google_error_log()
+    toc = time.perf_counter()
+    if comps:
+        write_to_log_file(f"Geocoded {len(comps)} comps ({sum(1 for google_data in google_results.values() if google_data)} found) in {toc - tic:0.2f} seconds")
+        write_to_log_file(f"Geocode cache: {cache.hits - hits} hits, {cache.misses - misses} misses")
+    return google_results
+
+
+def google_data_validation(address, city, state, zip, session=None, google_api_key=None, rate_limiter=None, max_retries=3, cache=None):
+    if google_api_key is None:
+        load_dotenv()
+        google_api_key = os.environ["GOOGLE_API_KEY"]
+    http = session if session is not None else requests
+    cache = cache if cache is not None else get_geocode_cache()
+
+    # Serve repeat addresses from the geocode cache; cached misses are still reported in the error log
+    normalized_address = normalize_address(address, city, state, zip)
+    hit, status, google_data = cache.get(normalized_address)
+    if hit:
+        if google_data is None:
+            error_line = {
+                "Error": f"{status} (CACHED)",
+                "Exception": None,
+                "Comp Address": f"{address}, {city}, {state}, {zip}",
+                "Google Response": None
+            }
+            write_to_google_error_log(error_line)
+        return google_data
 
     # Collate address data (address, city, state, zip)
     formatted_raw_address = address
@@ -378,11 +580,16 @@ def google_data_validation(address, city, state, zip):
     if not pd.isna(zip):
         formatted_raw_address += f", {zip}"
 
-    # Fetch Google Places API data
-    url = f"https://maps.googleapis.com/maps/api/geocode/json?address={formatted_raw_address}&key={google_api_key}"
+    # Fetch Google Places API data, backing off and retrying while over the query limit
     try:
-        response = requests.get(url)
-        data = response.json()
+        for attempt in range(max_retries + 1):
+            if rate_limiter is not None:
+                rate_limiter.wait()
+            response = http.get(GOOGLE_GEOCODE_URL, params={"address": formatted_raw_address, "key": google_api_key}, timeout=30)
+            data = response.json()
+            if data['status'] != "OVER_QUERY_LIMIT" or attempt == max_retries:
+                break
+            time.sleep(2 ** attempt)
         if data['status'] != "OK":
             error_line = {
                 "Error": data['status'],
@@ -391,6 +598,8 @@ def google_data_validation(address, city, state, zip):
                 "Google Response": data
             }
             write_to_google_error_log(error_line)
+            if data['status'] in NEGATIVE_GEOCODE_STATUSES:
+                cache.set(normalized_address, data['status'])
             return None
     except Exception as e:
         error_line = {
@@ -415,6 +624,7 @@ def google_data_validation(address, city, state, zip):
             "Google Response": address_components
         }
         write_to_google_error_log(error_line)
+        cache.set(normalized_address, "NO ADDRESS RETURNED")
         return None
     
     # Unpack results returned by google api for address, city, state, zip
@@ -440,6 +650,7 @@ def google_data_validation(address, city, state, zip):
         'state': state,
         'zip': zip
     }
+    cache.set(normalized_address, "OK", google_data)
     return google_data
 
 
@@ -448,23 +659,57 @@ def google_data_validation(address, city, state, zip):
 
 ############################################################
 # Post apto comps
-def post_apto_comps(df):
-    load_dotenv()
-    mongo_connection_str = os.environ.get("PARTNERSDB_URI")
-    client = MongoClient(mongo_connection_str, tlsCAFile=certifi.where())
-    db = client['partners-edge']
-    collection = db['apto_comps']
+# Comps are upserted with $setOnInsert, so a comp whose aptoID is already in the collection is skipped, not
+# overwritten. With update_existing, existing comps are replaced field by field instead ($set, and $unset for fields
+# that are now empty). Operations go out in unordered bulk_write chunks backed by a unique index on aptoID.
+def post_apto_comps(df, chunk_size=1000, update_existing=False):
+    tic = time.perf_counter()
+    collection = get_mongo_client()['partners-edge']['apto_comps']
+    try:
+        collection.create_index("aptoID", unique=True)
+    except OperationFailure as e:
+        write_to_log_file(f"Could not create unique aptoID index on apto_comps: {e}")
 
-    for idx, comp in df.iterrows():
-        # Convert to dictionary
-        comp_dict = comp.to_dict()
-        # Check if any values are nan, and remove them
+    # Convert to dictionaries, remove nan values and keep the first comp for each aptoID
+    upsert_ops = {}
+    for comp_dict in df.to_dict("records"):
         comp_dict = {k: v for k, v in comp_dict.items() if pd.notna(v)}
-        # Check if comp_dict['apto_id'] already exists in collection
-        apto_id = comp_dict['aptoID']
-        if collection.count_documents({"aptoID": apto_id}) == 0:
-            collection.insert_one(comp_dict)
-    
+        if comp_dict["aptoID"] in upsert_ops:
+            continue
+        if update_existing:
+            update = {"$set": comp_dict}
+            empty_fields = {col: "" for col in df.columns if col not in comp_dict}
+            if empty_fields:
+                update["$unset"] = empty_fields
+        else:
+            update = {"$setOnInsert": comp_dict}
+        upsert_ops[comp_dict["aptoID"]] = UpdateOne({"aptoID": comp_dict["aptoID"]}, update, upsert=True)
+    apto_ids = list(upsert_ops.keys())
+    upsert_ops = list(upsert_ops.values())
+
+    inserted, skipped, failed = 0, 0, 0
+    for start in range(0, len(upsert_ops), chunk_size):
+        chunk = upsert_ops[start:start + chunk_size]
+        try:
+            result = collection.bulk_write(chunk, ordered=False)
+            inserted += result.upserted_count
+            skipped += result.matched_count
+        except BulkWriteError as e:
+            details = e.details
+            inserted += details.get("nUpserted", 0)
+            skipped += details.get("nMatched", 0)
+            for write_error in details.get("writeErrors", []):
+                # Duplicate key: another writer inserted this aptoID first
+                if write_error.get("code") == 11000:
+                    skipped += 1
+                else:
+                    failed += 1
+                    write_to_log_file(f"Failed to post comp {apto_ids[start + write_error['index']]}: {write_error.get('errmsg')}")
+
+    toc = time.perf_counter()
+    existing_label = "updated" if update_existing else "skipped (already posted)"
+    write_to_log_file(f"Posted {len(df)} comps in {toc - tic:0.2f} seconds: {inserted} inserted, {skipped} {existing_label}, {failed} failed")
+
     apto_collection_dates = pd.read_csv("apto/apto_collection_dates.csv")
     current_date = datetime.now().strftime("%Y-%m-%d")
     apto_collection_dates.loc[len(apto_collection_dates)] = current_date
@@ -475,97 +720,198 @@ def post_apto_comps(df):
 
 
 ############################################################
-# Updated saleComps and leaseComps in properties collection given a new costarID
-def update_properties_comps(costarID):
-    load_dotenv()
-    mongo_connection_str = os.environ.get("PARTNERSDB_URI")
-    client = MongoClient(mongo_connection_str, tlsCAFile=certifi.where())
-    db = client['partners-edge']
+# Updated saleComps and leaseComps in properties collection given a list of new costarIDs. For every new comp, the
+# nearby (5 km) comp properties with rba and ceilingHeight within 20% get the new costarID added to their comps.
+# One client, three reads and one unordered bulk_write for the whole batch.
+def update_properties_comps_batch(costarIDs, distanceInMeters=5000, similarity=0.2):
+    tic = time.perf_counter()
+    db = get_mongo_client()['partners-edge']
     properties_collection = db['properties']
     apto_collection = db['apto_comps']
+    costarIDs = list(dict.fromkeys(costarIDs))
+    projection = {"_id": 0, "costarID": 1, "rba": 1, "ceilingHeight": 1, "loc_geojson": 1}
+
+    # Get property data for the new comps (first document per costarID, like find_one)
+    subjects = {}
+    for property_data in properties_collection.find({"costarID": {"$in": costarIDs}}, projection):
+        subjects.setdefault(property_data['costarID'], property_data)
+    subjects = [subjects[costarID] for costarID in costarIDs if costarID in subjects]
+    subjects = [subject for subject in subjects if pd.notna(subject.get('rba')) and pd.notna(subject.get('ceilingHeight'))
+                and not np.isnan(geojson_lon_lat(subject.get('loc_geojson'))).any()]
+
+    # Get all comp points once and find the comps near every new comp
+    comps = pd.DataFrame(apto_collection.find({"costarID": {"$ne": None}}, {"_id": 0, "costarID": 1, "transactionType": 1, "loc_geojson": 1}))
+    nearby_comps = {}
+    if subjects and not comps.empty:
+        comps = comps.reindex(columns=['costarID', 'transactionType', 'loc_geojson'])
+        comp_lon_lat = np.array([geojson_lon_lat(loc) for loc in comps['loc_geojson']], dtype=float).reshape(-1, 2)
+        subject_lon_lat = np.array([geojson_lon_lat(subject['loc_geojson']) for subject in subjects], dtype=float)
+        subject_xyz = lon_lat_to_unit_xyz(subject_lon_lat[:, 0], subject_lon_lat[:, 1])
+        chord = meters_to_chord(distanceInMeters)
+        for transactionType in ("Sale", "Lease"):
+            is_type = (comps['transactionType'] == transactionType).to_numpy() & ~np.isnan(comp_lon_lat).any(axis=1)
+            if not is_type.any():
+                continue
+            type_ids = comps['costarID'][is_type].tolist()
+            tree = cKDTree(lon_lat_to_unit_xyz(comp_lon_lat[is_type, 0], comp_lon_lat[is_type, 1]))
+            for subject, comp_idx in zip(subjects, tree.query_ball_point(subject_xyz, r=chord)):
+                nearby_comps[(subject['costarID'], transactionType)] = {type_ids[i] for i in comp_idx}
+
+    # Get properties for every nearby comp costarID in one read
+    nearby_costarIDs = list(set().union(*nearby_comps.values())) if nearby_comps else []
+    candidates = list(properties_collection.find({"costarID": {"$in": nearby_costarIDs}}, {"_id": 0, "costarID": 1, "rba": 1, "ceilingHeight": 1})) if nearby_costarIDs else []
+    candidate_rows = {}
+    for row, candidate in enumerate(candidates):
+        candidate_rows.setdefault(candidate['costarID'], []).append(row)
 
-    # Get property data
-    property_data = properties_collection.find_one({"costarID": costarID}, {"_id": 0, "rba": 1, "ceilingHeight": 1, "loc_geojson": 1})
-    if property_data is None:
-        return
-    rba = property_data['rba']
-    ceilingHeight = property_data['ceilingHeight']
-    location = property_data['loc_geojson']
+    ####################
+    # Match properties that are within rba and ceilingHeight bounds and collect $addToSet values per property
+    added_comps = {}
+    for subject in subjects:
+        costarID, rba, ceilingHeight = subject['costarID'], subject['rba'], subject['ceilingHeight']
+        rba_lower_bound = rba - (rba * similarity)
+        rba_upper_bound = rba + (rba * similarity)
+        ceilingHeight_lower_bound = ceilingHeight - (ceilingHeight * similarity)
+        ceilingHeight_upper_bound = ceilingHeight + (ceilingHeight * similarity)
+        for transactionType, field in (("Sale", "saleComps"), ("Lease", "leaseComps")):
+            nearby = nearby_comps.get((costarID, transactionType))
+            if not nearby:
+                continue
+            compIDs = []
+            for row in sorted(row for compID in nearby for row in candidate_rows.get(compID, [])):
+                candidate = candidates[row]
+                if candidate['costarID'] in compIDs:
+                    continue
+                if isinstance(candidate.get('rba'), (int, float)) and rba_lower_bound <= candidate['rba'] <= rba_upper_bound \
+                    and isinstance(candidate.get('ceilingHeight'), (int, float)) and ceilingHeight_lower_bound <= candidate['ceilingHeight'] <= ceilingHeight_upper_bound:
+                    compIDs.append(candidate['costarID'])
+            for compID in compIDs:
+                added_comps.setdefault(compID, {}).setdefault(field, []).append(costarID)
 
-    # Compute bounds
-    rba_lower_bound = rba - (rba * 0.2)
-    rba_upper_bound = rba + (rba * 0.2)
-    ceilingHeight_lower_bound = ceilingHeight - (ceilingHeight * 0.2)
-    ceilingHeight_upper_bound = ceilingHeight + (ceilingHeight * 0.2)
+    ####################
+    # Update saleComps and leaseComps for nearby properties in one bulk write
+    update_ops = [
+        UpdateOne({"costarID": compID}, {"$addToSet": {field: {"$each": values} for field, values in fields.items()}})
+        for compID, fields in added_comps.items()
+    ]
+    if update_ops:
+        properties_collection.bulk_write(update_ops, ordered=False)
 
-    distanceInMeters = 5000
+    toc = time.perf_counter()
+    write_to_log_file(f"Updated comps for {len(costarIDs)} new comps ({len(update_ops)} properties) in {toc - tic:0.2f} seconds: {len(costarIDs) / max(toc - tic, 1e-9):.1f} comps/sec")
 
-    ####################
-    # SALE COMPS
-    # Get comps near given costarID
-    nearby_comp_cursor = apto_collection.find({"transactionType": "Sale", "loc_geojson": {"$near": location, "$maxDistance": distanceInMeters}}, {"_id": 0, "costarID": 1})
-    nearby_comps = pd.DataFrame(nearby_comp_cursor)
-    if nearby_comps.empty:
-        saleComps = []
-    else:
-        # Get properties for each comp costarID that match rba and ceilingHeight
-        nearby_comps = nearby_comps.dropna(subset=['costarID'])
-        nearby_comps_costarIDs = list(nearby_comps['costarID'].unique())
-        similar_properties = properties_collection.aggregate(
-            [
-            {
-                "$match": {
-                    "rba": {"$gte": rba_lower_bound, "$lte": rba_upper_bound},
-                    "ceilingHeight": {"$gte": ceilingHeight_lower_bound, "$lte": ceilingHeight_upper_bound},
-                    "costarID": {"$in": nearby_comps_costarIDs}
-                }
-            },
-            {
-                "$project": {"costarID": 1}
-            }
-            ])
-        compIDs = pd.DataFrame(similar_properties)
-        if compIDs.empty:
-            saleComps = []
-        else:
-            saleComps = list(compIDs['costarID'].unique())
 
-    ####################
-    # LEASE COMPS
-    nearby_comp_cursor = apto_collection.find({"transactionType": "Lease", "loc_geojson": {"$near": location, "$maxDistance": distanceInMeters}}, {"_id": 0, "costarID": 1})
-    nearby_comps = pd.DataFrame(nearby_comp_cursor)
-    if nearby_comps.empty:
-        leaseComps = []
-    else:
-        # Get properties for each comp costarID that match rba and ceilingHeight
-        nearby_comps = nearby_comps.dropna(subset=['costarID'])
-        nearby_comps_costarIDs = list(nearby_comps['costarID'].unique())
-        similar_properties = properties_collection.aggregate(
-            [
-            {
-                "$match": {
-                    "rba": {"$gte": rba_lower_bound, "$lte": rba_upper_bound},
-                    "ceilingHeight": {"$gte": ceilingHeight_lower_bound, "$lte": ceilingHeight_upper_bound},
-                    "costarID": {"$in": nearby_comps_costarIDs}
-                }
-            },
-            {
-                "$project": {"costarID": 1}
-            }
-            ])
-        compIDs = pd.DataFrame(similar_properties)
-        if compIDs.empty:
-            leaseComps = []
-        else:
-            leaseComps = list(compIDs['costarID'].unique())
+# Updated saleComps and leaseComps in properties collection given a new costarID
+def update_properties_comps(costarID):
+    update_properties_comps_batch([costarID])
 
 
-    ####################
-    # Update saleComps and leaseComps for nearby properties
-    for compID in saleComps:
-        properties_collection.update_one({"costarID": compID}, {"$addToSet": {"saleComps": costarID}})
-    for compID in leaseComps:
-        properties_collection.update_one({"costarID": compID}, {"$addToSet": {"leaseComps": costarID}})
+# Remove costarIDs from every property's saleComps and leaseComps (before they are matched again)
+def remove_properties_comps(costarIDs):
+    if not costarIDs:
+        return 0
+    properties_collection = get_mongo_client()['partners-edge']['properties']
+    result = properties_collection.update_many(
+        {"$or": [{"saleComps": {"$in": costarIDs}}, {"leaseComps": {"$in": costarIDs}}]},
+        {"$pull": {"saleComps": {"$in": costarIDs}, "leaseComps": {"$in": costarIDs}}}
+    )
+    return result.modified_count
+
+
+
+
+
+############################################################
+# Incremental sync. A high-water mark on LastModifiedDate is kept in partners-edge.sync_state; each run pulls only
+# comps modified since then. Every pulled comp is hashed on its raw fields (compHash on the apto_comps document, or in
+# apto_skipped_comps for comps cleaning drops), so comps that were touched in Salesforce without changing skip
+# cleaning, geocoding and writes, and only comps that actually changed are rematched.
+SYNC_STATE_ID = "apto_comps"
+HASH_EXCLUDED_FIELDS = ("LastModifiedDate", "SystemModstamp")
+SYNC_CLOCK_SKEW = pd.Timedelta(minutes=5)
+
+def get_sync_watermark():
+    sync_state = get_mongo_client()['partners-edge']['sync_state'].find_one({"_id": SYNC_STATE_ID})
+    return sync_state.get("lastModifiedDate") if sync_state else None
+
+def set_sync_watermark(last_modified_date):
+    get_mongo_client()['partners-edge']['sync_state'].update_one(
+        {"_id": SYNC_STATE_ID}, {"$set": {"lastModifiedDate": last_modified_date, "updatedAt": datetime.now()}}, upsert=True
+    )
+
+def hash_raw_comps(raw_df):
+    hash_cols = sorted(col for col in raw_df.columns if col not in HASH_EXCLUDED_FIELDS)
+    return [
+        hashlib.sha1(json.dumps(dict(zip(hash_cols, values)), default=str).encode()).hexdigest()
+        for values in raw_df[hash_cols].itertuples(index=False, name=None)
+    ]
+
+def sync_apto_comps():
+    tic = time.perf_counter()
+    watermark = get_sync_watermark()
+    sync_started = pd.Timestamp.now(tz="UTC")
+    # First sync has no watermark: fall back to the collection date filter
+    raw_comp_df = get_apto_comps(since_modified=watermark)
+    # One row per aptoID, the first, as post_apto_comps keeps
+    raw_comp_df = raw_comp_df.drop_duplicates(subset="Name", keep="first").reset_index(drop=True)
+    pulled = len(raw_comp_df)
+
+    # Skip comps whose raw fields hash the same as the posted comp, or as a comp that cleaning dropped
+    raw_comp_df["compHash"] = hash_raw_comps(raw_comp_df)
+    db = get_mongo_client()['partners-edge']
+    collection = db['apto_comps']
+    skipped_collection = db['apto_skipped_comps']
+    aptoIDs = raw_comp_df["Name"].tolist()
+    posted_comps = {
+        comp["aptoID"]: comp
+        for comp in collection.find({"aptoID": {"$in": aptoIDs}}, {"_id": 0, "aptoID": 1, "compHash": 1, "costarID": 1})
+    }
+    skipped_hashes = {
+        comp["aptoID"]: comp.get("compHash")
+        for comp in skipped_collection.find({"aptoID": {"$in": aptoIDs}}, {"_id": 0, "aptoID": 1, "compHash": 1})
+    }
+    is_changed = np.array([
+        comp_hash != posted_comps.get(aptoID, {}).get("compHash") and comp_hash != skipped_hashes.get(aptoID)
+        for aptoID, comp_hash in zip(raw_comp_df["Name"], raw_comp_df["compHash"])
+    ], dtype=bool)
+    changed_df = raw_comp_df[is_changed].reset_index(drop=True)
+
+    if not changed_df.empty:
+        clean_comp_df = clean_apto_comps(changed_df.drop(columns=["compHash"]))
+        clean_comp_df["compHash"] = clean_comp_df["aptoID"].map(dict(zip(changed_df["Name"], changed_df["compHash"])))
+        if not clean_comp_df.empty:
+            post_apto_comps(clean_comp_df, update_existing=True)
+
+        # Comps dropped by cleaning (no address) are never posted; keep their hash so they aren't pulled through again
+        dropped_df = changed_df[~changed_df["Name"].isin(clean_comp_df["aptoID"])]
+        if not dropped_df.empty:
+            skipped_collection.bulk_write([
+                UpdateOne({"aptoID": aptoID}, {"$set": {"compHash": comp_hash, "updatedAt": datetime.now()}}, upsert=True)
+                for aptoID, comp_hash in zip(dropped_df["Name"], dropped_df["compHash"])
+            ], ordered=False)
+
+        # Rematch from scratch: the changed comps' old and new costarIDs come out of every property's comps, then
+        # the new ones, and old ones another comp still points at, are matched again
+        new_costarIDs = {id for id in clean_comp_df['costarID'].unique() if pd.notna(id)}
+        old_costarIDs = {posted_comps[aptoID].get("costarID") for aptoID in changed_df["Name"] if aptoID in posted_comps}
+        old_costarIDs = {id for id in old_costarIDs if pd.notna(id)} - new_costarIDs
+        still_comps = set(collection.distinct("costarID", {"costarID": {"$in": list(old_costarIDs)}})) if old_costarIDs else set()
+        remove_properties_comps(list(new_costarIDs | old_costarIDs))
+        update_properties_comps_batch(list(new_costarIDs | still_comps))
+
+    # Advance the watermark to the newest modification pulled (truncated to the second, so >= never skips a record).
+    # The first sync only pulled by creation date, so it starts the watermark at the sync start instead.
+    if watermark is None:
+        new_watermark = (sync_started - SYNC_CLOCK_SKEW).strftime("%Y-%m-%dT%H:%M:%SZ")
+    elif pulled and raw_comp_df["LastModifiedDate"].notna().any():
+        last_modified = pd.to_datetime(raw_comp_df["LastModifiedDate"], utc=True, format="ISO8601").max()
+        new_watermark = max(last_modified, pd.Timestamp(watermark)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    else:
+        new_watermark = watermark
+    set_sync_watermark(new_watermark)
+
+    toc = time.perf_counter()
+    write_to_log_file(f"Apto sync: {pulled} comps modified since {watermark}, {len(changed_df)} changed, {pulled - len(changed_df)} unchanged, watermark {new_watermark}, {toc - tic:0.2f} seconds")
 
 
 
@@ -574,13 +920,21 @@ def update_properties_comps(costarID):
 ############################################################
 ############################################################
 if __name__ == '__main__':
-    raw_comp_df = get_apto_comps()
-    clean_comp_df = clean_apto_comps(raw_comp_df)
+    parser = argparse.ArgumentParser()
+    # created is the long-standing collection run by apto_main.py; incremental sync is opt-in until it replaces it
+    parser.add_argument('--mode', choices=['incremental', 'created'], default='created',
+                        help='created: comps created since the last collection date (default); incremental: comps modified since the last sync')
+    args = parser.parse_args()
+
+    if args.mode == 'incremental':
+        sync_apto_comps()
+    else:
+        raw_comp_df = get_apto_comps()
+        clean_comp_df = clean_apto_comps(raw_comp_df)
 
-    post_apto_comps(clean_comp_df)
+        post_apto_comps(clean_comp_df)
 
-    new_costarIDs = [id for id in clean_comp_df['costarID'].unique() if pd.notna(id)]
-    for costarID in new_costarIDs:
-        update_properties_comps(costarID)
+        new_costarIDs = [id for id in clean_comp_df['costarID'].unique() if pd.notna(id)]
+        update_properties_comps_batch(new_costarIDs)
 
     
@@ -0,0 +1,208 @@
+import os, sys, json, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+from salesforce_bulk import SalesforceBulk
+
+# Run from the repo root: python -m pytest apto/tests
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import get_and_set_apto_comps as apto
+from get_and_set_apto_comps import run_bulk_query, get_comp_search_dtypes
+
+
+############################################################
+# Local stand-in for the Salesforce Bulk API (v1), driven by a real SalesforceBulk client. Each batch has a script of
+# states, one per poll of the batch list (None while the batch doesn't exist yet; the last state repeats), and a list
+# of CSV result sets served once it is Completed.
+JOB_NS = "http://www.force.com/2009/06/asyncapi/dataload"
+
+class FakeBulkServer:
+    def __init__(self, batch_states, batch_results, state_messages=None):
+        self.batch_states = batch_states
+        self.batch_results = batch_results
+        self.state_messages = state_messages or {}
+        self.polls = 0
+        self.job_headers = None
+        self.soql = None
+        self.downloads = []
+        self.closed = False
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+                parts = self.path.split("/")[4:]
+                with fake.lock:
+                    if parts == ["job"]:
+                        fake.job_headers = dict(self.headers)
+                        return self.reply(f'<jobInfo xmlns="{JOB_NS}"><id>J1</id><state>Open</state></jobInfo>', "application/xml")
+                    if parts == ["job", "J1", "batch"]:
+                        fake.soql = body
+                        return self.reply(json.dumps({"id": "B0", "jobId": "J1", "state": "Queued"}))
+                    if parts == ["job", "J1"]:
+                        fake.closed = True
+                        return self.reply(json.dumps({"id": "J1", "state": "Closed"}))
+                self.reply("", status=404)
+
+            def do_GET(self):
+                parts = self.path.split("/")[4:]
+                with fake.lock:
+                    if parts == ["job", "J1", "batch"]:
+                        fake.polls += 1
+                        return self.reply(json.dumps({"batchInfo": fake.batch_list()}))
+                    if len(parts) == 4 and parts[:3] == ["job", "J1", "batch"]:
+                        return self.reply(json.dumps(fake.batch_info(parts[3])))
+                    if len(parts) == 5 and parts[4] == "result":
+                        return self.reply(json.dumps([f"R{i}" for i in range(len(fake.batch_results[parts[3]]))]))
+                    if len(parts) == 6 and parts[4] == "result":
+                        fake.downloads.append((parts[3], parts[5]))
+                        return self.reply(fake.batch_results[parts[3]][int(parts[5][1:])], "text/csv")
+                self.reply("", status=404)
+
+            def reply(self, text, content_type="application/json", status=200):
+                body = text.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.host = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def batch_state(self, batch_id):
+        states = self.batch_states[batch_id]
+        return states[min(self.polls, len(states)) - 1]
+
+    def batch_info(self, batch_id):
+        return {"id": batch_id, "jobId": "J1", "state": self.batch_state(batch_id), "stateMessage": self.state_messages.get(batch_id)}
+
+    def batch_list(self):
+        return [self.batch_info(batch_id) for batch_id in self.batch_states if self.batch_state(batch_id) is not None]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def bulk_server(monkeypatch):
+    # Record poll sleeps instead of waiting, and keep the collection log out of the repo
+    sleeps = []
+    monkeypatch.setattr(apto.time, "sleep", sleeps.append)
+    monkeypatch.setattr(apto, "write_to_log_file", lambda message: None)
+    servers = []
+
+    def start(batch_states, batch_results, state_messages=None):
+        server = FakeBulkServer(batch_states, batch_results, state_messages)
+        servers.append(server)
+        return server, SalesforceBulk(sessionId="test-session", host=server.host)
+
+    yield start, sleeps
+    for server in servers:
+        server.close()
+
+
+# Report metadata as returned by sf.restful('analytics/reports/...'), for the dtypes of the Bulk CSV
+REPORT = {
+    "reportMetadata": {"detailColumns": ["Comp_Search__c.Name", "Comp_Search__c.Zip_Code__c", "Comp_Search__c.Square_Footage__c", "Comp_Search__c.RecordType"]},
+    "reportExtendedMetadata": {"detailColumnInfo": {
+        "Comp_Search__c.Name": {"dataType": "string"},
+        "Comp_Search__c.Zip_Code__c": {"dataType": "string"},
+        "Comp_Search__c.Square_Footage__c": {"dataType": "double"},
+        "Comp_Search__c.RecordType": {"dataType": "picklist"},
+        "Comp_Search__c.Close_Date__c": {"dataType": "date"},
+    }},
+}
+COLUMNS = ["Name", "Zip_Code__c", "Square_Footage__c", "Record_Type__c"]
+SOQL = "SELECT Name, Zip_Code__c, Square_Footage__c, Record_Type__c FROM Comp_Search__c"
+
+def result_csv(*rows):
+    lines = ['"Name","Zip_Code__c","Square_Footage__c","Record_Type__c"']
+    lines += [f'"{name}","{zip_code}","{square_footage}","Lease"' for name, zip_code, square_footage in rows]
+    return "\n".join(lines) + "\n"
+
+
+############################################################
+def test_report_types_map_to_csv_dtypes():
+    assert get_comp_search_dtypes(REPORT) == {"Name": str, "Zip_Code__c": str, "Square_Footage__c": "float64", "Record_Type__c": str}
+
+
+def test_query_without_pk_chunking(bulk_server):
+    start, sleeps = bulk_server
+    server, bulk = start(
+        {"B0": ["Queued", "InProgress", "Completed"]},
+        {"B0": [result_csv(("A-1", "02134", 1000), ("A-2", "07030", "")), result_csv(("A-3", "00501", 2500.5)), "Records not found for this query"]},
+    )
+
+    df = run_bulk_query(bulk, "Comp_Search__c", SOQL, get_comp_search_dtypes(REPORT), COLUMNS)
+
+    assert "Sforce-Enable-PKChunking" not in server.job_headers
+    assert server.soql == SOQL
+    assert list(df["Name"]) == ["A-1", "A-2", "A-3"]
+    # Zip codes keep their leading zeros, and empty numbers are NaN
+    assert list(df["Zip_Code__c"]) == ["02134", "07030", "00501"]
+    assert df["Square_Footage__c"].dtype == "float64"
+    assert df["Square_Footage__c"].isna().tolist() == [False, True, False]
+    assert server.closed
+    # Two polls back off from the minimum interval before the batch completes
+    assert sleeps == [apto.BULK_POLL_MIN_SECONDS, 2 * apto.BULK_POLL_MIN_SECONDS]
+
+
+def test_query_with_pk_chunking(bulk_server):
+    start, sleeps = bulk_server
+    server, bulk = start(
+        {
+            # The submitted batch is split into chunks and never processed itself
+            "B0": ["Queued", "NotProcessed"],
+            "B1": [None, "Completed"],
+            "B2": [None, "Queued", "InProgress", "Completed"],
+            "B3": [None, "InProgress", "Completed"],
+        },
+        {
+            "B1": [result_csv(("A-1", "02134", 1000))],
+            "B2": [result_csv(("A-2", "07030", 2000)), result_csv(("A-3", "00501", 3000))],
+            "B3": ["Records not found for this query"],
+        },
+    )
+
+    df = run_bulk_query(bulk, "Comp_Search__c", SOQL, get_comp_search_dtypes(REPORT), COLUMNS, pk_chunking=apto.PK_CHUNK_SIZE)
+
+    assert server.job_headers["Sforce-Enable-PKChunking"] == f"chunkSize={apto.PK_CHUNK_SIZE};"
+    # Each chunk is downloaded once, as soon as it completes
+    assert server.downloads == [("B1", "R0"), ("B3", "R0"), ("B2", "R0"), ("B2", "R1")]
+    assert sorted(df["Name"]) == ["A-1", "A-2", "A-3"]
+    assert sorted(df["Zip_Code__c"]) == ["00501", "02134", "07030"]
+    assert server.closed
+    # Polling drops back to the minimum interval after every poll that downloaded something
+    assert sleeps == [apto.BULK_POLL_MIN_SECONDS] * 3
+
+
+def test_failed_chunk_raises(bulk_server):
+    start, sleeps = bulk_server
+    server, bulk = start(
+        {
+            "B0": ["NotProcessed"],
+            "B1": ["Completed"],
+            "B2": ["InProgress", "Failed"],
+        },
+        {"B1": [result_csv(("A-1", "02134", 1000))]},
+        {"B2": "InvalidBatch : query timed out"},
+    )
+
+    with pytest.raises(Exception, match="Bulk batch B2 Failed: InvalidBatch : query timed out"):
+        run_bulk_query(bulk, "Comp_Search__c", SOQL, get_comp_search_dtypes(REPORT), COLUMNS, pk_chunking=apto.PK_CHUNK_SIZE)
+    assert server.closed
+
+
+def test_query_with_no_results(bulk_server):
+    start, sleeps = bulk_server
+    server, bulk = start({"B0": ["Completed"]}, {"B0": ["Records not found for this query"]})
+
+    df = run_bulk_query(bulk, "Comp_Search__c", SOQL, get_comp_search_dtypes(REPORT), COLUMNS)
+
+    assert df.empty and list(df.columns) == COLUMNS
@@ -0,0 +1,207 @@
+import os, sys, json, time, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import pytest
+
+# Run from the repo root: python -m pytest apto/tests
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import get_and_set_apto_comps as apto
+from get_and_set_apto_comps import GeocodeCache, geocode_comps, google_data_validation
+
+
+############################################################
+# Local stand-in for the Google geocode API. Responses are looked up by the street address (the part of the
+# "address" parameter before the first comma): a list of statuses is served in order (the last one repeats), and
+# "OK" answers with a full street address whose latitude is the number at the start of the street address.
+class StubGeocodeServer:
+    def __init__(self, statuses=None, delay=0):
+        self.statuses = statuses or {}
+        self.delay = delay
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with stub.lock:
+                    stub.in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+                    street = parse_qs(urlparse(self.path).query)["address"][0].split(",")[0]
+                    stub.requests.append((street, time.monotonic()))
+                    statuses = stub.statuses.get(street, ["OK"])
+                    status = statuses.pop(0) if len(statuses) > 1 else statuses[0]
+                if stub.delay:
+                    time.sleep(stub.delay)
+                body = json.dumps(stub.response(street, status)).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with stub.lock:
+                    stub.in_flight -= 1
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/geocode/json"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def response(self, street, status):
+        if status != "OK":
+            return {"status": status, "results": []}
+        number, route = street.split(" ", 1)
+        return {"status": "OK", "results": [{
+            "place_id": f"place-{street}",
+            "geometry": {"location": {"lat": float(number), "lng": -float(number)}},
+            "address_components": [
+                {"long_name": number, "short_name": number, "types": ["street_number"]},
+                {"long_name": route, "short_name": route, "types": ["route"]},
+                {"long_name": "Springfield", "short_name": "Springfield", "types": ["locality", "political"]},
+                {"long_name": "Illinois", "short_name": "IL", "types": ["administrative_area_level_1", "political"]},
+                {"long_name": "62701", "short_name": "62701", "types": ["postal_code"]},
+            ],
+        }]}
+
+    def streets_requested(self):
+        return [street for street, _ in self.requests]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def geocoder(tmp_path, monkeypatch):
+    # Point the geocoder at a fresh cache and keep its logs out of the repo
+    monkeypatch.setenv("GOOGLE_API_KEY", "test-key")
+    monkeypatch.setattr(apto, "GOOGLE_ERROR_LOG_PATH", str(tmp_path / "google_error_log.csv"))
+    monkeypatch.setattr(apto, "write_to_log_file", lambda message: None)
+    cache = GeocodeCache(str(tmp_path / "geocode_cache.sqlite"))
+    monkeypatch.setattr(apto, "geocode_cache", cache)
+    servers = []
+
+    def start(statuses=None, delay=0):
+        server = StubGeocodeServer(statuses, delay)
+        monkeypatch.setattr(apto, "GOOGLE_GEOCODE_URL", server.url)
+        servers.append(server)
+        return server
+
+    yield start, cache
+    apto.flush_google_error_log()
+    for server in servers:
+        server.close()
+
+
+def comp(number):
+    return (f"{number} Main St", "Springfield", "IL", "62701")
+
+
+############################################################
+def test_over_query_limit_is_retried_with_backoff(geocoder, monkeypatch):
+    start, cache = geocoder
+    server = start({"7 Main St": ["OVER_QUERY_LIMIT", "OVER_QUERY_LIMIT", "OK"]})
+    sleeps = []
+    monkeypatch.setattr(apto.time, "sleep", sleeps.append)
+
+    google_data = google_data_validation(*comp(7), cache=cache, max_retries=3)
+
+    assert google_data["latitude"] == 7.0 and google_data["address"] == "7 Main St"
+    assert server.streets_requested() == ["7 Main St"] * 3
+    assert sleeps == [1, 2]
+
+
+def test_over_query_limit_gives_up_after_max_retries(geocoder, monkeypatch):
+    start, cache = geocoder
+    server = start({"7 Main St": ["OVER_QUERY_LIMIT"]})
+    sleeps = []
+    monkeypatch.setattr(apto.time, "sleep", sleeps.append)
+
+    assert google_data_validation(*comp(7), cache=cache, max_retries=2) is None
+    assert len(server.requests) == 3
+    assert sleeps == [1, 2]
+    # Rate limiting is not a negative answer, so it is not cached
+    assert google_data_validation(*comp(7), cache=cache, max_retries=0) is None
+    assert len(server.requests) == 4
+
+
+def test_results_are_keyed_back_to_their_comps(geocoder):
+    start, cache = geocoder
+    start({"13 Main St": ["ZERO_RESULTS"]}, delay=0.01)
+    # Keys are arbitrary (clean_df index values) and deliberately out of order
+    comps = {key: comp(number) for key, number in zip(range(100, 70, -1), range(1, 31))}
+
+    results = geocode_comps(comps, workers=8, requests_per_second=None)
+
+    assert set(results) == set(comps)
+    assert results[100 - 12] is None
+    for key, (address, city, state, zip_code) in comps.items():
+        if address != "13 Main St":
+            assert results[key]["address"] == address
+            assert results[key]["latitude"] == float(address.split(" ")[0])
+            assert results[key]["googleID"] == f"place-{address}"
+
+
+def test_concurrency_is_capped_at_workers(geocoder):
+    start, cache = geocoder
+    server = start(delay=0.05)
+
+    geocode_comps({number: comp(number) for number in range(1, 25)}, workers=4, requests_per_second=None)
+
+    assert len(server.requests) == 24
+    assert 2 <= server.max_in_flight <= 4
+
+
+def test_requests_are_rate_limited_across_workers(geocoder):
+    start, cache = geocoder
+    server = start()
+    requests_per_second = 20
+
+    geocode_comps({number: comp(number) for number in range(1, 21)}, workers=8, requests_per_second=requests_per_second)
+
+    times = sorted(request_time for _, request_time in server.requests)
+    assert len(times) == 20
+    # 20 requests spaced 1/20 s apart span at least 19/20 s, even with 8 threads
+    assert times[-1] - times[0] >= 0.9 * (len(times) - 1) / requests_per_second
+
+
+def test_repeat_addresses_are_served_from_the_cache(geocoder):
+    start, cache = geocoder
+    server = start({"3 Main St": ["ZERO_RESULTS"]})
+    comps = {number: comp(number) for number in range(1, 6)}
+
+    first = geocode_comps(comps, workers=2, requests_per_second=None)
+    assert len(server.requests) == 5
+    hits = cache.hits
+
+    # Found and not-found addresses are both cached, and the cache key ignores case and punctuation
+    second = geocode_comps({number: (address.upper() + ".", city, state, zip_code) for number, (address, city, state, zip_code) in comps.items()},
+                           workers=2, requests_per_second=None)
+    assert len(server.requests) == 5
+    assert cache.hits - hits == 5
+    assert second == first
+    assert second[3] is None
+
+
+def test_negative_cache_entries_expire_first(geocoder):
+    start, cache = geocoder
+    server = start({"3 Main St": ["ZERO_RESULTS"]})
+    comps = {number: comp(number) for number in range(1, 6)}
+    geocode_comps(comps, workers=2, requests_per_second=None)
+
+    # Age every entry past the negative TTL (30 days) but not the positive one (180 days)
+    with cache.conn:
+        cache.conn.execute("UPDATE geocodes SET cached_at = cached_at - ?", ((apto.GEOCODE_NEGATIVE_TTL_DAYS + 1) * 86400,))
+
+    results = geocode_comps(comps, workers=2, requests_per_second=None)
+    assert server.streets_requested()[5:] == ["3 Main St"]
+    assert results[3] is None and results[1]["latitude"] == 1.0
+
+    # Past the positive TTL everything is geocoded again
+    with cache.conn:
+        cache.conn.execute("UPDATE geocodes SET cached_at = cached_at - ?", ((apto.GEOCODE_CACHE_TTL_DAYS + 1) * 86400,))
+    geocode_comps(comps, workers=2, requests_per_second=None)
+    assert len(server.requests) == 6 + 5
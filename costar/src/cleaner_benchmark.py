@@ -0,0 +1,115 @@
+import time, os, io, ast, types, subprocess, contextlib
+from pymongo import MongoClient
+import certifi
+from dotenv import load_dotenv
+import pandas as pd
+
+from costar_cleaner import build_cleaner_table, clean_document
+
+
+############################################################
+# The reference cleaner is the one before the dispatch table, loaded from git rather than copied into the tree:
+# CostarCleaner.clean_and_set_data there defined its cleaners as nested functions and matched on feature type for
+# every field. Its nested functions and per-document loop body are compiled into reference_clean_document(raw_document).
+REFERENCE_REV = '89057f9'
+REFERENCE_PATH = 'costar/src/costar_cleaner.py'
+
+def load_reference_cleaner(feature_types, rev=REFERENCE_REV):
+    source = subprocess.run(['git', 'show', f'{rev}:{REFERENCE_PATH}'], capture_output=True, text=True, check=True).stdout
+    module = ast.parse(source)
+    costar_cleaner_class = next(node for node in module.body if isinstance(node, ast.ClassDef) and node.name == 'CostarCleaner')
+    clean_and_set_data = next(node for node in costar_cleaner_class.body if isinstance(node, ast.FunctionDef) and node.name == 'clean_and_set_data')
+    nested_cleaners = [node for node in clean_and_set_data.body if isinstance(node, ast.FunctionDef)]
+    document_loop = next(node for node in ast.walk(clean_and_set_data)
+                         if isinstance(node, ast.For) and isinstance(node.target, ast.Name) and node.target.id == 'raw_document')
+    # Everything but appending to clean_doc_list for the insert
+    document_body = [stmt for stmt in document_loop.body if 'clean_doc_list' not in ast.unparse(stmt)]
+
+    # The nested cleaners read feat from clean_and_set_data's scope, so it stays an enclosing variable here
+    indent = lambda code, level: '\n'.join(' ' * 4 * level + line for line in code.splitlines())
+    reference_source = '\n'.join([
+        'def make_reference_cleaner(self):',
+        '    feat = None',
+        *(indent(ast.unparse(node), 1) for node in nested_cleaners),
+        '    def reference_clean_document(raw_document):',
+        '        nonlocal feat',
+        *(indent(ast.unparse(stmt), 2) for stmt in document_body),
+        '        return clean_document',
+        '    return reference_clean_document',
+    ])
+
+    # Only the module's plain imports (numpy, pandas, re, ...) are needed by the cleaners
+    namespace = {}
+    imports = ast.Module(body=[node for node in module.body if isinstance(node, ast.Import)], type_ignores=[])
+    exec(compile(imports, f'{rev}:{REFERENCE_PATH}', 'exec'), namespace)
+    exec(compile(reference_source, f'{rev}:{REFERENCE_PATH} (reference cleaner)', 'exec'), namespace)
+    return namespace['make_reference_cleaner'](types.SimpleNamespace(feature_types=feature_types))
+
+
+# Equality for cleaned documents, where nan (inside lists, tuples and dicts too) equals nan
+def same_clean_value(a, b):
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(same_clean_value(a[k], b[k]) for k in a)
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        return type(a) == type(b) and len(a) == len(b) and all(same_clean_value(x, y) for x, y in zip(a, b))
+    if isinstance(a, float) and isinstance(b, float) and a != a and b != b:
+        return True
+    return type(a) == type(b) and a == b
+
+
+def best_time(clean, raw_documents, repeats):
+    best = None
+    for _ in range(repeats):
+        tic = time.perf_counter()
+        for raw_document in raw_documents:
+            clean(raw_document)
+        toc = time.perf_counter()
+        if best is None or toc - tic < best:
+            best = toc - tic
+    return best
+
+
+############################################################
+# Micro-benchmark for the per-feature cleaner dispatch table. Cleans the same sample of raw documents with the
+# reference (match feat_type) cleaner and the dispatch table several times, reports the best throughput of each in
+# documents per second (no database writes) and checks that both give the same cleaned documents.
+def benchmark_cleaning(raw_documents, repeats=5, reference_rev=REFERENCE_REV):
+    data_info_table = pd.read_csv('costar/input/data_info.csv', header=0, index_col=0)
+    feature_types = dict(zip(data_info_table['db_labels'].values, data_info_table['feature_types'].values))
+
+    tic = time.perf_counter()
+    cleaner_table = build_cleaner_table(feature_types)
+    toc = time.perf_counter()
+    print(f'Cleaner table built in {toc - tic:0.4f} seconds ({len(cleaner_table)} features)')
+
+    reference_clean_document = load_reference_cleaner(feature_types, reference_rev)
+
+    # Both cleaners print the same errors for bad values; print them once here, not on every repeat
+    mismatches = sum(not same_clean_value(reference_clean_document(raw_document), clean_document(raw_document, cleaner_table))
+                     for raw_document in raw_documents)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        reference_time = best_time(reference_clean_document, raw_documents, repeats)
+        table_time = best_time(lambda raw_document: clean_document(raw_document, cleaner_table), raw_documents, repeats)
+
+    reference_docs_per_sec = len(raw_documents) / reference_time
+    table_docs_per_sec = len(raw_documents) / table_time
+    print(f'Cleaned {len(raw_documents)} documents (best of {repeats}):')
+    print(f'  before (match feat_type): {reference_docs_per_sec:.1f} docs/sec')
+    print(f'  after (dispatch table):   {table_docs_per_sec:.1f} docs/sec ({table_docs_per_sec / reference_docs_per_sec:.2f}x)')
+    print(f'  {mismatches} documents differ between the two cleaners')
+    return reference_docs_per_sec, table_docs_per_sec, mismatches
+
+
+
+
+############################################################
+# Run from the repo root: python costar/src/cleaner_benchmark.py
+if __name__ == '__main__':
+    load_dotenv()
+    client = MongoClient(os.environ['PARTNERSDB_URI'], tlsCAFile=certifi.where())
+    # Sample raw documents from the latest archive of raw data
+    raw_documents = list(client['costagg']['archive'].aggregate([{'$sample': {'size': 2000}}]))
+    client.close()
+
+    benchmark_cleaning(raw_documents)
@@ -1,4 +1,4 @@
-import time, os, json, imaplib
+import time, os, json, imaplib, threading
 import pandas as pd
 # import numpy as np
 
@@ -6,6 +6,9 @@ from PIL import Image
 
 import boto3
 import zoom_service
+from download_watcher import DownloadWatcher
+from image_pipeline import ImagePipeline
+from export_fetcher import HistoricalExportFetcher, FETCH_OK, FETCH_NO_DATA, FETCH_AUTH
 
 from dotenv import load_dotenv
 
@@ -23,7 +26,10 @@ from selenium.common.exceptions import TimeoutException, StaleElementReferenceEx
 
 
 class CostaggWebscraper:
-    def __init__(self, scraping_status, headless=True):
+    # work_queue (see webscraping.ScrapingStatusQueue) hands out saved searches when several webscrapers run at once;
+    # worker_id gives this webscraper its own browser profile and download directory.
+    # fetch_mode 'http' downloads historical data with the browser's cookies instead of clicking through each property.
+    def __init__(self, scraping_status, headless=True, work_queue=None, worker_id=None, fetch_mode='browser', fetch_workers=8, image_workers=4):
         # Load environment variables
         load_dotenv()
         self.email = os.environ['EMAIL']
@@ -33,21 +39,32 @@ class CostaggWebscraper:
         # Load config & status of webscraping session
         self.step_list = pd.read_csv('costar/input/steps.csv', header=0)
         self.scraping_status = scraping_status
-        self.saved_search_list = [search for search, status in self.scraping_status.items() if status == 0]
-        if self.saved_search_list == []: exit(0) # In case there's an issue between a complete scraping session & closing the session
-        self.saved_search = self.saved_search_list.pop(0)
+        self.work_queue = work_queue
+        self.worker_id = worker_id
+        self.fetch_mode = fetch_mode
+        self.fetch_workers = fetch_workers
+        self.export_fetcher = None
+        if self.work_queue is None:
+            self.saved_search_list = [search for search, status in self.scraping_status.items() if status == 0]
+            first_search = self.saved_search_list.pop(0) if self.saved_search_list else None
+        else:
+            self.saved_search_list = []
+            first_search = self.work_queue.claim()
+        if first_search is None: exit(0) # In case there's an issue between a complete scraping session & closing the session
         self.saved_search_size = -1
+        self.init_prop_log_len = 0
+        self.prop_log_lock = threading.RLock()
+        self.load_saved_search(first_search)
 
-        # Check if the file exists and is not empty
-        file_path = 'costar/logs/prop_log/' + self.saved_search + '.csv'
-        if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
-            self.prop_log = pd.read_csv(file_path, header=0)
+        # Each worker downloads into (and cleans up) its own directory
+        if self.worker_id is None:
+            self.download_dir = 'costar/data'
         else:
-            print(f"Warning: The file '{file_path}' is empty or does not exist.")
-            self.prop_log = pd.DataFrame()  # Initialize with an empty DataFrame or handle as needed
-
-        self.init_prop_log_len = 0
-        self.saved_search_downloaded = len(self.prop_log)
+            self.download_dir = f'costar/data/worker_{self.worker_id}'
+        os.makedirs(self.download_dir, exist_ok=True)
+        self.download_watcher = DownloadWatcher(self.download_dir)
+        os.makedirs('costar/images', exist_ok=True)
+        self.image_pipeline = ImagePipeline(self.download_log, workers=image_workers)
 
         # Configure Firefox and Geckodriver
         opts = FirefoxOptions()
@@ -55,8 +72,13 @@ class CostaggWebscraper:
             opts.add_argument("--headless")
             opts.add_argument("--width=2000")
             opts.add_argument("--height=2000")
-        opts.set_preference("browser.download.dir", os.getcwd() + '/costar/data')
+        opts.set_preference("browser.download.dir", os.path.join(os.getcwd(), self.download_dir))
         opts.set_preference("browser.download.folderList", 2)
+        if self.worker_id is not None:
+            profile_dir = os.path.join(os.getcwd(), f'costar/profiles/worker_{self.worker_id}')
+            os.makedirs(profile_dir, exist_ok=True)
+            opts.add_argument("-profile")
+            opts.add_argument(profile_dir)
         driver_loc = "/usr/local/bin/geckodriver"
         service = FirefoxService(executable_path=driver_loc)
         self.driver = webdriver.Firefox(options=opts, service=service)
@@ -107,14 +129,36 @@ class CostaggWebscraper:
 
     ########################################
     def download_log(self, log_message):
+        if self.worker_id is not None:
+            log_message = f'[worker {self.worker_id}] {log_message}'
         with open('costar/logs/download.log', 'a') as f:
             f.write(log_message+'\n')
     
     def sync_prop_log(self):
-        self.prop_log.to_csv('costar/logs/prop_log/'+self.saved_search+'.csv', index=False, sep=',')
+        # Image uploads finish on the image pipeline's threads, which also update the prop log
+        with self.prop_log_lock:
+            self.prop_log.to_csv('costar/logs/prop_log/'+self.saved_search+'.csv', index=False, sep=',')
 
     def sync_scraping_status(self):
-        json.dump(self.scraping_status, open('costar/input/scraping_status.json', 'w'))
+        if self.work_queue is not None:
+            # Only this worker's search is written, atomically, so other workers' updates are never overwritten
+            self.work_queue.update(self.saved_search, self.scraping_status[self.saved_search])
+        else:
+            json.dump(self.scraping_status, open('costar/input/scraping_status.json', 'w'))
+
+    def load_saved_search(self, saved_search):
+        self.saved_search = saved_search
+        # Check if the file exists and is not empty
+        file_path = 'costar/logs/prop_log/' + self.saved_search + '.csv'
+        if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
+            self.prop_log = pd.read_csv(file_path, header=0)
+            # Prop logs written before images were tracked: recheck every image (saved ones are found in S3)
+            if 'ImageDone' not in self.prop_log.columns:
+                self.prop_log['ImageDone'] = False
+        else:
+            print(f"Warning: The file '{file_path}' is empty or does not exist.")
+            self.prop_log = pd.DataFrame()  # Initialize with an empty DataFrame or handle as needed
+        self.saved_search_downloaded = len(self.prop_log)
 
     ########################################
     # def get_2fa_code(self):
@@ -341,74 +385,33 @@ class CostaggWebscraper:
         self.prop_log['Building'] = present_data['Property Name']      
         self.prop_log['ID'] = present_data['PropertyID']
         self.prop_log['Complete'] = False
+        self.prop_log['ImageDone'] = False
 
         self.init_prop_log_len = len(self.prop_log)
         self.sync_prop_log()
 
     
     ########################################
-    def check_for_saved_image(self, costarID):
-        load_dotenv()
-        s3 = boto3.resource('s3')
-        bucket_name = 'costar-images'
-        file_name = f'{costarID}.jpg'
-        try:
-            s3.Object(bucket_name, file_name).load()
-        except Exception as e:
-            return False
-        return True
-
-
-    def standardize_image(self, image_path):
-        # Open image
-        img = Image.open(image_path)
-        # Get image size
-        width, height = img.size
-        # Resize image to 16:9 aspect ratio
-        if width/height < 16/9:
-            # Crop top and bottom of image to bring to 16:9 aspect ratio
-            ideal_height  = width * (9 / 16)
-            crop_length = (height - ideal_height) / 2
-            img = img.crop((0, crop_length, width, height - crop_length))
-        elif width/height > 16/9:
-            # Crop sides of image to bring to 16:9 aspect ratio
-            ideal_width = height * (16 / 9)
-            crop_length = (width - ideal_width) / 2
-            img = img.crop((crop_length, 0, width - crop_length, height))
-        else:
-            # Image is already 16:9 aspect ratio
-            pass
-
-        # # Downscale image to 1920x1080
-        img.thumbnail((1920, 1080))
-
-        # Save image as jpg
-        if image_path.split(".")[-1] == "png":
-            img = img.convert('RGB')
-            os.remove(image_path)
-            image_path = image_path.replace(".png", ".jpg")
-        img.save(image_path, 'JPEG', quality=100)
-
-
-    def post_image_to_s3(self, costarID):
-        load_dotenv()
-        s3 = boto3.resource('s3')
-        bucket_name = 'costar-images'
-        file_name = f'{costarID}.jpg'
-        s3.meta.client.upload_file(f'costar/images/{costarID}.jpg', bucket_name, file_name)
-        self.download_log(f"### Image Uploaded to S3 ({costarID})")
+    # Record that a property's image is saved (or that it has none), so later runs skip it
+    def mark_image_done(self, costarID):
+        with self.prop_log_lock:
+            self.prop_log.loc[self.prop_log['ID'].astype(str) == str(costarID), 'ImageDone'] = True
+            self.sync_prop_log()
 
 
+    ########################################
+    # Images are downloaded in the browser, then standardized and uploaded by self.image_pipeline in the background
     def get_property_image(self, costarID):
         # Check for leftover images (if there are any jpg or png files in costar/data, delete them)
-        for file in os.listdir('costar/data'):
+        for file in os.listdir(self.download_dir):
             if file.endswith('.jpg') or file.endswith('.png'):
-                os.remove(f'costar/data/{file}')
+                os.remove(f'{self.download_dir}/{file}')
 
         # CHECK S3 TO SEE IF IMAGE ALREADY EXISTS
-        image_exists = self.check_for_saved_image(costarID)
+        image_exists = self.image_pipeline.check_for_saved_image(costarID)
         if image_exists:
             self.download_log(f"### Image Already Exists ({costarID})")
+            self.mark_image_done(costarID)
             return
         else:
             self.driver.get(f"https://product.costar.com/detail/all-properties/{costarID}/summary")
@@ -422,33 +425,21 @@ class CostaggWebscraper:
                 if self.driver.find_elements(By.CSS_SELECTOR, ".carousel__carousel-toolbar-button--JUXMS:nth-child(1) > span"):
                     img_download_button = self.driver.find_element(By.CSS_SELECTOR, ".carousel__carousel-toolbar-button--JUXMS:nth-child(1) > span")
                     img_download_button.click()
-                    download_wait_counter = 0
-                    while not (os.path.exists('costar/data/PrimaryPhoto.jpg') 
-                               or os.path.exists('costar/data/PlatMap.jpg') 
-                               or os.path.exists('costar/data/PrimaryPhoto.png') 
-                               or os.path.exists('costar/data/PlatMap.png')) and download_wait_counter < 20:
-                        time.sleep(5)
-                        download_wait_counter += 5
-                    if download_wait_counter == 20:
+                    image_path = self.download_watcher.wait_for(['PrimaryPhoto.jpg', 'PlatMap.jpg', 'PrimaryPhoto.png', 'PlatMap.png'], timeout=20)
+                    if image_path is None:
                         self.download_log(f"!!! Image Download Timeout ({costarID})")
 
-                    for file in os.listdir('costar/data'):
-                        if file.endswith('.jpg'):
-                            os.replace(f'costar/data/{file}', f'costar/images/{costarID}.jpg')
-                            self.download_log(f"### Image Downloaded ({costarID})")
-                            self.standardize_image(f'costar/images/{costarID}.jpg')
-                            self.download_log(f"### Image Standardized ({costarID})")
-                        elif file.endswith('.png'):
-                            os.replace(f'costar/data/{file}', f'costar/images/{costarID}.png')
+                    for file in os.listdir(self.download_dir):
+                        if file.endswith('.jpg') or file.endswith('.png'):
+                            image_ext = file.split('.')[-1]
+                            os.replace(f'{self.download_dir}/{file}', f'costar/images/{costarID}.{image_ext}')
                             self.download_log(f"### Image Downloaded ({costarID})")
-                            self.standardize_image(f'costar/images/{costarID}.png')
-                            self.download_log(f"### Image Standardized ({costarID})")
-                    
-                    # POST IMAGE TO S3
-                    self.post_image_to_s3(costarID)
+                            # STANDARDIZE AND POST IMAGE TO S3 (in the background)
+                            self.image_pipeline.submit(costarID, f'costar/images/{costarID}.{image_ext}', on_done=self.mark_image_done)
 
             else:
                 self.download_log(f"!!! No Image Found ({costarID})")
+                self.mark_image_done(costarID)
         except Exception as e:
             self.download_log(f"!!! Image Download Exception ({costarID}) \n{e}")
 
@@ -535,19 +526,16 @@ class CostaggWebscraper:
             self.step("Initiate present data export", wait_time=2)
 
             # Wait for the download to complete
-            wait_timer = 0
-            while not os.path.exists('costar/data/CostarExport.xlsx') and wait_timer < 300:
-                self.download_log("Waiting for present data download...")
-                time.sleep(2)
-                wait_timer += 2
+            self.download_log("Waiting for present data download...")
+            export_path = self.download_watcher.wait_for(['CostarExport.xlsx'], timeout=300)
 
             # Check if the file was downloaded successfully
-            if not os.path.exists('costar/data/CostarExport.xlsx'):
+            if export_path is None:
                 self.download_log("Present data download stalled. Closing driver")
                 exit(1)
 
             # Move the file to the desired location
-            os.replace('costar/data/CostarExport.xlsx', f'costar/data/{self.saved_search}/{self.saved_search}.xlsx')
+            os.replace(f'{self.download_dir}/CostarExport.xlsx', f'costar/data/{self.saved_search}/{self.saved_search}.xlsx')
             present_data = pd.read_excel(f'costar/data/{self.saved_search}/{self.saved_search}.xlsx', engine='openpyxl')
             present_data['Property Class'] = ''
             present_data['Rent'] = ''
@@ -569,6 +557,15 @@ class CostaggWebscraper:
         else:
             self.init_prop_log_len = len(self.prop_log)
 
+        # Images are collected after the historical data, for every property whose image isn't done yet. This is
+        # tracked apart from Complete, so properties downloaded by a run that died still get their images on restart.
+        image_queue = list(self.prop_log[self.prop_log['ImageDone'] == False]['ID'])
+
+        # Properties the HTTP fetch found no data for are not retried in the browser
+        no_data_ids = set()
+        if self.fetch_mode == 'http':
+            no_data_ids = self.fetch_historical_data_http()
+
 
         # First pass to get data for all properties
 
@@ -580,14 +577,14 @@ class CostaggWebscraper:
             address = row['Address']
             building = row['Building']
             costarID = row['ID']
+            if str(costarID) in no_data_ids:
+                continue
             download_success = False
             attempts = 0
             while not download_success and attempts < 2:
                 try:
                     attempts += 1
 
-                    self.get_property_image(costarID)
-
                     self.driver.get(f"https://product.costar.com/detail/all-properties/{costarID}/analytics")
 
                     # FAIL CHECK
@@ -613,16 +610,11 @@ class CostaggWebscraper:
 
                     # FAIL CHECK
                     # Check if "Click historical data Export button" was successful & await download
-                    wait_timer = 0
-                    while not os.path.exists('costar/data/PropertyDetailDataTable.xlsx') and wait_timer < 30:
-                        if wait_timer != 0 and wait_timer % 6 == 0:
-                            self.download_log("Waiting for download...")
-                        time.sleep(2)
-                        wait_timer += 2
+                    history_path = self.download_watcher.wait_for(['PropertyDetailDataTable.xlsx'], timeout=30)
                     
                     # FAIL CHECK
                     # If the download exceeds 5 mins, then something is wrong, so try again
-                    if not os.path.exists('costar/data/PropertyDetailDataTable.xlsx'):
+                    if history_path is None:
                         # print("Download stalled (> 30s), trying again...")
                         self.download_log("Download stalled (> 30s), trying again...")
                         self.driver.get(f"https://product.costar.com/detail/all-properties/{costarID}/analytics")
@@ -631,7 +623,7 @@ class CostaggWebscraper:
                     # SUCCESS
                     # If this point is reached, then the download was successful
                     else:
-                        os.replace('costar/data/PropertyDetailDataTable.xlsx', f'costar/data/{self.saved_search}/{costarID}.xlsx')
+                        os.replace(f'{self.download_dir}/PropertyDetailDataTable.xlsx', f'costar/data/{self.saved_search}/{costarID}.xlsx')
                         self.download_log(f"\n### Downloaded {address}, {building} ({costarID}) -- {index+1}/{self.init_prop_log_len}\n")
                         download_success = True
                         self.prop_log.loc[index, 'Complete'] = True
@@ -653,16 +645,75 @@ class CostaggWebscraper:
         self.download_log("#"*50+"\n\n")
         self.download_log(f"########################################\n### NUMBER OF PROPERTIES DOWNLOADED: {len(self.prop_log[self.prop_log['Complete'] == True])}\n########################################")
 
+        # Image stage: the browser downloads each image and hands it to the image pipeline, which standardizes and
+        # uploads it on its own threads while the browser moves on to the next property
+        tic = time.perf_counter()
+        for costarID in image_queue:
+            self.get_property_image(costarID)
+        self.image_pipeline.join()
+        toc = time.perf_counter()
+        self.download_log(f"### Get Images Time: {toc - tic:0.4f} seconds")
+
+
+
+    ########################################
+    # Download the historical data for every incomplete property over HTTP, many at a time, with the browser
+    # session's cookies. Properties that fail are left incomplete for the browser loop in Get_Historical_Data.
+    # Returns the IDs of properties with no data.
+    def fetch_historical_data_http(self):
+        tic = time.perf_counter()
+        if self.export_fetcher is None:
+            self.export_fetcher = HistoricalExportFetcher.from_driver(self.driver, workers=self.fetch_workers)
+        else:
+            self.export_fetcher.set_cookies(self.driver.get_cookies())
+
+        incomplete = self.prop_log[self.prop_log['Complete'] == False]
+        row_by_id = {str(row['ID']): (index, row) for index, row in incomplete.iterrows()}
+
+        def on_result(costarID, result):
+            index, row = row_by_id[costarID]
+            if result == FETCH_OK:
+                self.download_log(f"\n### Downloaded {row['Address']}, {row['Building']} ({costarID}) -- {index+1}/{self.init_prop_log_len}\n")
+                self.prop_log.loc[index, 'Complete'] = True
+
+        results = self.export_fetcher.fetch_many(list(row_by_id), f'costar/data/{self.saved_search}', on_result=on_result)
+
+        # The session cookies may have been rotated by the browser; retry auth failures once with fresh cookies
+        auth_failed = [costarID for costarID, result in results.items() if result == FETCH_AUTH]
+        if auth_failed:
+            self.download_log(f"HTTP export rejected for {len(auth_failed)} properties, refreshing session cookies...")
+            self.export_fetcher.set_cookies(self.driver.get_cookies())
+            results.update(self.export_fetcher.fetch_many(auth_failed, f'costar/data/{self.saved_search}', on_result=on_result))
+        self.sync_prop_log()
+
+        num_ok = sum(result == FETCH_OK for result in results.values())
+        no_data_ids = {costarID for costarID, result in results.items() if result == FETCH_NO_DATA}
+        # No-data answers are only trusted once the endpoint has served at least one export in this pass;
+        # otherwise those properties go to the browser too
+        if num_ok == 0:
+            no_data_ids = set()
+        for costarID in no_data_ids:
+            index, row = row_by_id[costarID]
+            self.download_log(f"\n!!! NO DATA FOR {row['Address']}, {row['Building']} ({costarID}) -- {index+1}/{self.init_prop_log_len}\n")
+        num_failed = len(results) - num_ok - len(no_data_ids)
+        toc = time.perf_counter()
+        self.download_log(f"### HTTP export: {num_ok} downloaded, {num_failed} left for the browser in {toc - tic:0.4f} seconds")
+        return no_data_ids
+
 
 
     ########################################
     def Get_Completion_Status(self):
-        if not self.saved_search_list:
+        if self.work_queue is not None:
+            next_search = self.work_queue.claim()
+        elif self.saved_search_list:
+            next_search = self.saved_search_list.pop(0)
+        else:
+            next_search = None
+        if next_search is None:
             return True
         else:
-            self.saved_search = self.saved_search_list.pop(0)
-            self.prop_log = pd.read_csv('costar/logs/prop_log/'+self.saved_search+'.csv', header=0)
-            self.saved_search_downloaded = len(self.prop_log)
+            self.load_saved_search(next_search)
             return False
 
 
@@ -678,5 +729,9 @@ class CostaggWebscraper:
 
     ########################################
     def Close_Webscraping_Session(self):
+        self.download_watcher.close()
+        self.image_pipeline.close()
+        if self.export_fetcher is not None:
+            self.export_fetcher.close()
         self.driver.close()
         self.driver.quit()
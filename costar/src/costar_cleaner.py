@@ -1,12 +1,265 @@
 import numpy as np
 import pandas as pd
-from pymongo import MongoClient
-import certifi, re, time, os
-from model_definitions import GetForecast
-import copy
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, AutoReconnect
+import certifi, re, time, os, argparse, multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+from itertools import groupby
+from scipy.spatial import cKDTree
+from model_definitions import GetForecast, model_registry
+from spatial_index import geojson_lon_lat, lon_lat_to_unit_xyz, meters_to_chord
 from dotenv import load_dotenv
 from tqdm import tqdm
 
+
+############################################################
+# Per-feature cleaners. build_cleaner_table maps every db label in data_info.csv straight to one of these
+# functions once, so cleaning a document is one table lookup per field. Patterns are compiled here once.
+MISSING_VALUES = ('nan', '-', '')
+missing_value_set = frozenset(MISSING_VALUES)
+nan = np.nan
+
+rate_pattern = re.compile(r'\$(\d+\.\d+)/sf')
+year_pattern = re.compile(r'\b(\d{4}) (Tax|Ops)\b')
+est_year_pattern = re.compile(r'\b(\d{4}) Est (Tax|Ops)\b')
+amp_pattern = re.compile(r'(\d+-\d+|\d+)a')
+volt_pattern = re.compile(r'(\d+-\d+|\d+)v')
+phase_pattern = re.compile(r'(\d+)p')
+wire_pattern = re.compile(r'(\d+)w')
+drive_in_width_pattern = re.compile(r"(\d+)'(\d+)\"w")
+drive_in_height_pattern = re.compile(r"(\d+)'(\d+)\"h")
+column_width_pattern = re.compile(r"(\d+-\d+|\d+)'w")
+column_depth_pattern = re.compile(r"(\d+-\d+|\d+)'d")
+
+
+def clean_str_array(raw_array):
+    try:
+        return list(raw_array)
+    except Exception as e:
+        print(f'Error in Cleaning String Array: \n{e}')
+        return raw_array
+
+
+def clean_float_array(raw_array):
+    try:
+        return [nan if val in missing_value_set else float(val) for val in raw_array]
+    except Exception as e:
+        print(f'Error in Cleaning Float Array: \n{e}')
+        return raw_array
+
+
+def clean_str_value(raw_value):
+    try:
+        if raw_value in MISSING_VALUES:
+            return np.nan
+        else:
+            return str(raw_value)
+    except Exception as e:
+        print(f'Error in Cleaning String Value: \n{e}')
+        return raw_value
+
+
+def clean_float_value(raw_value):
+    try:
+        if raw_value in MISSING_VALUES:
+            return np.nan
+        else:
+            return float(raw_value)
+    except Exception as e:
+        print(f'Error in Cleaning Float Value: \n{e}')
+        return raw_value
+
+
+def clean_status_hist(raw_value):
+    return ["Under Construction" if val == "nan" else val for val in raw_value]
+
+
+def clean_expenses(raw_value, feat_name):
+    rate_test = rate_pattern.search(raw_value)
+    year_test = year_pattern.search(raw_value)
+    if rate_test and year_test:
+        return {'rate': float(rate_test.group(1)), 'year': int(year_test.group(1)), 'est': False}
+    est_year_test = est_year_pattern.search(raw_value)
+    if rate_test and est_year_test:
+        return {'rate': float(rate_test.group(1)), 'year': int(est_year_test.group(1)), 'est': True}
+    print(f'Unexpected pattern in \'{feat_name}\' value: \n{raw_value}')
+    return raw_value
+
+
+def clean_phone(raw_value):
+    raw_value = raw_value[:-2]
+    return raw_value[:3] + '-' + raw_value[3:6] + '-' + raw_value[6:]
+
+
+def clean_features(raw_value):
+    return raw_value.split(', ')
+
+
+# Parse "400" or "400-800" into a (min, max) tuple
+def parse_range(range_str):
+    if '-' in range_str:
+        return tuple(map(int, range_str.split('-')))
+    return (int(range_str), int(range_str))
+
+
+def clean_power(raw_value):
+    clean_value = {}
+    amp_test = amp_pattern.search(raw_value)
+    if 'Heavy' in raw_value:
+        clean_value['amps'] = (800, np.inf)
+    elif amp_test:
+        clean_value['amps'] = parse_range(amp_test.group(1))
+    else:
+        clean_value['amps'] = (np.nan, np.nan)
+
+    volt_test = volt_pattern.search(raw_value)
+    clean_value['volts'] = parse_range(volt_test.group(1)) if volt_test else (np.nan, np.nan)
+
+    phase_test = phase_pattern.search(raw_value)
+    clean_value['phases'] = int(phase_test.group(1)) if phase_test else np.nan
+
+    wire_test = wire_pattern.search(raw_value)
+    clean_value['wires'] = int(wire_test.group(1)) if wire_test else np.nan
+    return clean_value
+
+
+def clean_ceiling_height(raw_value):
+    foot_inch = raw_value[:-1].split('\'')
+    return int(foot_inch[0]) + int(foot_inch[1])/12
+
+
+def clean_drive_ins(raw_value):
+    # Quickly test is value is just "Yes"
+    if raw_value == 'Yes':
+        return {'exists': True, 'quantity': np.nan, 'width': np.nan, 'height': np.nan}
+    # Quickly test if value is just quantity
+    try:
+        return {'exists': True, 'quantity': int(raw_value), 'width': np.nan, 'height': np.nan}
+    except Exception:
+        pass
+
+    quantity = int(raw_value.split('/')[0])
+    width_test = drive_in_width_pattern.search(raw_value)
+    width = int(width_test.group(1)) + int(width_test.group(2))/12 if width_test else np.nan
+    height_test = drive_in_height_pattern.search(raw_value)
+    height = int(height_test.group(1)) + int(height_test.group(2))/12 if height_test else np.nan
+    return {'exists': True, 'quantity': quantity, 'width': width, 'height': height}
+
+
+def clean_column_spacing(raw_value):
+    # Only take the minimum column spacing
+    width_test = column_width_pattern.search(raw_value)
+    depth_test = column_depth_pattern.search(raw_value)
+    return {'width': int(width_test.group(1).split('-')[0]) if width_test else np.nan,
+            'depth': int(depth_test.group(1).split('-')[0]) if depth_test else np.nan}
+
+
+def clean_coordinate(raw_value):
+    return round(float(raw_value), 7)
+
+
+def clean_rent(raw_value):
+    clean_value = {}
+    if "-" not in raw_value:
+        if "Est." in raw_value:
+            # Remove "$" and " (Est.)"
+            clean_rent = raw_value.replace("$", "").replace(" (Est.)", "")
+            clean_value['rate'] = (clean_rent, clean_rent)
+            clean_value['est'] = True
+        else:
+            # Remove "$"
+            clean_rent = float(raw_value[1:])
+            clean_value['rate'] = (clean_rent, clean_rent)
+            clean_value['est'] = False
+    else:
+        if "Est." in raw_value:
+            clean_value['est'] = True
+            rents = raw_value.replace("$", "").replace(" (Est.)", "").split(" - ")
+        else:
+            clean_value['est'] = False
+            rents = raw_value[1:].split(" - ")
+        clean_value['rate'] = (float(rents[0]), float(rents[1]))
+    return clean_value
+
+
+def clean_zip(raw_value):
+    return raw_value[0:5]
+
+
+misc_cleaners = {
+    'statusHist': clean_status_hist,
+    'bldgTaxExpenses': partial(clean_expenses, feat_name='bldgTaxExpenses'),
+    'bldgOpExpenses': partial(clean_expenses, feat_name='bldgOpExpenses'),
+    'leasingCompanyPhone': clean_phone,
+    'leasingCompanyFax': clean_phone,
+    'features': clean_features,
+    'power': clean_power,
+    'ceilingHeight': clean_ceiling_height,
+    'driveIns': clean_drive_ins,
+    'columnSpacing': clean_column_spacing,
+    'latitude': clean_coordinate,
+    'longitude': clean_coordinate,
+    'rent': clean_rent,
+    'zip': clean_zip,
+}
+
+
+def keep_raw_value(raw_value):
+    return raw_value
+
+
+# Wrap a MISC cleaner with the shared missing value check and error handling
+def misc_value_cleaner(feat_name, cleaner):
+    def clean_misc_value(raw_value):
+        if raw_value in MISSING_VALUES:
+            return np.nan
+        try:
+            return cleaner(raw_value)
+        except Exception as e:
+            print(f'Error in Cleaning {feat_name} Value: \n(Raw Value: {raw_value}) \n{e}')
+            return raw_value
+    return clean_misc_value
+
+
+# Build {db label: cleaning function} from the {db label: feature type} mapping in data_info.csv
+def build_cleaner_table(feature_types):
+    type_cleaners = {
+        'String Array': clean_str_array,
+        'Float Array': clean_float_array,
+        'String Value': clean_str_value,
+        'Float Value': clean_float_value,
+    }
+    cleaner_table = {}
+    for feat, feat_type in feature_types.items():
+        if feat_type == 'MISC':
+            cleaner_table[feat] = misc_value_cleaner(feat, misc_cleaners.get(feat, keep_raw_value))
+        else:
+            cleaner_table[feat] = type_cleaners.get(feat_type, keep_raw_value)
+    return cleaner_table
+
+
+def clean_document(raw_document, cleaner_table):
+    clean_document = {}
+    for feat, raw_value in raw_document.items():
+        if feat == '_id': continue
+        clean_feat_val = cleaner_table[feat](raw_value)
+        # Don't create field in document if it's a non-array with a value of nan (nan is the only value != itself)
+        if clean_feat_val is None or (isinstance(clean_feat_val, float) and clean_feat_val != clean_feat_val):
+            continue
+        clean_document[feat] = clean_feat_val
+
+    # Create additional fields here
+    if 'latitude' in clean_document and 'longitude' in clean_document:
+        clean_document['loc_geojson'] = {
+            'type': 'Point',
+            'coordinates': [clean_document['longitude'], clean_document['latitude']]
+        }
+    return clean_document
+
+
+
+
 class CostarCleaner:
     def __init__(self):
         try:
@@ -32,399 +285,194 @@ class CostarCleaner:
         # if 'new_properties' not in self.clean_db.list_collection_names():
         #     self.new_properties_collection = self.clean_db['new_properties']
         self.new_properties_collection = self.clean_db['new_properties']
+
+        # Geography levels rolled up by aggregate_geographies. Each level lists the property fields that identify
+        # a region and the collection its aggregates are written to. Add an entry here to roll up a new geography.
+        self.rollup_levels = {
+            'county': {'keys': ['county', 'state'], 'collection': 'counties', 'upsert': False},
+            'zip': {'keys': ['zip'], 'collection': 'zip_codes', 'upsert': False},
+            'market': {'keys': ['market', 'state'], 'collection': 'markets', 'upsert': False},
+            'submarket': {'keys': ['submarketName', 'market', 'state'], 'collection': 'submarkets', 'upsert': True},
+        }
         
         data_info_table = pd.read_csv('costar/input/data_info.csv', header=0, index_col=0)
 
         self.feature_types = dict(zip(data_info_table['db_labels'].values, 
                                       data_info_table['feature_types'].values))
+        self.cleaner_table = build_cleaner_table(self.feature_types)
 
 
 
 
     ############################################################
-    def clean_and_set_data(self):
-        def clean_str_array(raw_array):
-            clean_array = []
-            try:
-                for val in raw_array:
-                    clean_array.append(val)
-            except Exception as e:
-                print(f'Error in Cleaning String Array: \n{e}')
-                return raw_array
-            return clean_array
+    def clean_and_set_data(self, chunk_size=1000, max_retries=3, workers=1):
+        market_names = self.new_raw_data.find().distinct('market')
+        market_counts = {}
+        insert_errors = []
+
+        if workers > 1:
+            # Fan markets out to a process pool. Each worker process opens its own MongoClient (see
+            # init_clean_worker) and writes its own chunked inserts; only counts and errors come back.
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=init_clean_worker) as executor:
+                futures = {executor.submit(clean_market_worker, mkt, chunk_size, max_retries): mkt for mkt in market_names}
+                for future in as_completed(futures):
+                    mkt = futures[future]
+                    try:
+                        inserted, errors = future.result()
+                    except Exception as e:
+                        inserted, errors = 0, [{'chunk': None, 'error': f'{type(e).__name__}: {e}'}]
+                    market_counts[mkt] = inserted
+                    for error in errors:
+                        error['market'] = mkt
+                    insert_errors += errors
+        else:
+            for mkt in market_names:
+                inserted, errors = self.clean_and_set_market(mkt, chunk_size, max_retries)
+                market_counts[mkt] = inserted
+                for error in errors:
+                    error['market'] = mkt
+                insert_errors += errors
+
+        print(f'Clean data inserted: {sum(market_counts.values())} documents across {len(market_counts)} markets')
+        for error in insert_errors:
+            print(f"Insert error in {error['market']} (chunk {error['chunk']}): {error['error']}")
         
+        # Only call update comps AFTER all new data has been added to properties collection
+        # if new_property_ids: 
+        #     self.update_comps(new_property_ids)
+    
 
-        def clean_float_array(raw_array):
-            clean_array = []
-            try:
-                for val in raw_array: 
-                    if val in ['nan', '-', '']:
-                        clean_array.append(np.nan)
-                    else:
-                        clean_array.append(float(val))
-            except Exception as e:
-                print(f'Error in Cleaning Float Array: \n{e}')
-                return raw_array
-            return clean_array
-
-
-        def clean_str_value(raw_value):
-            try:
-                if raw_value in ['nan', '-', '']:
-                    return np.nan
-                else:
-                    return str(raw_value)
-            except Exception as e:
-                print(f'Error in Cleaning String Value: \n{e}')
-                return raw_value
 
 
-        def clean_float_value(raw_value):
-            try:
-                if raw_value in ['nan', '-', '']:
-                    return np.nan
-                else:
-                    return float(raw_value)
-            except Exception as e:
-                print(f'Error in Cleaning Float Value: \n{e}')
-                return raw_value
-
-
-        def clean_misc_value(raw_value, feat_name):
-            if raw_value in ['nan', '-', '']:
-                return np.nan
-            try:
-                match feat_name:
-                    ##############################
-                    case 'statusHist':
-                        clean_value = []
-                        for val in raw_value:
-                            if val == "nan":
-                                clean_value.append("Under Construction")
-                            else:
-                                clean_value.append(val)
-                    ##############################
-                    case 'bldgTaxExpenses' | 'bldgOpExpenses':
-                        rate_pattern = r'\$(\d+\.\d+)/sf'
-                        year_pattern = r'\b(\d{4}) (Tax|Ops)\b'
-                        est_year_pattern = r'\b(\d{4}) Est (Tax|Ops)\b'
-                        rate_test = re.search(rate_pattern, raw_value)
-                        year_test = re.search(year_pattern, raw_value)
-                        est_year_test = re.search(est_year_pattern, raw_value)
-                        if rate_test and year_test:
-                            clean_value = {
-                                'rate': float(rate_test.group(1)),
-                                'year': int(year_test.group(1)), 
-                                'est': False
-                            }
-                        elif rate_test and est_year_test:
-                            clean_value = {
-                                'rate': float(rate_test.group(1)),
-                                'year': int(est_year_test.group(1)), 
-                                'est': True
-                            }
-                        else:
-                            print(f'Unexpected pattern in \'{feat_name}\' value: \n{raw_value}')
-                            clean_value = raw_value
-                    ##############################
-                    case 'leasingCompanyPhone' | 'leasingCompanyFax':
-                        raw_value = raw_value[:-2]
-                        clean_value = raw_value[:3] + '-' + raw_value[3:6] + '-' + raw_value[6:]
-                    ##############################
-                    case 'features':
-                        clean_value = raw_value.split(', ')
-                    ##############################
-                    case 'power':
-                        clean_value = {}
-                        amp_pattern = r'(\d+-\d+|\d+)a'
-                        volt_pattern = r'(\d+-\d+|\d+)v'
-                        phase_pattern = r'(\d+)p'
-                        wire_pattern = r'(\d+)w'
-
-                        if 'Heavy' in raw_value: 
-                            clean_value['amps'] = (800, np.inf)
-                        elif re.search(amp_pattern, raw_value):
-                            amp_str = re.search(amp_pattern, raw_value).group(1)
-                            if '-' in amp_str:
-                                clean_value['amps'] = tuple(map(int, amp_str.split('-')))
-                            else:
-                                clean_value['amps'] = (int(amp_str), int(amp_str))
-                        else:
-                            clean_value['amps'] = (np.nan, np.nan)
-                        
-                        if re.search(volt_pattern, raw_value):
-                            volt_str = re.search(volt_pattern, raw_value).group(1)
-                            if '-' in volt_str:
-                                clean_value['volts'] = tuple(map(int, volt_str.split('-')))
-                            else:
-                                clean_value['volts'] = (int(volt_str), int(volt_str))
-                        else:
-                            clean_value['volts'] = (np.nan, np.nan)
-                        
-                        if re.search(phase_pattern, raw_value):
-                            clean_value['phases'] = int(re.search(phase_pattern, raw_value).group(1))
-                        else:
-                            clean_value['phases'] = np.nan
-                        
-                        if re.search(wire_pattern, raw_value):
-                            clean_value['wires'] = int(re.search(wire_pattern, raw_value).group(1))
-                        else:
-                            clean_value['wires'] = np.nan
-                    ##############################
-                    case 'ceilingHeight':
-                        raw_value = raw_value[:-1]
-                        foot_inch = raw_value.split('\'')
-                        clean_value = int(foot_inch[0]) + int(foot_inch[1])/12
-                    ##############################
-                    case 'driveIns':
-                        # Quickly test is value is just "Yes"
-                        if raw_value == 'Yes':
-                            return {'exists': True, 'quantity': np.nan, 'width': np.nan, 'height': np.nan}
-                        # Quickly test if value is just quantity
-                        try: 
-                            count = int(raw_value)
-                            return {'exists': True, 'quantity': count, 'width': np.nan, 'height': np.nan}
-                        except Exception: 
-                            pass
-
-                        clean_value = {}
-                        clean_value['exists'] = True
-
-                        quantity = int(raw_value.split('/')[0])
-                        clean_value['quantity'] = quantity
-
-                        width_pattern = r"(\d+)'(\d+)\"w"
-                        height_pattern = r"(\d+)'(\d+)\"h"
-                        if re.search(width_pattern, raw_value):
-                            width_ft = int(re.search(width_pattern, raw_value).group(1))
-                            width_in = int(re.search(width_pattern, raw_value).group(2))
-                            width = width_ft + width_in/12
-                        else:
-                            width = np.nan
-                        
-                        if re.search(height_pattern, raw_value):
-                            height_ft = int(re.search(height_pattern, raw_value).group(1))
-                            height_in = int(re.search(height_pattern, raw_value).group(2))
-                            height = height_ft + height_in/12
-                        else:
-                            height = np.nan
-                        clean_value['width'] = width
-                        clean_value['height'] = height
-                    ##############################
-                    case 'columnSpacing':
-                        clean_value = {}
-                        width_pattern = r"(\d+-\d+|\d+)'w"
-                        depth_pattern = r"(\d+-\d+|\d+)'d"
-
-                        if re.search(width_pattern, raw_value):
-                            width_str = re.search(width_pattern, raw_value).group(1)
-                            if '-' in width_str:
-                                # Only take the minimum column spacing. 
-                                clean_value['width'] = int(width_str.split('-')[0])
-                            else:
-                                clean_value['width'] = int(width_str)
-                        else:
-                            clean_value['width'] = np.nan
-
-                        if re.search(depth_pattern, raw_value):
-                            depth_str = re.search(depth_pattern, raw_value).group(1)
-                            if '-' in depth_str:
-                                # Only take the minimum column spacing. 
-                                clean_value['depth'] = int(depth_str.split('-')[0])
-                            else:
-                                clean_value['depth'] = int(depth_str)
-                        else:
-                            clean_value['depth'] = np.nan
-                    ##############################
-                    case 'latitude' | 'longitude':
-                        clean_value = round(float(raw_value), 7)
-                    ##############################
-                    case 'rent':
-                        clean_value = {}
-                        if "-" not in raw_value:
-                            if "Est." in raw_value:
-                                # Remove "$" and " (Est.)"
-                                clean_rent = raw_value.replace("$", "")
-                                clean_rent = clean_rent.replace(" (Est.)", "")
-                                clean_value['rate'] = (clean_rent, clean_rent)
-                                clean_value['est'] = True
-                            else:
-                                # Remove "$"
-                                clean_rent = float(raw_value[1:])
-                                clean_value['rate'] = (clean_rent, clean_rent)
-                                clean_value['est'] = False
-                        else:
-                            if "Est." in raw_value:
-                                clean_value['est'] = True
-                                rents = raw_value.replace("$", "")
-                                rents = rents.replace(" (Est.)", "")
-                                rents = rents.split(" - ")
-                                clean_value['rate'] = (float(rents[0]), float(rents[1]))
-                            else:
-                                clean_value['est'] = False
-                                rents = raw_value[1:].split(" - ")
-                                clean_value['rate'] = (float(rents[0]), float(rents[1]))
-                    ##############################
-                    case 'zip': 
-                        clean_value = raw_value[0:5]
-
-            except Exception as e:
-                print(f'Error in Cleaning {feat} Value: \n(Raw Value: {raw_value}) \n{e}')
-                return raw_value
-
-            return clean_value
+    ############################################################
+    # Clean one market's raw documents and insert them into new_properties. Documents are cleaned as a generator,
+    # so only one cursor batch and one insert chunk are held in memory at a time. Returns (inserted, errors).
+    def clean_and_set_market(self, mkt, chunk_size=1000, max_retries=3):
+        def clean_documents(raw_cursor):
+            for raw_document in raw_cursor:
+                yield clean_document(raw_document, self.cleaner_table)
 
+        # Get data from MongoDB in batches
+        raw_cursor = self.new_raw_data.find({'market': mkt}, batch_size=chunk_size)
+        return self.insert_in_chunks(self.new_properties_collection, clean_documents(raw_cursor), chunk_size, max_retries)
 
-        market_names = self.new_raw_data.find().distinct('market')
-        new_property_ids = []
-        clean_doc_list = []
-        for mkt in market_names:
-            # Get data from MongoDB
-            self.raw_batch = self.new_raw_data.find({'market': mkt})
-
-            for raw_document in self.raw_batch:
-                clean_document = {}
-                for feat in raw_document:
-                    if feat == '_id': continue
-                    feat_type = self.feature_types[feat]
-                    match feat_type:
-                        case 'String Array':
-                            clean_feat_val = clean_str_array(raw_document[feat])
-                        case 'Float Array':
-                            clean_feat_val = clean_float_array(raw_document[feat])
-                        case 'String Value':
-                            clean_feat_val = clean_str_value(raw_document[feat])
-                        case 'Float Value':
-                            clean_feat_val = clean_float_value(raw_document[feat])
-                        case 'MISC':
-                            clean_feat_val = clean_misc_value(raw_document[feat], feat)
-                        case _:
-                            clean_feat_val = raw_document[feat]
-
-                    # Check if clean_feat_val is not an array and is nan
-                    if not isinstance(clean_feat_val, list) and pd.isna(clean_feat_val):
-                        # Don't create field in document if it's a non-array with a value of nan
-                        continue
-                    else:
-                        clean_document[feat] = clean_feat_val
-                        
-                # Create additional fields here
-                if 'latitude' in clean_document.keys() and 'longitude' in clean_document.keys():
-                    clean_document['loc_geojson'] = {
-                        'type': 'Point',
-                        'coordinates': [clean_document['longitude'], clean_document['latitude']]
-                    }
 
 
-                clean_doc_list.append(clean_document)
 
-        self.new_properties_collection.insert_many(clean_doc_list)
-        
-        # Only call update comps AFTER all new data has been added to properties collection
-        # if new_property_ids: 
-        #     self.update_comps(new_property_ids)
-    
+    ############################################################
+    # Insert documents from any iterable in unordered insert_many chunks of chunk_size. A chunk that hits a
+    # connection error is retried up to max_retries times; document-level failures are captured, not raised.
+    # Returns (number of documents inserted, list of {chunk, error} dicts).
+    def insert_in_chunks(self, collection, documents, chunk_size=1000, max_retries=3):
+        def flush(chunk, chunk_num):
+            inserted = 0
+            for attempt in range(max_retries + 1):
+                try:
+                    result = collection.insert_many(chunk, ordered=False)
+                    return inserted + len(result.inserted_ids), []
+                except BulkWriteError as e:
+                    write_errors = e.details.get('writeErrors', [])
+                    inserted += e.details.get('nInserted', 0)
+                    # On a retry, duplicate key errors are documents that made it in before the connection dropped
+                    if attempt > 0:
+                        inserted += len([err for err in write_errors if err.get('code') == 11000])
+                        write_errors = [err for err in write_errors if err.get('code') != 11000]
+                    return inserted, [{'chunk': chunk_num, 'error': err.get('errmsg', err)} for err in write_errors]
+                except AutoReconnect as e:
+                    if attempt == max_retries:
+                        return inserted, [{'chunk': chunk_num, 'error': f'{type(e).__name__}: {e}'}]
+                    time.sleep(2 ** attempt)
+                except Exception as e:
+                    return inserted, [{'chunk': chunk_num, 'error': f'{type(e).__name__}: {e}'}]
+
+        total_inserted = 0
+        errors = []
+        chunk = []
+        chunk_num = 0
+        for document in documents:
+            chunk.append(document)
+            if len(chunk) == chunk_size:
+                inserted, chunk_errors = flush(chunk, chunk_num)
+                total_inserted += inserted
+                errors += chunk_errors
+                chunk = []
+                chunk_num += 1
+        if chunk:
+            inserted, chunk_errors = flush(chunk, chunk_num)
+            total_inserted += inserted
+            errors += chunk_errors
+
+        return total_inserted, errors
+
 
 
 
     ############################################################
     ############################################################
     # ONLY CALL AFTER ALL DATA HAS BEEN ADDED TO PROPERTIES COLLECTION
-    def update_comps(self):
+    def update_comps(self, distanceInMeters=5000, similarity=0.2):
+        tic = time.perf_counter()
+
+        # Load every property (costarID, rba, ceilingHeight, location) and every comp point once
+        properties = pd.DataFrame(self.new_properties_collection.find({}, {"_id": 0, "costarID": 1, "rba": 1, "ceilingHeight": 1, "loc_geojson": 1}))
+        comps = pd.DataFrame(self.comps_collection.find({}, {"_id": 0, "costarID": 1, "transactionType": 1, "loc_geojson": 1}))
+        if properties.empty or comps.empty or 'costarID' not in properties or 'costarID' not in comps:
+            print('No properties or comps to match')
+            return
+        properties = properties.reindex(columns=['costarID', 'rba', 'ceilingHeight', 'loc_geojson']).dropna(subset=['costarID']).reset_index(drop=True)
+        comps = comps.reindex(columns=['costarID', 'transactionType', 'loc_geojson']).dropna(subset=['costarID']).reset_index(drop=True)
+
+        rba = pd.to_numeric(properties['rba'], errors='coerce').to_numpy(dtype=float)
+        ceilingHeight = pd.to_numeric(properties['ceilingHeight'], errors='coerce').to_numpy(dtype=float)
+        property_ids = properties['costarID'].tolist()
+
+        # Rows of each costarID in natural order, so matches come back in the same order as the old aggregate
+        property_rows = {}
+        for row, costarID in enumerate(property_ids):
+            property_rows.setdefault(costarID, []).append(row)
+
+        # Subjects: the first property document of each costarID that also appears in the comps collection
+        comp_ids = set(comps['costarID'].tolist())
+        subject_rows = [rows[0] for costarID, rows in property_rows.items() if costarID in comp_ids]
+        subject_lon_lat = np.array([geojson_lon_lat(properties['loc_geojson'].iat[row]) for row in subject_rows], dtype=float).reshape(-1, 2)
+        has_location = ~np.isnan(subject_lon_lat).any(axis=1) & ~np.isnan(rba[subject_rows]) & ~np.isnan(ceilingHeight[subject_rows])
+        if not has_location.all():
+            print(f'Skipping {int((~has_location).sum())} comp properties without rba, ceilingHeight or location')
+        subject_rows = [row for row, ok in zip(subject_rows, has_location) if ok]
+        subject_xyz = lon_lat_to_unit_xyz(subject_lon_lat[has_location, 0], subject_lon_lat[has_location, 1])
+
+        subject_comps = {row: {} for row in subject_rows}
+        comp_lon_lat = np.array([geojson_lon_lat(loc) for loc in comps['loc_geojson']], dtype=float).reshape(-1, 2)
+        for transactionType, field in (("Sale", "saleComps"), ("Lease", "leaseComps")):
+            is_type = (comps['transactionType'] == transactionType).to_numpy() & ~np.isnan(comp_lon_lat).any(axis=1)
+            if not is_type.any() or not subject_rows:
+                continue
+            type_ids = comps['costarID'][is_type].tolist()
+            tree = cKDTree(lon_lat_to_unit_xyz(comp_lon_lat[is_type, 0], comp_lon_lat[is_type, 1]))
+            nearby = tree.query_ball_point(subject_xyz, r=meters_to_chord(distanceInMeters))
 
-        # Get all unique costar IDs from properties collection
-        costar_ids = self.new_properties_collection.find({}, {'costarID': 1, '_id': 0})
-        costar_ids = pd.DataFrame(costar_ids)
-        costar_ids = costar_ids.dropna(subset=['costarID'])
-        costar_ids = list(costar_ids['costarID'].unique())
+            for row, comp_idx in zip(subject_rows, nearby):
+                if not comp_idx:
+                    continue
+                # Properties that are nearby comps and within +/- similarity of the subject's rba and ceiling height
+                candidate_rows = sorted(r for costarID in {type_ids[i] for i in comp_idx} for r in property_rows.get(costarID, []))
+                candidate_rows = np.array(candidate_rows, dtype=int)
+                rba_lower_bound, rba_upper_bound = rba[row] - (rba[row] * similarity), rba[row] + (rba[row] * similarity)
+                ceilingHeight_lower_bound, ceilingHeight_upper_bound = ceilingHeight[row] - (ceilingHeight[row] * similarity), ceilingHeight[row] + (ceilingHeight[row] * similarity)
+                is_similar = (rba[candidate_rows] >= rba_lower_bound) & (rba[candidate_rows] <= rba_upper_bound) \
+                    & (ceilingHeight[candidate_rows] >= ceilingHeight_lower_bound) & (ceilingHeight[candidate_rows] <= ceilingHeight_upper_bound)
+                matches = list(dict.fromkeys(property_ids[r] for r in candidate_rows[is_similar]))
+                if matches:
+                    subject_comps[row][field] = matches
 
-        for costarID in costar_ids: 
-            # Check if costarID is in comps collection
-            if self.comps_collection.count_documents({'costarID': costarID}) == 0:
-                continue
-            else:
-                property_data = self.new_properties_collection.find_one({'costarID': costarID}, {"_id": 0, "rba": 1, "ceilingHeight": 1, "loc_geojson": 1})
-                rba = property_data['rba']
-                ceilingHeight = property_data['ceilingHeight']
-                location = property_data['loc_geojson']
-
-                # Compute bounds
-                rba_lower_bound = rba - (rba * 0.2)
-                rba_upper_bound = rba + (rba * 0.2)
-                ceilingHeight_lower_bound = ceilingHeight - (ceilingHeight * 0.2)
-                ceilingHeight_upper_bound = ceilingHeight + (ceilingHeight * 0.2)
-
-                distanceInMeters = 5000
-
-                ####################
-                # SALE COMPS
-                nearby_sale_comps = self.comps_collection.find({"transactionType": "Sale", "loc_geojson": {"$near": location, "$maxDistance": distanceInMeters}}, {"_id": 0, "costarID": 1})
-                nearby_sale_comps = pd.DataFrame(nearby_sale_comps)
-                if nearby_sale_comps.empty:
-                    saleComps = []
-                else:
-                    nearby_sale_comps = nearby_sale_comps.dropna(subset=['costarID'])
-                    nearby_sale_comps_costarIDs = list(nearby_sale_comps['costarID'].unique())
-                    similar_properties = self.new_properties_collection.aggregate(
-                        [
-                        {
-                            "$match": {
-                                "rba": {"$gte": rba_lower_bound, "$lte": rba_upper_bound},
-                                "ceilingHeight": {"$gte": ceilingHeight_lower_bound, "$lte": ceilingHeight_upper_bound},
-                                "costarID": {"$in": nearby_sale_comps_costarIDs}
-                            }
-                        },
-                        {
-                            "$project": {"costarID": 1}
-                        }
-                        ])
-                    saleCompIDs = pd.DataFrame(similar_properties)
-                    if saleCompIDs.empty:
-                        saleComps = []
-                    else:
-                        saleComps = list(saleCompIDs['costarID'].unique())
-                    
-                # Update the property document with the sale comps
-                if saleComps:
-                    self.new_properties_collection.update_one(
-                        {"costarID": costarID},
-                        {"$set": {"saleComps": saleComps}}
-                    )
-
-                ####################
-                # LEASE COMPS
-                nearby_lease_comps = self.comps_collection.find({"transactionType": "Lease", "loc_geojson": {"$near": location, "$maxDistance": distanceInMeters}}, {"_id": 0, "costarID": 1})
-                nearby_lease_comps = pd.DataFrame(nearby_lease_comps)
-                if nearby_lease_comps.empty:
-                    leaseComps = []
-                else:
-                    nearby_lease_comps = nearby_lease_comps.dropna(subset=['costarID'])
-                    nearby_lease_comps_costarIDs = list(nearby_lease_comps['costarID'].unique())
-                    similar_properties = self.new_properties_collection.aggregate(
-                        [
-                        {
-                            "$match": {
-                                "rba": {"$gte": rba_lower_bound, "$lte": rba_upper_bound},
-                                "ceilingHeight": {"$gte": ceilingHeight_lower_bound, "$lte": ceilingHeight_upper_bound},
-                                "costarID": {"$in": nearby_lease_comps_costarIDs}
-                            }
-                        },
-                        {
-                            "$project": {"costarID": 1}
-                        }
-                        ])
-                    leaseCompIDs = pd.DataFrame(similar_properties)
-                    if leaseCompIDs.empty:
-                        leaseComps = []
-                    else:
-                        leaseComps = list(leaseCompIDs['costarID'].unique())
-                    
-                # Update the property document with the sale comps
-                if leaseComps:
-                    self.new_properties_collection.update_one(
-                        {"costarID": costarID},
-                        {"$set": {"leaseComps": leaseComps}}
-                    )
+        # Write every property's sale and lease comps back in one bulk write
+        update_ops = [UpdateOne({"costarID": property_ids[row]}, {"$set": fields}) for row, fields in subject_comps.items() if fields]
+        if update_ops:
+            result = self.new_properties_collection.bulk_write(update_ops, ordered=False)
+            print(f'Comps matched for {len(subject_rows)} properties: {result.modified_count} updated')
+        toc = time.perf_counter()
+        print(f'update_comps ran in {toc - tic:0.2f} seconds')
 
 
 
@@ -517,456 +565,225 @@ class CostarCleaner:
 
 
 
-    def aggregate_county_data(self):
-        # Generate quarter list
-        quarterNames = self.get_quarter_names()
-        # Get list of unique (county, state) pairs via aggregation pipeline
-        unique_counties_pipeline = [
-            {"$group": {"_id": {"county": "$county", "state": "$state"}}},
-            {"$project": {"county": "$_id.county", "state": "$_id.state", "_id": 0}}
-        ]
-        unique_counties = list(self.counties_collection.aggregate(unique_counties_pipeline))
-
-        # For each county
-        for cty in unique_counties:
-            properties_in_county = self.new_properties_collection.find({"county": cty['county'], "state": cty['state']},
-                                                        {'_id': 0, 
-                                                         'address': 1, 
-                                                         'quarter': 1, 
-                                                         'statusHist': 1, 
-                                                         'occupancySF': 1, 
-                                                         'netAbsorptionSFTotal': 1, 
-                                                         'status': 1,
-                                                         'rba': 1, 
-                                                         'ceilingHeight': 1, 
-                                                         'yearBuilt': 1, 
-                                                         'propertyType': 1})
-            region_df = pd.DataFrame(properties_in_county)
-
-            # If no properties in county, skip to next county
-            if region_df.empty:
-                continue
-
-            # Initialize each aggregate field in a dataframe
-            aggregate_df = pd.DataFrame({'quarter': quarterNames})
-            aggregate_df['propertyCount'] = 0
-            aggregate_df['rbaSum'] = 0
-            aggregate_df['ceilingHeightSum'] = 0
-            aggregate_df['yearBuiltSum'] = 0
-            aggregate_df['occupancySFSum'] = 0
-            aggregate_df['netAbsSum'] = 0
-
-            # Initialize dataframe for forecasting input
-            hist_df = pd.DataFrame(columns=['Quarter', 'NA', 'DEL'])
-            # Initialize under construction list for forecasting input
-            uc_sf = [0]*6
-            # Initialize total existing rba
-            total_rba = 0
-
-            # Get most recent quarter in data
-            sample_quarters = region_df.loc[0]['quarter']
-            sample_quarters = [q for q in sample_quarters if "QTD" in q]
-            if len(sample_quarters) == 0:
-                continue
-            else:
-                most_recent_quarter = sample_quarters[0]
-            most_recent_quarter = most_recent_quarter.replace(" QTD", "")
-            most_recent_year, most_recent_quarter_number = most_recent_quarter.split(" Q")
-
-            # Get historical data quarters
-            hist_qtr = f"{most_recent_year}-Q{most_recent_quarter_number}"
-            historical_quarters = []
-            for _ in range(24):
-                hist_qtr = self.get_prev_quarter(hist_qtr)
-                historical_quarters.append(hist_qtr)
-            
-            hist_df['Quarter'] = historical_quarters
-            hist_df['NA'] = 0
-            hist_df['DEL'] = 0
-
-
-            # For each property
-            for idx, prop in region_df.iterrows():
-                # Create new df for quarter, statusHist, occupancySF, netAbsorptionSFTotal
-                prop_df = pd.DataFrame({'quarter': prop['quarter'],
-                                        'statusHist': prop['statusHist'],
-                                        'occupancySF': prop['occupancySF'],
-                                        'netAbsorptionSFTotal': prop['netAbsorptionSFTotal']})
-                # If prop_df is empty, continue
-                if prop_df.empty:
-                    continue
-                # Remove row where quarter that includes QTD
-                prop_df = prop_df[prop_df['quarter'].str[-3:] != 'QTD']
-                # Remove rows where quarter is before 2011 Q1
-                prop_df = prop_df[prop_df['quarter'].str[:4] > "2010"]
-
-                # Create separate df for hist data
-                hist_prop_df = copy.deepcopy(prop_df)
-                hist_prop_df['netAbsorptionSFTotal'] = hist_prop_df['netAbsorptionSFTotal'].fillna(0)
-
-                # Remove rows where statusHist is not "Existing"
-                prop_df = prop_df[prop_df['statusHist'] == "Existing"]
-                # Replace nan values in netAbsorptionSFTotal with 0
-                prop_df['netAbsorptionSFTotal'] = prop_df['netAbsorptionSFTotal'].fillna(0)
+    # Columnar aggregation of a region's properties. Every property's quarterly arrays are exploded into one
+    # long frame (one row per property per quarter) and each per-quarter total is computed with a single groupby.
+    # Returns ({field: [{label, value}]}, total_rba, hist_df, uc_sf), or None if the region has no QTD quarter.
+    def aggregate_region(self, region_df, quarterNames):
+        hist_cols = ['quarter', 'statusHist', 'occupancySF', 'netAbsorptionSFTotal']
+        sum_cols = {'rba': 'rbaSum',
+                    'ceilingHeight': 'ceilingHeightSum',
+                    'yearBuilt': 'yearBuiltSum',
+                    'occupancySF': 'occupancySFSum',
+                    'netAbsorptionSFTotal': 'netAbsSum'}
 
-            
-                # For each quarter left in prop_df
-                for idx, row in prop_df.iterrows():
-
-                    qtr = row['quarter']
+        # Sum each group, but keep nan when any value in the group is nan (same as a running += total)
+        def strict_sum(grouped):
+            return grouped.sum().where(grouped.count().eq(grouped.size(), axis=0))
 
-                    # Add values to aggregate fields
-                    aggregate_df.loc[aggregate_df['quarter'] == qtr, 'propertyCount'] += 1
-                    aggregate_df.loc[aggregate_df['quarter'] == qtr, 'rbaSum'] += prop['rba']
-                    aggregate_df.loc[aggregate_df['quarter'] == qtr, 'ceilingHeightSum'] += prop['ceilingHeight']
-                    aggregate_df.loc[aggregate_df['quarter'] == qtr, 'yearBuiltSum'] += prop['yearBuilt']
-                    aggregate_df.loc[aggregate_df['quarter'] == qtr, 'occupancySFSum'] += row['occupancySF']
-                    aggregate_df.loc[aggregate_df['quarter'] == qtr, 'netAbsSum'] += row['netAbsorptionSFTotal']
+        # Turn "2024 Q1" labels into consecutive integers so previous quarters are just index - 1
+        def quarter_index(quarters):
+            return quarters.str[:4].astype(int) * 4 + quarters.str[-1].astype(int) - 1
 
+        # Get most recent quarter in data
+        sample_quarters = region_df.iloc[0]['quarter']
+        sample_quarters = [q for q in sample_quarters if "QTD" in q]
+        if len(sample_quarters) == 0:
+            return None
+        else:
+            most_recent_quarter = sample_quarters[0]
+        most_recent_quarter = most_recent_quarter.replace(" QTD", "")
+        most_recent_year, most_recent_quarter_number = most_recent_quarter.split(" Q")
+
+        # Get historical data quarters
+        hist_qtr = f"{most_recent_year}-Q{most_recent_quarter_number}"
+        historical_quarters = []
+        for _ in range(24):
+            hist_qtr = self.get_prev_quarter(hist_qtr)
+            historical_quarters.append(hist_qtr)
+        historical_index = quarter_index(pd.Series(historical_quarters))
+
+        # Make sure every field used below exists, then drop properties with no quarterly history
+        region_df = region_df.reindex(columns=list(dict.fromkeys(hist_cols + list(sum_cols) + ['status'])))
+        has_history = region_df['quarter'].apply(lambda q: isinstance(q, list) and len(q) > 0)
+        region_df = region_df[has_history].reset_index(drop=True)
+        # A missing history array is treated as nan for every quarter of the property
+        for col in hist_cols[1:]:
+            region_df[col] = [v if isinstance(v, list) else [v]*len(q) for v, q in zip(region_df[col], region_df['quarter'])]
+
+        # Explode into one row per (property, quarter), keeping each array's original position
+        long_df = region_df.explode(hist_cols).rename_axis('propIdx').reset_index()
+        long_df['position'] = long_df.groupby('propIdx').cumcount()
+        long_df['occupancySF'] = long_df['occupancySF'].astype(float)
+        long_df['netAbsorptionSFTotal'] = long_df['netAbsorptionSFTotal'].astype(float)
+        full_long_df = long_df
+
+        # Remove rows where quarter includes QTD, and rows where quarter is before 2011 Q1
+        long_df = long_df[long_df['quarter'].str[-3:] != 'QTD']
+        long_df = long_df[long_df['quarter'].str[:4] > "2010"].copy()
+        # Replace nan values in netAbsorptionSFTotal with 0
+        long_df['netAbsorptionSFTotal'] = long_df['netAbsorptionSFTotal'].fillna(0)
+
+        ##########
+        # Per-quarter aggregates over quarters where the property was "Existing"
+        existing_grouped = long_df[long_df['statusHist'] == "Existing"].groupby('quarter')
+        quarter_sums = strict_sum(existing_grouped[list(sum_cols)]).rename(columns=sum_cols)
+
+        aggregate_df = pd.DataFrame({'quarter': quarterNames})
+        aggregate_df['propertyCount'] = existing_grouped.size().reindex(quarterNames, fill_value=0).values
+        for col in sum_cols.values():
+            aggregate_df[col] = quarter_sums[col].reindex(quarterNames, fill_value=0).values
+
+        # Create new columns for meanRba, meanCeilingHeight, meanYearBuilt
+        aggregate_df['meanRba'] = aggregate_df['rbaSum'] / aggregate_df['propertyCount']
+        aggregate_df['meanCeilingHeight'] = aggregate_df['ceilingHeightSum'] / aggregate_df['propertyCount']
+        aggregate_df['meanYearBuilt'] = aggregate_df['yearBuiltSum'] / aggregate_df['propertyCount']
+        # Create new column for occupancy rate
+        aggregate_df['occupancyRate'] = aggregate_df['occupancySFSum'] / aggregate_df['rbaSum']
+
+        # Convert dataframe to arrays of dictionaries {label: quarter, value: v}
+        output_cols = {'propertyCount': 'propertyCount',
+                       'rba': 'rbaSum',
+                       'meanRba': 'meanRba',
+                       'meanCeilingHeight': 'meanCeilingHeight',
+                       'meanYearBuilt': 'meanYearBuilt',
+                       'occupancyRate': 'occupancyRate',
+                       'netAbsorption': 'netAbsSum'}
+        aggregate_fields = {}
+        for field, col in output_cols.items():
+            aggregate_fields[field] = [{'label': qtr, 'value': val} for qtr, val in zip(quarterNames, aggregate_df[col].tolist())]
+
+        ##########
+        # Forecasting inputs
+        total_rba = region_df.loc[region_df['status'] == "Existing", 'rba'].sum(skipna=False)
+
+        # Each property's current status is the status of its first remaining quarter
+        current_status = long_df.drop_duplicates('propIdx').set_index('propIdx')['statusHist']
+        uc_props = current_status.index[current_status == "Under Construction"]
+        hist_props = current_status.index[current_status != "Under Construction"]
+
+        # Under construction SF, bucketed by number of quarters under construction (excluding the first array entry)
+        uc_rows = full_long_df[full_long_df['propIdx'].isin(uc_props) & (full_long_df['position'] >= 1)]
+        num_uc_quarters = (uc_rows['statusHist'] == "Under Construction").groupby(uc_rows['propIdx']).sum()
+        uc_rba = region_df.loc[num_uc_quarters.index, 'rba']
+        uc_sf = [uc_rba[num_uc_quarters == n].sum(skipna=False) for n in range(1, 7)]
+
+        # Historical net absorption and deliveries
+        hist_long_df = long_df[long_df['propIdx'].isin(hist_props)].copy()
+        hist_long_df['qtrIdx'] = quarter_index(hist_long_df['quarter'])
+        hist_long_df['isExisting'] = hist_long_df['statusHist'] == "Existing"
+        hist_long_df['isUC'] = hist_long_df['statusHist'] == "Under Construction"
+        # Status flags of the previous quarter, joined back on (property, quarter)
+        prev_flags = hist_long_df.groupby(['propIdx', 'qtrIdx'])[['isExisting', 'isUC']].any().reset_index()
+        prev_flags['qtrIdx'] += 1
+        prev_flags = prev_flags.rename(columns={'isExisting': 'prevExisting', 'isUC': 'prevUC'})
+        hist_long_df = hist_long_df.merge(prev_flags, on=['propIdx', 'qtrIdx'], how='left')
+        hist_long_df['prevExisting'] = hist_long_df['prevExisting'].eq(True)
+        hist_long_df['prevUC'] = hist_long_df['prevUC'].eq(True)
+        hist_long_df = hist_long_df[hist_long_df['qtrIdx'].isin(historical_index)]
+
+        demolished = hist_long_df['statusHist'].isin(['Demolished', 'Converted'])
+        existing = hist_long_df['statusHist'].isin(['Existing', 'Under Renovation'])
+        # Existing/Under Renovation quarters add net absorption
+        na_rows = hist_long_df[existing]
+        na_sums = na_rows.groupby('qtrIdx')['netAbsorptionSFTotal'].sum()
+        # Demolitions of previously existing buildings subtract rba, completions of under construction buildings add it
+        del_rows = pd.concat([hist_long_df.loc[demolished & hist_long_df['prevExisting'], ['qtrIdx']].assign(DEL=-hist_long_df['rba']),
+                              hist_long_df.loc[existing & hist_long_df['prevUC'], ['qtrIdx']].assign(DEL=hist_long_df['rba'])])
+        del_sums = strict_sum(del_rows.groupby('qtrIdx')['DEL'])
+
+        hist_df = pd.DataFrame({'Quarter': historical_quarters})
+        hist_df['NA'] = na_sums.reindex(historical_index, fill_value=0).values
+        hist_df['DEL'] = del_sums.reindex(historical_index, fill_value=0).values
+
+        return aggregate_fields, total_rba, hist_df, uc_sf
+
+
+
+    # Single rollup stage for every geography level in self.rollup_levels. Each level streams the properties
+    # collection sorted by its key fields, with only the fields aggregate_region needs, so one region's properties
+    # are in memory at a time. All of a level's regions are forecast together and written in one bulk_write.
+    def aggregate_geographies(self, levels=None, report_models=False):
+        if levels is None:
+            levels = list(self.rollup_levels.keys())
+        # Generate quarter list
+        quarterNames = self.get_quarter_names()
 
-                if prop['status'] == "Existing":
-                    total_rba += prop['rba']
-
-                # Check if property is under construction
-                current_status = hist_prop_df['statusHist']
-                if current_status.empty:
+        # Fields needed by aggregate_region
+        projection = {'_id': 0,
+                      'quarter': 1,
+                      'statusHist': 1,
+                      'occupancySF': 1,
+                      'netAbsorptionSFTotal': 1,
+                      'status': 1,
+                      'rba': 1,
+                      'ceilingHeight': 1,
+                      'yearBuilt': 1}
+
+        for level in levels:
+            keys = self.rollup_levels[level]['keys']
+            collection = self.clean_db[self.rollup_levels[level]['collection']]
+            upsert = self.rollup_levels[level]['upsert']
+
+            # Properties with every key field set, sorted so each region's properties arrive together
+            level_projection = dict(projection, **{key: 1 for key in keys})
+            properties = self.new_properties_collection.find({key: {'$ne': None} for key in keys}, level_projection,
+                                                             batch_size=5000, allow_disk_use=True).sort([(key, 1) for key in keys])
+
+            region_entries = []
+            for region_key, region_properties in groupby(properties, key=lambda prop: tuple(prop[key] for key in keys)):
+                if any(pd.isna(value) for value in region_key):
                     continue
-                else:
-                    current_status = current_status.iloc[0]
-                if current_status == "Under Construction":
-                    num_uc_quarters = list(prop['statusHist'])[1:].count("Under Construction")
-                    if num_uc_quarters == 1:
-                        uc_sf[0] += prop['rba']
-                    elif num_uc_quarters == 2:
-                        uc_sf[1] += prop['rba']
-                    elif num_uc_quarters == 3:
-                        uc_sf[2] += prop['rba']
-                    elif num_uc_quarters == 4:
-                        uc_sf[3] += prop['rba']
-                    elif num_uc_quarters == 5:
-                        uc_sf[4] += prop['rba']
-                    elif num_uc_quarters == 6:
-                        uc_sf[5] += prop['rba']
+                region_df = pd.DataFrame(list(region_properties)).drop(columns=keys)
+                region_aggregate = self.aggregate_region(region_df, quarterNames)
+                if region_aggregate is None:
                     continue
+                aggregate_fields, total_rba, hist_df, uc_sf = region_aggregate
+                region_entries.append((dict(zip(keys, region_key)), aggregate_fields, (total_rba, hist_df, uc_sf)))
+
+            # Get forecasts for every region of this level, one forward pass per rba bucket
+            forecast_results = self.generate_batch_forecasts([forecast_input for _, _, forecast_input in region_entries])
+
+            region_updates = []
+            for (region_filter, aggregate_fields, _), forecast_result in zip(region_entries, forecast_results):
+                # Update the region document with the aggregate fields
+                if not forecast_result or type(forecast_result) == str:
+                    update = {'$set': aggregate_fields,
+                              '$unset': {'netAbsForecast': "",
+                                         'delForecast': ""}}
+                else:
+                    na_forecast, del_forecast = forecast_result
+                    # Convert na_forecast and del_forecast into lists from torch tensor
+                    na_forecast = na_forecast.tolist()
+                    del_forecast = del_forecast.tolist()
+                    # Get current quarter
+                    current_quarter = "2024-Q3"
+                    # Get next 7 quarters
+                    next_quarters = [current_quarter]
+                    for _ in range(7):
+                        current_quarter = self.get_next_quarter(current_quarter)
+                        next_quarters.append(current_quarter)
+                    # Convert na_forecast and del_forecast into dictionaries {label: quarter, value: v}
+                    aggregate_fields['netAbsForecast'] = [{'label': qtr, 'value': val} for qtr, val in zip(next_quarters, na_forecast)]
+                    aggregate_fields['delForecast'] = [{'label': qtr, 'value': val} for qtr, val in zip(next_quarters, del_forecast)]
+                    update = {'$set': aggregate_fields}
 
-                for idx, row in hist_prop_df.iterrows():
-                    qtr = row['quarter']
-                    if qtr.replace(" ", "-") not in hist_df['Quarter'].values:
-                        continue
-
-                    # Add values to historical data
-                    prev_qtr = self.get_prev_quarter(qtr.replace(" ", "-"))
-                    # Get status
-                    qtr_status = row['statusHist']
-                    prev_qtr_status = list(hist_prop_df[hist_prop_df['quarter'] == prev_qtr.replace("-", " ")]['statusHist'].values)
-                    # if prop['status'] in ['Demolished', 'Converted']:
-                    if qtr_status in ['Demolished', 'Converted']:
-                        # Check if prev quarter was Existing or Under Renovation. If so, subtract rba from DEL
-                        if "Existing" in prev_qtr_status:
-                            hist_df.loc[hist_df['Quarter'] == qtr.replace(" ", "-"), 'DEL'] -= prop['rba']
-                    elif qtr_status in ['Existing', 'Under Renovation']:
-                        hist_df.loc[hist_df['Quarter'] == qtr.replace(" ", "-"), 'NA'] += hist_prop_df[hist_prop_df['quarter'] == qtr]['netAbsorptionSFTotal'].values[0]
-                        if "Under Construction" in prev_qtr_status:
-                            hist_df.loc[hist_df['Quarter'] == qtr.replace(" ", "-"), 'DEL'] += prop['rba']
-
-            # Create new columns for meanRba, meanCeilingHeight, meanYearBuilt
-            aggregate_df['meanRba'] = aggregate_df['rbaSum'] / aggregate_df['propertyCount']
-            aggregate_df['meanCeilingHeight'] = aggregate_df['ceilingHeightSum'] / aggregate_df['propertyCount']
-            aggregate_df['meanYearBuilt'] = aggregate_df['yearBuiltSum'] / aggregate_df['propertyCount']
-            # Create new column for occupancy rate
-            aggregate_df['occupancyRate'] = aggregate_df['occupancySFSum'] / aggregate_df['rbaSum']
-
-            # Convert dataframe to array of dictionaries {label: quarter, value: v} for propertyCount, rba, meanRba, meanCeilingHeight, meanYearBuilt, occupancyRate, netAbsorption
-            propertyCount = []
-            rba = []
-            meanRba = []
-            meanCeilingHeight = []
-            meanYearBuilt = []
-            occupancyRate = []
-            netAbsorption = []
-            for idx, row in aggregate_df.iterrows():
-                propertyCount.append({'label': row['quarter'], 'value': row['propertyCount']})
-                rba.append({'label': row['quarter'], 'value': row['rbaSum']})
-                meanRba.append({'label': row['quarter'], 'value': row['meanRba']})
-                meanCeilingHeight.append({'label': row['quarter'], 'value': row['meanCeilingHeight']})
-                meanYearBuilt.append({'label': row['quarter'], 'value': row['meanYearBuilt']})
-                occupancyRate.append({'label': row['quarter'], 'value': row['occupancyRate']})
-                netAbsorption.append({'label': row['quarter'], 'value': row['netAbsSum']})
-            
-            # Get forecasts for county
-            forecast_result = self.generate_forecasts(total_rba, hist_df, uc_sf)
-            # print(f"{cty['county']}, {cty['state']}")
-            # print(total_rba)
-            # print(uc_sf)
-            # print(hist_df)
-            # print(na_forecast)
-            # print(del_forecast)
-            
-            
-            # Update the county document with the aggregate fields
-            if not forecast_result or type(forecast_result) == str:
-                self.counties_collection.update_one({'county': cty['county'], 'state': cty['state']},
-                                        {'$set': {'propertyCount': propertyCount,
-                                                'rba': rba,
-                                                'meanRba': meanRba,
-                                                'meanCeilingHeight': meanCeilingHeight,
-                                                'meanYearBuilt': meanYearBuilt,
-                                                'occupancyRate': occupancyRate,
-                                                'netAbsorption': netAbsorption},
-                                        '$unset': {'netAbsForecast': "", 
-                                                   'delForecast': ""}})
-            else:
-                na_forecast, del_forecast = forecast_result
-                # Convert na_forecast and del_forecast into lists from torch tensor
-                na_forecast = na_forecast.tolist()
-                del_forecast = del_forecast.tolist()
-                # Get current quarter
-                current_quarter = "2024-Q3"
-                # Get next 7 quarters
-                next_quarters = [current_quarter]
-                for _ in range(7):
-                    current_quarter = self.get_next_quarter(current_quarter)
-                    next_quarters.append(current_quarter)
-                # Convert na_forecast and del_forecast into dictionaries {label: quarter, value: v}
-                na_forecast = [{'label': qtr, 'value': val} for qtr, val in zip(next_quarters, na_forecast)]
-                del_forecast = [{'label': qtr, 'value': val} for qtr, val in zip(next_quarters, del_forecast)]
-                self.counties_collection.update_one({'county': cty['county'], 'state': cty['state']},
-                                        {'$set': {'propertyCount': propertyCount,
-                                                'rba': rba,
-                                                'meanRba': meanRba,
-                                                'meanCeilingHeight': meanCeilingHeight,
-                                                'meanYearBuilt': meanYearBuilt,
-                                                'occupancyRate': occupancyRate,
-                                                'netAbsorption': netAbsorption,
-                                                'netAbsForecast': na_forecast,
-                                                'delForecast': del_forecast}})
+                region_updates.append(UpdateOne(region_filter, update, upsert=upsert))
 
+            if region_updates:
+                collection.bulk_write(region_updates, ordered=False)
 
+        if report_models:
+            print(model_registry.report())
 
 
 
-    def aggregate_zip_data(self):
-        # Generate quarter list
-        quarterNames = self.get_quarter_names()
-        # Get list of unique zips via aggregation pipeline
-        unique_zips_pipeline = [
-                                    {"$group": {"_id": None, "uniqueZips": {"$addToSet": "$zip"}}},
-                                    {"$project": {"_id": 0, "uniqueZips": 1,}},
-        ]
-        unique_zips = list(self.zip_codes_collection.aggregate(unique_zips_pipeline))
-        unique_zips = unique_zips[0]['uniqueZips']
-
-        # For each county
-        for zip_code in unique_zips:
-            properties_in_zip = self.new_properties_collection.find({"zip": zip_code},
-                                                        {'_id': 0, 
-                                                         'address': 1, 
-                                                         'quarter': 1, 
-                                                         'statusHist': 1, 
-                                                         'occupancySF': 1, 
-                                                         'netAbsorptionSFTotal': 1, 
-                                                         'status': 1,
-                                                         'rba': 1, 
-                                                         'ceilingHeight': 1, 
-                                                         'yearBuilt': 1, 
-                                                         'propertyType': 1})
-            region_df = pd.DataFrame(properties_in_zip)
-
-            # If no properties in zip, skip to next zip
-            if region_df.empty:
-                continue
+    def aggregate_county_data(self):
+        self.aggregate_geographies(['county'])
 
-            # Initialize each aggregate field in a dataframe
-            aggregate_df = pd.DataFrame({'quarter': quarterNames})
-            aggregate_df['propertyCount'] = 0
-            aggregate_df['rbaSum'] = 0
-            aggregate_df['ceilingHeightSum'] = 0
-            aggregate_df['yearBuiltSum'] = 0
-            aggregate_df['occupancySFSum'] = 0
-            aggregate_df['netAbsSum'] = 0
-
-            # Initialize dataframe for forecasting input
-            hist_df = pd.DataFrame(columns=['Quarter', 'NA', 'DEL'])
-            # Initialize under construction list for forecasting input
-            uc_sf = [0]*6
-            # Initialize total existing rba
-            total_rba = 0
-
-            # Get most recent quarter in data
-            sample_quarters = region_df.loc[0]['quarter']
-            sample_quarters = [q for q in sample_quarters if "QTD" in q]
-            if len(sample_quarters) == 0: 
-                continue
-            else:
-                most_recent_quarter = sample_quarters[0]
-            most_recent_quarter = most_recent_quarter.replace(" QTD", "")
-            most_recent_year, most_recent_quarter_number = most_recent_quarter.split(" Q")
-
-            # Get historical data quarters
-            hist_qtr = f"{most_recent_year}-Q{most_recent_quarter_number}"
-            historical_quarters = []
-            for _ in range(24):
-                hist_qtr = self.get_prev_quarter(hist_qtr)
-                historical_quarters.append(hist_qtr)
-            
-            hist_df['Quarter'] = historical_quarters
-            hist_df['NA'] = 0
-            hist_df['DEL'] = 0
-
-
-            # For each property
-            for idx, prop in region_df.iterrows():
-                # Create new df for quarter, statusHist, occupancySF, netAbsorptionSFTotal
-                prop_df = pd.DataFrame({'quarter': prop['quarter'],
-                                        'statusHist': prop['statusHist'],
-                                        'occupancySF': prop['occupancySF'],
-                                        'netAbsorptionSFTotal': prop['netAbsorptionSFTotal']})
-
-                # Remove row where quarter that includes QTD
-                prop_df = prop_df[prop_df['quarter'].str[-3:] != 'QTD']
-                # Remove rows where quarter is before 2011 Q1
-                prop_df = prop_df[prop_df['quarter'].str[:4] > "2010"]
-
-                # Create separate df for hist data
-                hist_prop_df = copy.deepcopy(prop_df)
-                hist_prop_df['netAbsorptionSFTotal'] = hist_prop_df['netAbsorptionSFTotal'].fillna(0)
-
-                # Remove rows where statusHist is not "Existing"
-                prop_df = prop_df[prop_df['statusHist'] == "Existing"]
-                # Replace nan values in netAbsorptionSFTotal with 0
-                prop_df['netAbsorptionSFTotal'] = prop_df['netAbsorptionSFTotal'].fillna(0)
-            
-                # For each quarter left in prop_df
-                for idx, row in prop_df.iterrows():
-                    qtr = row['quarter']
-                    # Add values to aggregate fields
-                    aggregate_df.loc[aggregate_df['quarter'] == qtr, 'propertyCount'] += 1
-                    aggregate_df.loc[aggregate_df['quarter'] == qtr, 'rbaSum'] += prop['rba']
-                    aggregate_df.loc[aggregate_df['quarter'] == qtr, 'ceilingHeightSum'] += prop['ceilingHeight']
-                    aggregate_df.loc[aggregate_df['quarter'] == qtr, 'yearBuiltSum'] += prop['yearBuilt']
-                    aggregate_df.loc[aggregate_df['quarter'] == qtr, 'occupancySFSum'] += row['occupancySF']
-                    aggregate_df.loc[aggregate_df['quarter'] == qtr, 'netAbsSum'] += row['netAbsorptionSFTotal']
-
-
-                if prop['status'] == "Existing":
-                    total_rba += prop['rba']
-
-                # Check if property is under construction
-                current_status = hist_prop_df['statusHist']
-                if current_status.empty:
-                    continue
-                else:
-                    current_status = current_status.iloc[0]
-                if current_status == "Under Construction":
-                    num_uc_quarters = list(prop['statusHist'])[1:].count("Under Construction")
-                    if num_uc_quarters == 1:
-                        uc_sf[0] += prop['rba']
-                    elif num_uc_quarters == 2:
-                        uc_sf[1] += prop['rba']
-                    elif num_uc_quarters == 3:
-                        uc_sf[2] += prop['rba']
-                    elif num_uc_quarters == 4:
-                        uc_sf[3] += prop['rba']
-                    elif num_uc_quarters == 5:
-                        uc_sf[4] += prop['rba']
-                    elif num_uc_quarters == 6:
-                        uc_sf[5] += prop['rba']
-                    continue
 
-                for idx, row in hist_prop_df.iterrows():
-                    qtr = row['quarter']
-                    if qtr.replace(" ", "-") not in hist_df['Quarter'].values:
-                        continue
-
-                    # Add values to historical data
-                    prev_qtr = self.get_prev_quarter(qtr.replace(" ", "-"))
-                    # Get status
-                    qtr_status = row['statusHist']
-                    prev_qtr_status = list(hist_prop_df[hist_prop_df['quarter'] == prev_qtr.replace("-", " ")]['statusHist'].values)
-                    # if prop['status'] in ['Demolished', 'Converted']:
-                    if qtr_status in ['Demolished', 'Converted']:
-                        # Check if prev quarter was Existing or Under Renovation. If so, subtract rba from DEL
-                        if "Existing" in prev_qtr_status:
-                            hist_df.loc[hist_df['Quarter'] == qtr.replace(" ", "-"), 'DEL'] -= prop['rba']
-                    elif qtr_status in ['Existing', 'Under Renovation']:
-                        hist_df.loc[hist_df['Quarter'] == qtr.replace(" ", "-"), 'NA'] += hist_prop_df[hist_prop_df['quarter'] == qtr]['netAbsorptionSFTotal'].values[0]
-                        if "Under Construction" in prev_qtr_status:
-                            hist_df.loc[hist_df['Quarter'] == qtr.replace(" ", "-"), 'DEL'] += prop['rba']
-
-
-            # Create new columns for meanRba, meanCeilingHeight, meanYearBuilt
-            aggregate_df['meanRba'] = aggregate_df['rbaSum'] / aggregate_df['propertyCount']
-            aggregate_df['meanCeilingHeight'] = aggregate_df['ceilingHeightSum'] / aggregate_df['propertyCount']
-            aggregate_df['meanYearBuilt'] = aggregate_df['yearBuiltSum'] / aggregate_df['propertyCount']
-            # Create new column for occupancy rate
-            aggregate_df['occupancyRate'] = aggregate_df['occupancySFSum'] / aggregate_df['rbaSum']
-
-            # Convert dataframe to array of dictionaries {label: quarter, value: v} for propertyCount, rba, meanRba, meanCeilingHeight, meanYearBuilt, occupancyRate, netAbsorption
-            propertyCount = []
-            rba = []
-            meanRba = []
-            meanCeilingHeight = []
-            meanYearBuilt = []
-            occupancyRate = []
-            netAbsorption = []
-            for idx, row in aggregate_df.iterrows():
-                propertyCount.append({'label': row['quarter'], 'value': row['propertyCount']})
-                rba.append({'label': row['quarter'], 'value': row['rbaSum']})
-                meanRba.append({'label': row['quarter'], 'value': row['meanRba']})
-                meanCeilingHeight.append({'label': row['quarter'], 'value': row['meanCeilingHeight']})
-                meanYearBuilt.append({'label': row['quarter'], 'value': row['meanYearBuilt']})
-                occupancyRate.append({'label': row['quarter'], 'value': row['occupancyRate']})
-                netAbsorption.append({'label': row['quarter'], 'value': row['netAbsSum']})
-            
-            # Get forecasts for county
-            forecast_result = self.generate_forecasts(total_rba, hist_df, uc_sf)
-
-
-            # Update the county document with the aggregate fields
-            if not forecast_result or type(forecast_result) == str:
-                self.zip_codes_collection.update_one({'zip': zip_code},
-                                        {
-                                            '$set': {
-                                                'propertyCount': propertyCount,
-                                                'rba': rba,
-                                                'meanRba': meanRba,
-                                                'meanCeilingHeight': meanCeilingHeight,
-                                                'meanYearBuilt': meanYearBuilt,
-                                                'occupancyRate': occupancyRate,
-                                                'netAbsorption': netAbsorption},
-                                            '$unset': {
-                                                'netAbsForecast': "",
-                                                'delForecast': ""
-                                                }
-                                        })
-            else:
-                na_forecast, del_forecast = forecast_result
-                # Convert na_forecast and del_forecast into lists from torch tensor
-                na_forecast = na_forecast.tolist()
-                del_forecast = del_forecast.tolist()                
-                # Get current quarter
-                current_quarter = "2024-Q3"
-                # Get next 7 quarters
-                next_quarters = [current_quarter]
-                for _ in range(7):
-                    current_quarter = self.get_next_quarter(current_quarter)
-                    next_quarters.append(current_quarter)
-                # Convert na_forecast and del_forecast into dictionaries {label: quarter, value: v}
-                na_forecast = [{'label': qtr, 'value': val} for qtr, val in zip(next_quarters, na_forecast)]
-                del_forecast = [{'label': qtr, 'value': val} for qtr, val in zip(next_quarters, del_forecast)]
-                self.zip_codes_collection.update_one({'zip': zip_code},
-                                        {
-                                            '$set': {
-                                                'propertyCount': propertyCount,
-                                                'rba': rba,
-                                                'meanRba': meanRba,
-                                                'meanCeilingHeight': meanCeilingHeight,
-                                                'meanYearBuilt': meanYearBuilt,
-                                                'occupancyRate': occupancyRate,
-                                                'netAbsorption': netAbsorption,
-                                                'netAbsForecast': na_forecast,
-                                                'delForecast': del_forecast}
-                                        })
+
+    def aggregate_zip_data(self):
+        self.aggregate_geographies(['zip'])
 
 
 
@@ -1010,16 +827,36 @@ class CostarCleaner:
 
 
 
-    def generate_forecasts(self, total_rba, hist_df, uc_sf):
+    # Forecasts for many regions at once. Regions are grouped by rba bucket and each bucket is forecast with a
+    # single forward pass. Returns a list aligned with forecast_inputs of (na_forecast, del_forecast) or None.
+    def generate_batch_forecasts(self, forecast_inputs):
         forecast_class = GetForecast
-        na_forecast_model, del_forecast_model = forecast_class.match_model(total_rba)
-        if na_forecast_model == None:
-            return None
-        na_smoothed_data, del_smoothed_data = forecast_class.data_preprocessing(total_rba, hist_df, uc_sf)
-        na_forecast, del_forecast = forecast_class.forecast(na_smoothed_data, del_smoothed_data, na_forecast_model, del_forecast_model)
-        na_forecast = na_forecast*total_rba/1000
-        del_forecast = del_forecast*total_rba/1000
-        return na_forecast, del_forecast
+        forecast_results = [None]*len(forecast_inputs)
+
+        # Group region indices by the model bucket their total rba falls in
+        bucket_regions = {}
+        for idx, (total_rba, hist_df, uc_sf) in enumerate(forecast_inputs):
+            bucket = forecast_class.match_bucket(total_rba)
+            if bucket is None:
+                continue
+            bucket_regions.setdefault(bucket, []).append(idx)
+
+        for bucket, region_idxs in bucket_regions.items():
+            na_forecast_model, del_forecast_model = forecast_class.load_bucket(bucket)
+            na_model_inputs = []
+            del_model_inputs = []
+            for idx in region_idxs:
+                total_rba, hist_df, uc_sf = forecast_inputs[idx]
+                na_smoothed_data, del_smoothed_data = forecast_class.data_preprocessing(total_rba, hist_df, uc_sf)
+                na_model_inputs.append(na_smoothed_data)
+                del_model_inputs.append(del_smoothed_data)
+
+            na_forecasts, del_forecasts = forecast_class.forecast_batch(na_model_inputs, del_model_inputs, na_forecast_model, del_forecast_model)
+            for row, idx in enumerate(region_idxs):
+                total_rba = forecast_inputs[idx][0]
+                forecast_results[idx] = (na_forecasts[row]*total_rba/1000, del_forecasts[row]*total_rba/1000)
+
+        return forecast_results
 
 
 
@@ -1127,6 +964,30 @@ class CostarCleaner:
 
 
 
-# TEST RUN
-# if __name__ == '__main__':
-#     cleaner = CostarCleaner()
\ No newline at end of file
+############################################################
+# Process pool workers for clean_and_set_data(workers=N). Each worker process builds its own CostarCleaner
+# (and MongoClient) once, then cleans and inserts whole markets.
+worker_cleaner = None
+
+def init_clean_worker():
+    global worker_cleaner
+    worker_cleaner = CostarCleaner()
+
+
+def clean_market_worker(mkt, chunk_size, max_retries):
+    return worker_cleaner.clean_and_set_market(mkt, chunk_size, max_retries)
+
+
+
+
+############################################################
+# Clean raw data into new_properties: python costar/src/costar_cleaner.py --workers 16
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes to clean markets with')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='Documents per insert_many chunk')
+    args = parser.parse_args()
+
+    cleaner = CostarCleaner()
+    cleaner.clean_and_set_data(chunk_size=args.chunk_size, workers=args.workers)
+    cleaner.client.close()
@@ -163,7 +163,7 @@ def initialize_scraping_status_and_prop_log():
     if not os.path.exists('costar/logs/prop_log') or not os.listdir('costar/logs/prop_log'):
         os.makedirs('costar/logs/prop_log', exist_ok=True)
         # os.makedirs('costar/logs/screenshots', exist_ok=True)
-        prop_log_template = pd.DataFrame(columns=['Address', 'Building', 'ID', 'Complete'])
+        prop_log_template = pd.DataFrame(columns=['Address', 'Building', 'ID', 'Complete', 'ImageDone'])
         for S in SAVED_SEARCHES:
             prop_log_template.to_csv(f'costar/logs/prop_log/{S}.csv', index=False, sep=',')
             os.makedirs(f'costar/data/{S}', exist_ok=True)
@@ -249,10 +249,8 @@ if __name__ == '__main__':
 
     #     cleaner.set_market_centers()
 
-    #     # Set aggregate region data
-    #     cleaner.aggregate_county_data()
-
-    #     cleaner.aggregate_zip_data()
+    #     # Set aggregate region data (county, zip, market and submarket in one pass)
+    #     cleaner.aggregate_geographies()
 
     #     cleaner.get_and_set_fips_codes()
 
@@ -4,11 +4,14 @@ import pandas as pd
 import numpy as np
 import time, certifi, os, shutil
 from dotenv import load_dotenv
+from xlsx_reader import read_xlsx, DEFAULT_XLSX_READER
 
 
 class DataHandler:
-    def __init__(self):
+    # xlsx_reader picks the backend for reading exports (see xlsx_reader.XLSX_READERS)
+    def __init__(self, xlsx_reader=DEFAULT_XLSX_READER):
         load_dotenv()
+        self.xlsx_reader = xlsx_reader
         # ESTABLISH CONNECTION TO MONGODB
         try:
             connect_str = os.environ['PARTNERSDB_URI']
@@ -42,7 +45,7 @@ class DataHandler:
         data_dict_list = []
         props_added = set()
 
-        present_data = pd.read_excel(f'costar/data/{saved_search}/{saved_search}.xlsx', engine='openpyxl')
+        present_data = read_xlsx(f'costar/data/{saved_search}/{saved_search}.xlsx', self.xlsx_reader)
         # Update all NaN values to '' in 'Property Name' column
         present_data['Property Name'].fillna('', inplace=True)
         # Ensure that all 'PropertyID' values are integer strings
@@ -79,7 +82,7 @@ class DataHandler:
 
             # MOST PROBLEMS THAT ARISE IN THIS CLASS ARE DUE TO READING EXCEL FILES. 
             try:
-                prop_hist_data = pd.read_excel(f'costar/data/{saved_search}/{prop_id}.xlsx', engine='openpyxl')
+                prop_hist_data = read_xlsx(f'costar/data/{saved_search}/{prop_id}.xlsx', self.xlsx_reader)
             except Exception as e:
                 self.download_log(f'ERROR READING HISTORICAL DATA FOR {address}, {building}')
                 self.download_log(f'ERROR: \n{e}')
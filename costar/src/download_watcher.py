@@ -0,0 +1,75 @@
+import os, time, select, ctypes, ctypes.util
+
+
+############################################################
+# Waits for browser downloads to land in a directory. On Linux the directory is watched with inotify, so a wait
+# returns as soon as the file is written; elsewhere (or if inotify is unavailable) the directory is polled every
+# poll_interval seconds. Firefox creates the target file early and writes into "<name>.part", so a download only
+# counts as complete once the target exists, is not empty and its .part file is gone.
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+class DownloadWatcher:
+    def __init__(self, directory, poll_interval=0.25):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.inotify_fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            inotify_fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if inotify_fd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+            if libc.inotify_add_watch(inotify_fd, os.fsencode(os.path.abspath(directory)), WATCH_MASK) < 0:
+                os.close(inotify_fd)
+                raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+            self.inotify_fd = inotify_fd
+        except (OSError, AttributeError):
+            # No inotify (e.g. macOS): fall back to polling
+            self.inotify_fd = None
+
+
+    def is_complete(self, filename):
+        path = os.path.join(self.directory, filename)
+        try:
+            return os.path.getsize(path) > 0 and not os.path.exists(path + '.part')
+        except OSError:
+            return False
+
+
+    # Wait until one of filenames is completely downloaded. Returns its path, or None after timeout seconds.
+    def wait_for(self, filenames, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            for filename in filenames:
+                if self.is_complete(filename):
+                    return os.path.join(self.directory, filename)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            if self.inotify_fd is not None:
+                # Any event in the directory triggers a re-check; the timeout caps each wait as a safety net
+                readable, _, _ = select.select([self.inotify_fd], [], [], min(remaining, 1.0))
+                if readable:
+                    self.drain_events()
+            else:
+                time.sleep(min(remaining, self.poll_interval))
+
+
+    def drain_events(self):
+        try:
+            while os.read(self.inotify_fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+
+
+    def close(self):
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
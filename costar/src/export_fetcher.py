@@ -0,0 +1,108 @@
+import os, time
+from multiprocessing.pool import ThreadPool
+import requests
+from requests.adapters import HTTPAdapter
+
+
+############################################################
+# Fetches historical data exports over HTTP with the cookies of a logged-in browser session, so the browser is only
+# needed for login and 2FA. The export URL is a template with a {costarID} field and has no default: set
+# COSTAR_HISTORY_EXPORT_URL to the request the "Export" button on the analytics history tab sends (copied from the
+# browser's network tab), or to a local fake export server for testing.
+HISTORY_EXPORT_URL = os.environ.get('COSTAR_HISTORY_EXPORT_URL')
+
+# Fetch results
+FETCH_OK = 'ok'
+FETCH_NO_DATA = 'no_data'
+FETCH_AUTH = 'auth'
+FETCH_FAILED = 'failed'
+
+# xlsx files are zip archives
+XLSX_MAGIC = b'PK\x03\x04'
+
+
+class HistoricalExportFetcher:
+    def __init__(self, cookies=(), user_agent=None, export_url=HISTORY_EXPORT_URL, workers=8, timeout=60, max_retries=2):
+        if not export_url:
+            raise ValueError('No export URL: set COSTAR_HISTORY_EXPORT_URL to use the HTTP fetch mode')
+        self.export_url = export_url
+        self.workers = workers
+        self.timeout = timeout
+        self.max_retries = max_retries
+        # One pooled session shared by all fetch threads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        if user_agent:
+            self.session.headers['User-Agent'] = user_agent
+        self.set_cookies(cookies)
+
+
+    # Build a fetcher from a Selenium driver that has already logged in
+    @classmethod
+    def from_driver(cls, driver, **kwargs):
+        return cls(driver.get_cookies(), driver.execute_script("return navigator.userAgent;"), **kwargs)
+
+
+    # cookies: list of dicts as returned by driver.get_cookies()
+    def set_cookies(self, cookies):
+        self.session.cookies.clear()
+        for cookie in cookies:
+            self.session.cookies.set(cookie['name'], cookie['value'], domain=cookie.get('domain', ''), path=cookie.get('path', '/'))
+
+
+    # Download the export for one property to dest_path. Returns one of FETCH_OK, FETCH_NO_DATA, FETCH_AUTH, FETCH_FAILED.
+    def fetch(self, costarID, dest_path):
+        url = self.export_url.format(costarID=costarID)
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.session.get(url, timeout=self.timeout, stream=True, allow_redirects=False) as response:
+                    # A redirect or login page means the browser session has expired
+                    if response.status_code in (401, 403) or response.is_redirect:
+                        return FETCH_AUTH
+                    # 204 means the property has no data. A 404 is more likely a wrong export URL, so it is a
+                    # failure and the property falls back to the browser.
+                    if response.status_code == 204:
+                        return FETCH_NO_DATA
+                    if response.status_code == 429 or response.status_code >= 500:
+                        time.sleep(2 ** attempt)
+                        continue
+                    if response.status_code != 200:
+                        return FETCH_FAILED
+
+                    chunks = response.iter_content(chunk_size=65536)
+                    first_chunk = next(chunks, b'')
+                    if not first_chunk.startswith(XLSX_MAGIC):
+                        return FETCH_AUTH if b'<html' in first_chunk[:1024].lower() else FETCH_FAILED
+                    # Write to a .part file and swap it in, so a partial export is never taken as complete
+                    with open(dest_path + '.part', 'wb') as f:
+                        f.write(first_chunk)
+                        for chunk in chunks:
+                            f.write(chunk)
+                    os.replace(dest_path + '.part', dest_path)
+                    return FETCH_OK
+            except requests.RequestException:
+                if os.path.exists(dest_path + '.part'):
+                    os.remove(dest_path + '.part')
+                time.sleep(2 ** attempt)
+        return FETCH_FAILED
+
+
+    # Download the exports for many properties at once into dest_dir/<costarID>.xlsx.
+    # Returns {costarID: result}; on_result(costarID, result) is called as each fetch finishes.
+    def fetch_many(self, costarIDs, dest_dir, on_result=None):
+        def fetch_one(costarID):
+            return costarID, self.fetch(costarID, f'{dest_dir}/{costarID}.xlsx')
+
+        results = {}
+        with ThreadPool(self.workers) as pool:
+            for costarID, result in pool.imap_unordered(fetch_one, costarIDs):
+                results[costarID] = result
+                if on_result is not None:
+                    on_result(costarID, result)
+        return results
+
+
+    def close(self):
+        self.session.close()
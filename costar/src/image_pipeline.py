@@ -0,0 +1,218 @@
+import io, math, time, threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from PIL import Image
+import boto3
+from boto3.s3.transfer import TransferConfig
+from dotenv import load_dotenv
+
+
+############################################################
+# Standardized images are 16:9, at most 1920x1080. Each image is stored as <costarID>.jpg (the key existence checks
+# use) plus variants under variants/<costarID>/: WebP (and AVIF where Pillow supports it) at full size, and JPEG and
+# WebP thumbnails.
+IMAGE_SIZE = (1920, 1080)
+THUMBNAIL_WIDTHS = (960, 480)
+JPEG_QUALITY = 85
+WEBP_QUALITY = 80
+AVIF_QUALITY = 60
+CACHE_CONTROL = 'public, max-age=604800'
+CONTENT_TYPES = {'jpg': 'image/jpeg', 'webp': 'image/webp', 'avif': 'image/avif'}
+# upload_fileobj switches to a multipart upload above 8 MB
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024)
+
+
+############################################################
+# In-memory index of the keys in an S3 bucket, built with paginated list_objects_v2 (one request per 1000 keys) so
+# existence checks don't need a HEAD request each. Uploads are added as they happen; the whole index is re-listed
+# when it is older than refresh_interval seconds, to pick up images uploaded by other workers.
+class S3KeyIndex:
+    def __init__(self, s3_client, bucket_name, refresh_interval=900):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.refresh_interval = refresh_interval
+        self.keys = set()
+        self.refreshed_at = None
+        self.lock = threading.Lock()
+
+
+    def refresh(self):
+        keys = set()
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        # Delimiter='/' keeps the variants/ keys out of the listing
+        for page in paginator.paginate(Bucket=self.bucket_name, Delimiter='/'):
+            keys.update(obj['Key'] for obj in page.get('Contents', []))
+        with self.lock:
+            # Keep keys added by uploads while the listing ran
+            self.keys |= keys
+            self.refreshed_at = time.monotonic()
+
+
+    def is_stale(self):
+        return self.refreshed_at is None or time.monotonic() - self.refreshed_at > self.refresh_interval
+
+
+    def contains(self, key):
+        if self.is_stale():
+            self.refresh()
+        return key in self.keys
+
+
+    def add(self, key):
+        with self.lock:
+            self.keys.add(key)
+
+
+############################################################
+# Background stage for property images. The browser only downloads the image; checking S3 for an existing image,
+# standardizing it and uploading it run on a thread pool, so image work never holds up historical data collection.
+# One boto3 client is shared by all threads (clients are thread safe, resources are not).
+# Existence checks go to an S3KeyIndex of the bucket; keys it doesn't have (and every key, if the bucket can't be
+# listed) are confirmed with a HEAD request.
+class ImagePipeline:
+    def __init__(self, download_log, bucket_name='costar-images', workers=4, jpeg_quality=JPEG_QUALITY, webp_quality=WEBP_QUALITY,
+                 avif_quality=AVIF_QUALITY, thumbnail_widths=THUMBNAIL_WIDTHS):
+        load_dotenv()
+        self.download_log = download_log
+        self.bucket_name = bucket_name
+        self.jpeg_quality = jpeg_quality
+        self.webp_quality = webp_quality
+        self.avif_quality = avif_quality
+        self.thumbnail_widths = thumbnail_widths
+        # AVIF needs Pillow 11.2+ (or pillow-avif-plugin) and is the slowest encode (~1 s per image); avif_quality=None skips it
+        Image.init()
+        self.avif_supported = avif_quality is not None and 'AVIF' in Image.SAVE
+        self.s3_client = boto3.client('s3')
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.s3_key_index = S3KeyIndex(self.s3_client, self.bucket_name)
+        self.pending = []
+        self.lock = threading.Lock()
+        self.num_uploaded = 0
+        self.num_failed = 0
+
+
+    ########################################
+    def head_saved_image(self, costarID):
+        try:
+            self.s3_client.head_object(Bucket=self.bucket_name, Key=f'{costarID}.jpg')
+        except Exception as e:
+            return False
+        return True
+
+
+    def check_for_saved_image(self, costarID):
+        if self.s3_key_index is not None:
+            try:
+                if self.s3_key_index.contains(f'{costarID}.jpg'):
+                    return True
+            except Exception as e:
+                self.download_log(f"!!! S3 Image Index Unavailable, checking images one at a time \n{e}")
+                self.s3_key_index = None
+        # A key missing from the index may have been uploaded by another worker since it was listed
+        if self.head_saved_image(costarID):
+            if self.s3_key_index is not None:
+                self.s3_key_index.add(f'{costarID}.jpg')
+            return True
+        return False
+
+
+    ########################################
+    # Queue a downloaded image (costar/images/<costarID>.jpg or .png) to be standardized and uploaded.
+    # on_done(costarID) is called from the pipeline's thread once the upload succeeds.
+    def submit(self, costarID, image_path, on_done=None):
+        future = self.executor.submit(self.process_image, costarID, image_path, on_done)
+        with self.lock:
+            self.pending = [f for f in self.pending if not f.done()]
+            self.pending.append(future)
+
+
+    def process_image(self, costarID, image_path, on_done=None):
+        try:
+            with open(image_path, 'rb') as f:
+                image_bytes = f.read()
+            img = self.standardize_image(image_bytes)
+            self.download_log(f"### Image Standardized ({costarID})")
+            self.post_image_to_s3(costarID, self.encode_image_variants(costarID, img))
+            with self.lock:
+                self.num_uploaded += 1
+            if on_done is not None:
+                on_done(costarID)
+        except Exception as e:
+            with self.lock:
+                self.num_failed += 1
+            self.download_log(f"!!! Image Processing Exception ({costarID}) \n{e}")
+
+
+    # Crop to 16:9 and downscale to at most IMAGE_SIZE. Returns an RGB image.
+    def standardize_image(self, image_bytes):
+        img = Image.open(io.BytesIO(image_bytes))
+        # Get image size
+        width, height = img.size
+        # Size of the 16:9 crop
+        crop_width, crop_height = min(width, height * (16 / 9)), min(height, width * (9 / 16))
+        # For JPEGs, decode at the smallest power-of-two reduction that still covers IMAGE_SIZE after cropping
+        scale = min(1, IMAGE_SIZE[0] / crop_width, IMAGE_SIZE[1] / crop_height)
+        if scale < 1:
+            img.draft('RGB', (math.ceil(width * scale), math.ceil(height * scale)))
+        if img.size != (width, height):
+            crop_width, crop_height = crop_width * img.size[0] / width, crop_height * img.size[1] / height
+            width, height = img.size
+
+        # Crop to 16:9 aspect ratio (top and bottom, or sides)
+        left, top = (width - crop_width) / 2, (height - crop_height) / 2
+        if left > 0 or top > 0:
+            img = img.crop((left, top, width - left, height - top))
+
+        # Downscale image to 1920x1080
+        img.thumbnail(IMAGE_SIZE)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        return img
+
+
+    # Encode the standardized image and its variants. Returns a list of (key, bytes, content type).
+    def encode_image_variants(self, costarID, img):
+        def encode(variant_img, image_format):
+            buffer = io.BytesIO()
+            if image_format == 'jpg':
+                variant_img.save(buffer, 'JPEG', quality=self.jpeg_quality, optimize=True, progressive=True)
+            elif image_format == 'webp':
+                variant_img.save(buffer, 'WEBP', quality=self.webp_quality, method=4)
+            else:
+                variant_img.save(buffer, 'AVIF', quality=self.avif_quality)
+            return buffer.getvalue()
+
+        variants = [(f'variants/{costarID}/full.webp', encode(img, 'webp'), CONTENT_TYPES['webp'])]
+        if self.avif_supported:
+            variants.append((f'variants/{costarID}/full.avif', encode(img, 'avif'), CONTENT_TYPES['avif']))
+        for thumbnail_width in self.thumbnail_widths:
+            thumbnail = img.copy()
+            thumbnail.thumbnail((thumbnail_width, thumbnail_width))
+            for image_format in ('jpg', 'webp'):
+                variants.append((f'variants/{costarID}/{thumbnail_width}.{image_format}', encode(thumbnail, image_format), CONTENT_TYPES[image_format]))
+        # The main jpg goes last, so an image only shows up as saved once all of its variants are
+        variants.append((f'{costarID}.jpg', encode(img, 'jpg'), CONTENT_TYPES['jpg']))
+        return variants
+
+
+    def post_image_to_s3(self, costarID, variants):
+        for key, body, content_type in variants:
+            self.s3_client.upload_fileobj(io.BytesIO(body), self.bucket_name, key, Config=TRANSFER_CONFIG,
+                                          ExtraArgs={'ContentType': content_type, 'CacheControl': CACHE_CONTROL})
+        if self.s3_key_index is not None:
+            self.s3_key_index.add(f'{costarID}.jpg')
+        self.download_log(f"### Image Uploaded to S3 ({costarID}, {sum(len(body) for _, body, _ in variants)} bytes in {len(variants)} files)")
+
+
+    ########################################
+    # Wait for all queued images to finish
+    def join(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+        wait(pending)
+        self.download_log(f"### Images: {self.num_uploaded} uploaded, {self.num_failed} failed")
+
+
+    def close(self):
+        self.join()
+        self.executor.shutdown(wait=True)
@@ -1,87 +1,226 @@
 import numpy as np
-import os
+import os, time
 from scipy.ndimage import gaussian_filter1d
-import torch
-import torch.nn as nn
-import torch.nn.functional as F
+from scipy.special import expit
 
+# Forecasts run on torch by default. Set FORECAST_RUNTIME=numpy to run the exported .npz weights with the NumPy
+# runtime below instead, without importing torch at all (see export_numpy_weights).
+FORECAST_RUNTIME = os.environ.get("FORECAST_RUNTIME", "torch")
+if FORECAST_RUNTIME == "torch":
+    try:
+        import torch
+        import torch.nn as nn
+        import torch.nn.functional as F
+    except ImportError:
+        FORECAST_RUNTIME = "numpy"
 
-############################################################
-class LSTM_NA_Forecast_Model(nn.Module):
-    def __init__(self):
-        super(LSTM_NA_Forecast_Model, self).__init__()
 
-        self.lstm_layer = nn.LSTM(input_size=2, hidden_size=256, num_layers=1, batch_first=True)
+if FORECAST_RUNTIME == "torch":
+    ############################################################
+    class LSTM_NA_Forecast_Model(nn.Module):
+        def __init__(self):
+            super(LSTM_NA_Forecast_Model, self).__init__()
 
-        self.dense_input = nn.Linear(256, 512)
-        self.dense_layers = nn.ModuleList([nn.Linear(512, 256), nn.Linear(256, 128)])
-        self.dense_output = nn.Linear(128, 8)
-    
-    def forward(self, input_data):
-        # Get output of LSTM layer
-        lstm_output, _ = self.lstm_layer(input_data)
-
-        # Concatenate LSTM output with covariate data
-        x = lstm_output[-1, :]
-        x = self.dense_input(x)
-        x = F.relu(x)
-        for layer in self.dense_layers:
-            x = layer(x)
+            self.lstm_layer = nn.LSTM(input_size=2, hidden_size=256, num_layers=1, batch_first=True)
+
+            self.dense_input = nn.Linear(256, 512)
+            self.dense_layers = nn.ModuleList([nn.Linear(512, 256), nn.Linear(256, 128)])
+            self.dense_output = nn.Linear(128, 8)
+
+        def forward(self, input_data):
+            # Get output of LSTM layer
+            lstm_output, _ = self.lstm_layer(input_data)
+
+            # Take the last timestep (input_data is (seq, 2) or batched as (batch, seq, 2))
+            x = lstm_output[..., -1, :]
+            x = self.dense_input(x)
             x = F.relu(x)
-        x = self.dense_output(x)
+            for layer in self.dense_layers:
+                x = layer(x)
+                x = F.relu(x)
+            x = self.dense_output(x)
+
+            return x
+
+
+
 
-        return x
+    ############################################################
+    class LSTM_DEL_Forecast_Model(nn.Module):
+        def __init__(self):
+            super(LSTM_DEL_Forecast_Model, self).__init__()
+
+            self.lstm_layer = nn.LSTM(input_size=2, hidden_size=256, num_layers=1, batch_first=True)
+
+            self.dense_input = nn.Linear(262, 512)
+            self.dense_layers = nn.ModuleList([nn.Linear(512, 256), nn.Linear(256, 128)])
+            self.dense_output = nn.Linear(128, 8)
+
+        def forward(self, input_data):
+            # Unpack input data. ts_data is a list of tensors, cv_data is a tensor
+            ts_data, cv_data = input_data
+
+            # Get output of LSTM layer
+            lstm_output, _ = self.lstm_layer(ts_data)
+
+            # Concatenate LSTM output with covariate data (last timestep, works for single or batched input)
+            x = torch.cat([lstm_output[..., -1, :], cv_data], dim=-1)
+            x = self.dense_input(x)
+            x = F.relu(x)
+            for layer in self.dense_layers:
+                x = layer(x)
+                x = F.relu(x)
+            x = self.dense_output(x)
+
+            return x
 
 
 
 
 ############################################################
-class LSTM_DEL_Forecast_Model(nn.Module):
-    def __init__(self):
-        super(LSTM_DEL_Forecast_Model, self).__init__()
+# NumPy versions of the forecast models above. They run the same 1-layer LSTM and dense stack on weights
+# exported from the torch checkpoints, for both single (seq, 2) and batched (batch, seq, 2) input.
+class NumPy_LSTM_Forecast_Model():
+    def __init__(self, weights):
+        # Torch stores the LSTM gates stacked in (input, forget, cell, output) order
+        self.weight_ih = weights['lstm_layer.weight_ih_l0']
+        self.weight_hh = weights['lstm_layer.weight_hh_l0']
+        self.lstm_bias = weights['lstm_layer.bias_ih_l0'] + weights['lstm_layer.bias_hh_l0']
+        self.hidden_size = self.weight_hh.shape[1]
 
-        self.lstm_layer = nn.LSTM(input_size=2, hidden_size=256, num_layers=1, batch_first=True)
+        dense_names = ['dense_input', 'dense_layers.0', 'dense_layers.1', 'dense_output']
+        self.dense_weights = [(weights[f'{name}.weight'].T, weights[f'{name}.bias']) for name in dense_names]
 
-        self.dense_input = nn.Linear(262, 512)
-        self.dense_layers = nn.ModuleList([nn.Linear(512, 256), nn.Linear(256, 128)])
-        self.dense_output = nn.Linear(128, 8)
-    
-    def forward(self, input_data):
-        # Unpack input data. ts_data is a list of tensors, cv_data is a tensor
+    def lstm_last_hidden(self, ts_data):
+        batched = ts_data.ndim == 3
+        if not batched:
+            ts_data = ts_data[np.newaxis]
+        H = self.hidden_size
+
+        # Input projections for every timestep at once, then step through the recurrence
+        x_proj = ts_data @ self.weight_ih.T + self.lstm_bias
+        h = np.zeros((ts_data.shape[0], H), dtype=np.float32)
+        c = np.zeros((ts_data.shape[0], H), dtype=np.float32)
+        for t in range(ts_data.shape[1]):
+            gates = x_proj[:, t] + h @ self.weight_hh.T
+            i = expit(gates[:, :H])
+            f = expit(gates[:, H:2*H])
+            g = np.tanh(gates[:, 2*H:3*H])
+            o = expit(gates[:, 3*H:])
+            c = f * c + i * g
+            h = o * np.tanh(c)
+
+        return h if batched else h[0]
+
+    def dense_forward(self, x):
+        for weight, bias in self.dense_weights[:-1]:
+            x = np.maximum(x @ weight + bias, 0)
+        weight, bias = self.dense_weights[-1]
+        return x @ weight + bias
+
+
+class NumPy_NA_Forecast_Model(NumPy_LSTM_Forecast_Model):
+    def __call__(self, input_data):
+        return self.dense_forward(self.lstm_last_hidden(input_data))
+
+
+class NumPy_DEL_Forecast_Model(NumPy_LSTM_Forecast_Model):
+    def __call__(self, input_data):
         ts_data, cv_data = input_data
+        x = np.concatenate([self.lstm_last_hidden(ts_data), cv_data], axis=-1)
+        return self.dense_forward(x)
 
-        # Get output of LSTM layer
-        lstm_output, _ = self.lstm_layer(ts_data)
 
-        # Concatenate LSTM output with covariate data
-        x = torch.cat([lstm_output[-1, :], cv_data])
-        x = self.dense_input(x)
-        x = F.relu(x)
-        for layer in self.dense_layers:
-            x = layer(x)
-            x = F.relu(x)
-        x = self.dense_output(x)
+############################################################
+# Process-wide cache of forecast models. Each rba bucket's NA/DEL checkpoints are loaded the first time the
+# bucket is used, built into eval-mode modules and then served from memory for the rest of the run.
+class ForecastModelRegistry():
+    def __init__(self, model_path=None, mmap=False, runtime=None):
+        self.model_path = model_path if model_path else os.getcwd() + "/costar/src/forecast_models/"
+        # Memory-map checkpoint weights instead of reading them into memory up front (torch runtime only)
+        self.mmap = mmap
+        self.runtime = runtime if runtime else FORECAST_RUNTIME
+        self.models = {}
+        self.load_times = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+
+    def load_params(self, file_name):
+        file_path = os.path.join(self.model_path, file_name)
+        if self.mmap:
+            return torch.load(file_path, map_location="cpu", mmap=True)
+        return torch.load(file_path, map_location="cpu")
+
+
+    def get_models(self, bucket):
+        if bucket in self.models:
+            self.cache_hits += 1
+            return self.models[bucket]
+
+        self.cache_misses += 1
+        tic = time.perf_counter()
+        if self.runtime == "numpy":
+            with np.load(os.path.join(self.model_path, f"{bucket} NA.npz")) as na_weights:
+                na_model = NumPy_NA_Forecast_Model(dict(na_weights))
+            with np.load(os.path.join(self.model_path, f"{bucket} DEL.npz")) as del_weights:
+                del_model = NumPy_DEL_Forecast_Model(dict(del_weights))
+            toc = time.perf_counter()
+
+            self.models[bucket] = (na_model, del_model)
+            self.load_times[bucket] = toc - tic
+            return self.models[bucket]
+
+        na_model = LSTM_NA_Forecast_Model()
+        na_model.load_state_dict(self.load_params(f"{bucket} NA.pt"))
+        na_model.eval()
+
+        del_model = LSTM_DEL_Forecast_Model()
+        del_model.load_state_dict(self.load_params(f"{bucket} DEL.pt"))
+        del_model.eval()
+        toc = time.perf_counter()
+
+        self.models[bucket] = (na_model, del_model)
+        self.load_times[bucket] = toc - tic
+        return self.models[bucket]
+
+
+    def stats(self):
+        return {
+            'bucketsLoaded': list(self.models.keys()),
+            'loadTimes': dict(self.load_times),
+            'totalLoadTime': sum(self.load_times.values()),
+            'cacheHits': self.cache_hits,
+            'cacheMisses': self.cache_misses
+        }
+
+
+    def report(self):
+        load_times = ", ".join(f"{bucket}: {load_time:0.4f}s" for bucket, load_time in self.load_times.items())
+        return (f"Forecast models loaded: {len(self.models)} ({load_times}) -- "
+                f"cache hits: {self.cache_hits}, cache misses: {self.cache_misses}")
+
+
+model_registry = ForecastModelRegistry()
+
 
-        return x
 
 
 ############################################################
 class GetForecast():
-    def match_model(existing_rba):
-        model_path = os.getcwd() + "/costar/src/forecast_models/"
+    def match_bucket(existing_rba):
         if existing_rba < 10000000:
-            return None, None
+            return None
         elif existing_rba < 20000000:
-            na_model_params = torch.load(os.path.join(model_path,"10M-20M NA.pt"),map_location="cpu")
-            del_model_params = torch.load(os.path.join(model_path,"10M-20M DEL.pt"),map_location="cpu")
+            return "10M-20M"
         elif existing_rba < 45000000:
-            na_model_params = torch.load(os.path.join(model_path,"20M-45M NA.pt"),map_location="cpu")
-            del_model_params = torch.load(os.path.join(model_path,"20M-45M DEL.pt"),map_location="cpu")
+            return "20M-45M"
         else:
-            na_model_params = torch.load(os.path.join(model_path,"45M+ NA.pt"),map_location="cpu")
-            del_model_params = torch.load(os.path.join(model_path,"45M+ DEL.pt"),map_location="cpu")
-        
-        return na_model_params, del_model_params
+            return "45M+"
+
+
+    def load_bucket(bucket):
+        return model_registry.get_models(bucket)
 
 
     def data_preprocessing(total_rba, hist_df, uc_sf):
@@ -94,20 +233,87 @@ class GetForecast():
         smooth_scaled_del = gaussian_filter1d(scaled_del, sigma=1.5, mode='nearest')
 
         # Create array with first column being smoothed data, second column being original data
-        na_data = torch.tensor(np.array([smooth_scaled_na, scaled_na]).T, dtype=torch.float32)
-        del_data = torch.tensor(np.array([smooth_scaled_del, scaled_del]).T, dtype=torch.float32)
-        uc_sf_data = torch.tensor(scaled_uc_sf, dtype=torch.float32)
+        na_data = np.array([smooth_scaled_na, scaled_na]).T.astype(np.float32)
+        del_data = np.array([smooth_scaled_del, scaled_del]).T.astype(np.float32)
+        uc_sf_data = scaled_uc_sf.astype(np.float32)
+        if FORECAST_RUNTIME == "torch":
+            na_data = torch.tensor(na_data)
+            del_data = torch.tensor(del_data)
+            uc_sf_data = torch.tensor(uc_sf_data)
 
         return na_data, [del_data, uc_sf_data]
     
 
-    def forecast(na_model_input, del_model_input, na_model_params, del_model_params):
-        na_model = LSTM_NA_Forecast_Model()
-        na_model.load_state_dict(na_model_params)
+    # Batched forecast for every region in one rba bucket. na_model_inputs is a list of (24, 2) tensors and
+    # del_model_inputs a list of [del_data, uc_sf_data] pairs, as returned by data_preprocessing.
+    # Returns (batch, 8) tensors of na and del forecasts, in the same order as the inputs.
+    def forecast_batch(na_model_inputs, del_model_inputs, na_model, del_model):
+        stack = np.stack if FORECAST_RUNTIME == "numpy" else torch.stack
+        na_batch = stack(na_model_inputs)
+        del_batch = [stack([del_data for del_data, _ in del_model_inputs]),
+                     stack([uc_sf_data for _, uc_sf_data in del_model_inputs])]
+        if FORECAST_RUNTIME == "numpy":
+            return na_model(na_batch), del_model(del_batch)
 
-        del_model = LSTM_DEL_Forecast_Model()
-        del_model.load_state_dict(del_model_params)
         with torch.no_grad():
-            na_forecast = na_model(na_model_input)
-            del_forecast = del_model(del_model_input)
-        return na_forecast, del_forecast
+            na_forecasts = na_model(na_batch)
+            del_forecasts = del_model(del_batch)
+        return na_forecasts, del_forecasts
+
+
+
+
+############################################################
+# Export each torch checkpoint to a .npz of float32 arrays (same parameter names as the state dict) for the
+# NumPy runtime, and check that both runtimes give the same forecasts before keeping the export.
+def export_numpy_weights(model_path=None, tolerance=1e-4):
+    model_path = model_path if model_path else os.getcwd() + "/costar/src/forecast_models/"
+    for bucket in ["10M-20M", "20M-45M", "45M+"]:
+        for model_type in ["NA", "DEL"]:
+            params = torch.load(os.path.join(model_path, f"{bucket} {model_type}.pt"), map_location="cpu")
+            weights = {name: param.detach().numpy().astype(np.float32) for name, param in params.items()}
+            np.savez(os.path.join(model_path, f"{bucket} {model_type}.npz"), **weights)
+
+    max_diffs = check_numpy_parity(model_path)
+    for bucket, (na_diff, del_diff) in max_diffs.items():
+        print(f"{bucket}: max NA difference {na_diff:.2e}, max DEL difference {del_diff:.2e}")
+        if na_diff > tolerance or del_diff > tolerance:
+            raise ValueError(f"NumPy forecasts for {bucket} differ from torch by more than {tolerance}")
+    return max_diffs
+
+
+# Parity check between the torch checkpoints and their NumPy export. Runs both runtimes on the same random
+# batch of scaled inputs and returns {bucket: (max NA difference, max DEL difference)}.
+def check_numpy_parity(model_path=None, batch_size=64, seed=0):
+    torch_registry = ForecastModelRegistry(model_path, runtime="torch")
+    numpy_registry = ForecastModelRegistry(model_path, runtime="numpy")
+    rng = np.random.default_rng(seed)
+
+    max_diffs = {}
+    for bucket in ["10M-20M", "20M-45M", "45M+"]:
+        na_data = rng.normal(0, 5, (batch_size, 24, 2)).astype(np.float32)
+        del_data = rng.normal(0, 5, (batch_size, 24, 2)).astype(np.float32)
+        uc_sf_data = rng.uniform(0, 50, (batch_size, 6)).astype(np.float32)
+
+        torch_na_model, torch_del_model = torch_registry.get_models(bucket)
+        numpy_na_model, numpy_del_model = numpy_registry.get_models(bucket)
+        with torch.no_grad():
+            torch_na = torch_na_model(torch.tensor(na_data)).numpy()
+            torch_del = torch_del_model([torch.tensor(del_data), torch.tensor(uc_sf_data)]).numpy()
+        numpy_na = numpy_na_model(na_data)
+        numpy_del = numpy_del_model([del_data, uc_sf_data])
+
+        # Single (unbatched) sequences must match too
+        with torch.no_grad():
+            torch_single = torch_na_model(torch.tensor(na_data[0])).numpy()
+        single_diff = np.abs(numpy_na_model(na_data[0]) - torch_single).max()
+
+        max_diffs[bucket] = (float(max(np.abs(numpy_na - torch_na).max(), single_diff)),
+                             float(np.abs(numpy_del - torch_del).max()))
+    return max_diffs
+
+
+
+
+if __name__ == '__main__':
+    export_numpy_weights()
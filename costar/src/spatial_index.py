@@ -0,0 +1,27 @@
+import numpy as np
+
+
+############################################################
+# Spatial index helpers for comp matching (costar_cleaner.update_comps and apto's update_properties_comps_batch).
+# Points are placed on a unit sphere so a KD-tree ball query with the chord length of an arc matches MongoDB's
+# spherical $near/$maxDistance (same earth radius as 2dsphere).
+EARTH_RADIUS_METERS = 6378100
+
+# (lon, lat) of a GeoJSON point, or (nan, nan) if it is missing or malformed
+def geojson_lon_lat(loc_geojson):
+    try:
+        lon, lat = loc_geojson['coordinates'][:2]
+        return float(lon), float(lat)
+    except Exception:
+        return np.nan, np.nan
+
+
+# Arrays of longitudes and latitudes (degrees) -> (n, 3) unit vectors
+def lon_lat_to_unit_xyz(lon, lat):
+    lon, lat = np.radians(lon), np.radians(lat)
+    cos_lat = np.cos(lat)
+    return np.column_stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)])
+
+
+def meters_to_chord(distance_in_meters):
+    return 2 * np.sin(distance_in_meters / (2 * EARTH_RADIUS_METERS))
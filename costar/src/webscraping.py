@@ -4,9 +4,74 @@ from data_handler import DataHandler
 from memory_profiler import profile
 import shutil
 import os
+import fcntl, argparse, multiprocessing
+from contextlib import contextmanager
+
+
+############################################################
+# Shared work queue over scraping_status.json for parallel webscrapers. Every read-modify-write holds an exclusive
+# file lock, so claiming a saved search and updating its status are atomic across worker processes.
+# Status values: 0 = to do, 2 = claimed by a worker, 1 = done, -1 = too many results.
+IN_PROGRESS = 2
+
+class ScrapingStatusQueue:
+    def __init__(self, status_path='costar/input/scraping_status.json'):
+        self.status_path = status_path
+        self.lock_path = status_path + '.lock'
+
+    @contextmanager
+    def locked_status(self):
+        with open(self.lock_path, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(self.status_path, 'r') as f:
+                    scraping_status = json.load(f)
+                yield scraping_status
+                # Write to a temp file and swap it in, so readers never see a partial file
+                with open(self.status_path + '.tmp', 'w') as f:
+                    json.dump(scraping_status, f)
+                os.replace(self.status_path + '.tmp', self.status_path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def snapshot(self):
+        with self.locked_status() as scraping_status:
+            return dict(scraping_status)
+
+    # Claim the next saved search that is still to do; None when there is nothing left
+    def claim(self):
+        with self.locked_status() as scraping_status:
+            for search, status in scraping_status.items():
+                if status == 0:
+                    scraping_status[search] = IN_PROGRESS
+                    return search
+        return None
+
+    def update(self, search, status):
+        with self.locked_status() as scraping_status:
+            scraping_status[search] = status
+
+    # Searches left claimed by a crashed run go back in the queue
+    def release_claims(self):
+        with self.locked_status() as scraping_status:
+            for search, status in scraping_status.items():
+                if status == IN_PROGRESS:
+                    scraping_status[search] = 0
+
+# A run has started on scraping_status.json if any saved search has left the to-do state. The file is deleted when a
+# run completes, so a started one means the last run stopped partway and should be resumed rather than reset.
+def unfinished_scraping_status(status_path='costar/input/scraping_status.json'):
+    if not os.path.exists(status_path):
+        return False
+    try:
+        with open(status_path, 'r') as f:
+            scraping_status = json.load(f)
+    except ValueError:
+        return False
+    return any(status != 0 for status in scraping_status.values())
 
 # @profile
-def webscraping_loop():
+def webscraping_loop(fetch_mode='browser'):
     with open('costar/input/input.json', 'r') as f:
         INPUT_FILE = json.load(f)
         SAVED_SEARCHES = INPUT_FILE['SAVED_SEARCHES']
@@ -17,7 +82,7 @@ def webscraping_loop():
     data_handler = DataHandler()
 
     # Set headless to False to see browser on screen as script runs. 
-    webscraper = CostaggWebscraper(SCRAPING_STATUS, headless=False)
+    webscraper = CostaggWebscraper(SCRAPING_STATUS, headless=False, fetch_mode=fetch_mode)
 
     webscraper.Login_To_Homepage()
 
@@ -42,18 +107,83 @@ def webscraping_loop():
         print(f"Deleted '{status_file_path}'.")
     
 
+############################################################
+# One webscraper process: its own browser profile and download directory, saved searches from the shared queue.
+# Logins are serialized (login_lock) because every session reads its 2FA code from the same mailbox.
+def webscraping_worker(worker_id, login_lock, headless=True, fetch_mode='browser'):
+    work_queue = ScrapingStatusQueue()
+    with login_lock:
+        webscraper = CostaggWebscraper(work_queue.snapshot(), headless=headless, work_queue=work_queue, worker_id=worker_id, fetch_mode=fetch_mode)
+        webscraper.Login_To_Homepage()
+
+    complete = False
+    while not complete:
+        if webscraper.Homepage_To_Data_Collection():
+
+            webscraper.Get_Historical_Data()
+
+        webscraper.Reset_Webscraping_Session()
+        complete = webscraper.Get_Completion_Status()
+
+    webscraper.Close_Webscraping_Session()
+
+
+def webscraping_pool(workers, headless=True, fetch_mode='browser'):
+    work_queue = ScrapingStatusQueue()
+    work_queue.release_claims()
+
+    ctx = multiprocessing.get_context('spawn')
+    login_lock = ctx.Lock()
+    processes = [ctx.Process(target=webscraping_worker, args=(worker_id, login_lock, headless, fetch_mode)) for worker_id in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    failed_workers = [worker_id for worker_id, process in enumerate(processes) if process.exitcode != 0]
+    if failed_workers:
+        # Leave scraping_status.json in place so the restart resumes where the workers stopped
+        print(f"Webscraping workers {failed_workers} failed")
+        exit(1)
+
+    # Delete the existing scraping_status.json file if it exists
+    status_file_path = 'costar/input/scraping_status.json'
+    if os.path.exists(status_file_path):
+        os.remove(status_file_path)
+        print(f"Deleted '{status_file_path}'.")
+
+
+
+
 ############################################################
 ############################################################
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('COSTAGG_WORKERS', 1)),
+                        help='Number of parallel browser sessions (default 1, or $COSTAGG_WORKERS)')
+    parser.add_argument('--headless', action='store_true', help='Run parallel browser sessions headless')
+    parser.add_argument('--fetch-mode', choices=['browser', 'http'], default=os.environ.get('COSTAGG_FETCH_MODE', 'browser'),
+                        help='Download historical data by clicking Export in the browser, or over HTTP with the browser session cookies')
+    args = parser.parse_args()
+    if args.fetch_mode == 'http' and not os.environ.get('COSTAR_HISTORY_EXPORT_URL'):
+        parser.error('--fetch-mode http needs COSTAR_HISTORY_EXPORT_URL (the export request from the browser\'s network tab)')
+
     # Clone the base scraping status file to the target location
     base_file_path = 'costar/input/scraping_status_base.json'
     target_file_path = 'costar/input/scraping_status.json'
 
+    # Resume an unfinished run: searches claimed by workers that stopped go back in the queue, finished ones are kept
+    if unfinished_scraping_status(target_file_path):
+        ScrapingStatusQueue(target_file_path).release_claims()
+        print(f"Resuming unfinished run from '{target_file_path}'.")
     # Check if the base file exists before cloning
-    if os.path.exists(base_file_path):
+    elif os.path.exists(base_file_path):
         shutil.copy(base_file_path, target_file_path)
         print(f"Cloned '{base_file_path}' to '{target_file_path}'.")
     else:
         print(f"Warning: The base file '{base_file_path}' does not exist. Cannot clone.")
 
-    webscraping_loop()
\ No newline at end of file
+    if args.workers > 1:
+        webscraping_pool(args.workers, headless=args.headless, fetch_mode=args.fetch_mode)
+    else:
+        webscraping_loop(fetch_mode=args.fetch_mode)
\ No newline at end of file
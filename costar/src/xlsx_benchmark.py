@@ -0,0 +1,56 @@
+import time, os, glob, argparse
+import pandas as pd
+
+from xlsx_reader import XLSX_READERS
+
+
+############################################################
+# Benchmark for the xlsx reader backends. Reads every export in a directory with each backend, reports the best
+# throughput in files per second and checks that each backend returns the same DataFrame as openpyxl.
+def benchmark_xlsx_readers(paths, readers=None, repeats=3):
+    readers = readers or list(XLSX_READERS)
+    reference = {path: XLSX_READERS['openpyxl'](path) for path in paths}
+
+    results = {}
+    for reader in readers:
+        read_xlsx = XLSX_READERS[reader]
+        best_time = None
+        for _ in range(repeats):
+            tic = time.perf_counter()
+            for path in paths:
+                read_xlsx(path)
+            toc = time.perf_counter()
+            if best_time is None or toc - tic < best_time:
+                best_time = toc - tic
+
+        mismatches = 0
+        for path in paths:
+            try:
+                pd.testing.assert_frame_equal(reference[path], read_xlsx(path))
+            except AssertionError as e:
+                mismatches += 1
+                print(f'{reader}: {path} differs from openpyxl\n{e}')
+
+        files_per_sec = len(paths) / best_time
+        results[reader] = files_per_sec
+        print(f'{reader}: {files_per_sec:.1f} files/sec (best of {repeats}), {mismatches} mismatches in {len(paths)} files')
+    return results
+
+
+
+
+############################################################
+# Run from the repo root, e.g.: python costar/src/xlsx_benchmark.py costar/data
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory', nargs='?', default='costar/data', help='Directory of xlsx exports (searched recursively)')
+    parser.add_argument('--readers', nargs='+', choices=list(XLSX_READERS), help='Backends to benchmark (default all)')
+    parser.add_argument('--limit', type=int, default=500, help='Maximum number of files to read')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.directory, '**', '*.xlsx'), recursive=True))[:args.limit]
+    if not paths:
+        print(f'No xlsx files found in {args.directory}')
+        exit(1)
+    benchmark_xlsx_readers(paths, args.readers, args.repeats)
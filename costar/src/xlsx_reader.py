@@ -0,0 +1,234 @@
+import os, re, zipfile, posixpath, datetime
+import xml.etree.ElementTree as ET
+import numpy as np
+import pandas as pd
+from pandas.errors import EmptyDataError
+from pandas.io.parsers import TextParser
+from openpyxl.styles.numbers import builtin_format_code, is_date_format, is_timedelta_format
+from openpyxl.utils.datetime import from_excel, from_ISO8601, WINDOWS_EPOCH, MAC_EPOCH
+try:
+    from python_calamine import CalamineWorkbook
+except ImportError:
+    CalamineWorkbook = None
+
+
+############################################################
+# Pluggable readers for the first sheet of an xlsx file, all returning the same DataFrame as
+# pd.read_excel(path, engine='openpyxl'):
+#   openpyxl: pd.read_excel itself (slowest)
+#   xml:      minimal streaming parser over the zip's sheet XML (no extra dependency)
+#   calamine: python-calamine's Rust parser (fastest, optional dependency)
+# Every backend produces rows of cell values the way pandas' openpyxl reader does and hands them to the same pandas
+# parser, so dtypes and NaN handling match. The default is $COSTAGG_XLSX_READER, else calamine if installed, else xml.
+NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+REL_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+PACKAGE_REL_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+ROW_TAG, CELL_TAG, VALUE_TAG, INLINE_STRING_TAG = f'{NS}row', f'{NS}c', f'{NS}v', f'{NS}is'
+
+
+# Rows of converted cells -> DataFrame, with the trimming and padding of pandas' openpyxl reader
+def rows_to_frame(data):
+    # Trim trailing empty cells and rows
+    data = [row[:len(row) - next((i for i, value in enumerate(reversed(row)) if value != ""), len(row))] for row in data]
+    while data and not data[-1]:
+        data.pop()
+    if not data:
+        return pd.DataFrame()
+    # Extend rows to max width
+    max_width = max(len(row) for row in data)
+    data = [row + [""] * (max_width - len(row)) for row in data]
+    try:
+        return TextParser(data, header=0, skip_blank_lines=False).read()
+    except EmptyDataError:
+        return pd.DataFrame()
+
+
+############################################################
+# openpyxl backend
+def read_xlsx_openpyxl(path):
+    return pd.read_excel(path, engine='openpyxl')
+
+
+############################################################
+# xml backend: reads the workbook, shared strings and styles it needs, then the first sheet's cells. The sheet is parsed
+# in one go (exports are at most a few MB), which is much faster than iterparse events per cell.
+def xlsx_first_sheet_path(archive):
+    workbook = ET.fromstring(archive.read('xl/workbook.xml'))
+    sheet = workbook.find(f'{NS}sheets/{NS}sheet')
+    rels = ET.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+    targets = {rel.get('Id'): rel.get('Target') for rel in rels.iter(f'{PACKAGE_REL_NS}Relationship')}
+    target = targets[sheet.get(f'{REL_NS}id')]
+    # Targets are relative to xl/ unless absolute
+    sheet_path = target.lstrip('/') if target.startswith('/') else posixpath.normpath(f'xl/{target}')
+    workbook_pr = workbook.find(f'{NS}workbookPr')
+    date1904 = workbook_pr is not None and workbook_pr.get('date1904') in ('1', 'true')
+    return sheet_path, (MAC_EPOCH if date1904 else WINDOWS_EPOCH)
+
+
+# Plain text of a shared or inline string, without formatting runs or phonetic hints
+def xlsx_string_text(element):
+    snippets = [element.findtext(f'{NS}t') or '']
+    snippets += [run.findtext(f'{NS}t') or '' for run in element.findall(f'{NS}r')]
+    return ''.join(snippets)
+
+
+def xlsx_shared_strings(archive):
+    if 'xl/sharedStrings.xml' not in archive.namelist():
+        return []
+    shared_strings = []
+    with archive.open('xl/sharedStrings.xml') as f:
+        for _, element in ET.iterparse(f):
+            if element.tag == f'{NS}si':
+                shared_strings.append(xlsx_string_text(element).replace('x005F_', ''))
+                element.clear()
+    return shared_strings
+
+
+# Style indexes whose number format is a date (or a duration)
+def xlsx_date_styles(archive):
+    date_styles, timedelta_styles = set(), set()
+    if 'xl/styles.xml' not in archive.namelist():
+        return date_styles, timedelta_styles
+    styles = ET.fromstring(archive.read('xl/styles.xml'))
+    custom_formats = {int(fmt.get('numFmtId')): fmt.get('formatCode') for fmt in styles.iter(f'{NS}numFmt')}
+    cell_xfs = styles.find(f'{NS}cellXfs')
+    for idx, xf in enumerate(cell_xfs if cell_xfs is not None else []):
+        num_fmt_id = int(xf.get('numFmtId', 0))
+        fmt = custom_formats[num_fmt_id] if num_fmt_id in custom_formats else builtin_format_code(num_fmt_id)
+        if is_date_format(fmt):
+            date_styles.add(idx)
+        if is_timedelta_format(fmt):
+            timedelta_styles.add(idx)
+    return date_styles, timedelta_styles
+
+
+# Column letters -> 1-based column number, cached since every row repeats the same columns
+COLUMN_INDEXES = {}
+def column_index(coordinate):
+    letters = coordinate.rstrip('0123456789')
+    column = COLUMN_INDEXES.get(letters)
+    if column is None:
+        column = 0
+        for char in letters:
+            column = column * 26 + ord(char) - 64
+        COLUMN_INDEXES[letters] = column
+    return column
+
+
+def convert_xlsx_cell(element, shared_strings, date_styles, timedelta_styles, epoch):
+    data_type = element.get('t', 'n')
+    if data_type == 'inlineStr':
+        inline_string = element.find(INLINE_STRING_TAG)
+        return xlsx_string_text(inline_string) if inline_string is not None else ""
+    value = element.findtext(VALUE_TAG) or None
+    if value is None:
+        return ""
+    if data_type == 'n':
+        style_id = int(element.get('s', 0))
+        number = float(value) if '.' in value or 'e' in value or 'E' in value else int(value)
+        if style_id in date_styles:
+            try:
+                return from_excel(number, epoch, timedelta=style_id in timedelta_styles)
+            except (OverflowError, ValueError):
+                return np.nan
+        # Whole numbers become ints, as in pandas' openpyxl reader
+        return int(number) if int(number) == number else float(number)
+    if data_type == 's':
+        return shared_strings[int(value)]
+    if data_type == 'b':
+        return bool(int(value))
+    if data_type == 'd':
+        return from_ISO8601(value)
+    if data_type == 'e':
+        return np.nan
+    return value
+
+
+def read_xlsx_xml(path):
+    with zipfile.ZipFile(path) as archive:
+        sheet_path, epoch = xlsx_first_sheet_path(archive)
+        shared_strings = xlsx_shared_strings(archive)
+        date_styles, timedelta_styles = xlsx_date_styles(archive)
+
+        sheet = ET.fromstring(archive.read(sheet_path))
+
+    data = []
+    row_number = 0
+    for element in sheet.iter(ROW_TAG):
+        row_number = int(element.get('r', row_number + 1))
+        # Missing rows are empty
+        while len(data) < row_number - 1:
+            data.append([])
+        row = []
+        for cell in element.iter(CELL_TAG):
+            coordinate = cell.get('r')
+            column = column_index(coordinate) if coordinate else len(row) + 1
+            # Missing cells are empty
+            if column - 1 > len(row):
+                row.extend([""] * (column - 1 - len(row)))
+            row.append(convert_xlsx_cell(cell, shared_strings, date_styles, timedelta_styles, epoch))
+        data.append(row)
+    return rows_to_frame(data)
+
+
+############################################################
+# calamine backend. calamine returns Excel error cells (#N/A, #DIV/0!, ...) as "", the same as empty cells, where
+# openpyxl gives NaN, so a trailing row of errors would be trimmed. Error cells are found in the sheet XML instead
+# (a byte search, skipped when the sheet has none) and set to NaN.
+ERROR_CELL_PATTERN = re.compile(rb'<c\s[^>]*\bt="e"[^>]*>')
+CELL_REF_PATTERN = re.compile(rb'\br="([A-Z]+)([0-9]+)"')
+
+
+# 0-based (row, column) of every error cell with a value in the first sheet
+def xlsx_error_cells(path):
+    with zipfile.ZipFile(path) as archive:
+        sheet_path, _ = xlsx_first_sheet_path(archive)
+        sheet_xml = archive.read(sheet_path)
+    if b't="e"' not in sheet_xml:
+        return []
+    error_cells = []
+    for match in ERROR_CELL_PATTERN.finditer(sheet_xml):
+        cell_ref = CELL_REF_PATTERN.search(match.group())
+        # An error cell without a value is read as empty, as in pandas' openpyxl reader
+        if cell_ref is None or match.group().endswith(b'/>'):
+            continue
+        error_cells.append((int(cell_ref.group(2)) - 1, column_index(cell_ref.group(1).decode()) - 1))
+    return error_cells
+
+
+def convert_calamine_cell(value):
+    if isinstance(value, float):
+        # Whole numbers become ints, as in pandas' openpyxl reader
+        return int(value) if value.is_integer() else value
+    if type(value) is datetime.date:
+        # openpyxl reads dates as datetimes
+        return datetime.datetime.combine(value, datetime.time())
+    return value
+
+
+def read_xlsx_calamine(path):
+    workbook = CalamineWorkbook.from_path(path)
+    try:
+        rows = workbook.get_sheet_by_index(0).to_python(skip_empty_area=False)
+    finally:
+        workbook.close()
+    data = [[convert_calamine_cell(value) for value in row] for row in rows]
+    for row_idx, column_idx in xlsx_error_cells(path):
+        while len(data) <= row_idx:
+            data.append([])
+        row = data[row_idx]
+        if len(row) <= column_idx:
+            row.extend([""] * (column_idx + 1 - len(row)))
+        row[column_idx] = np.nan
+    return rows_to_frame(data)
+
+
+############################################################
+XLSX_READERS = {'openpyxl': read_xlsx_openpyxl, 'xml': read_xlsx_xml}
+if CalamineWorkbook is not None:
+    XLSX_READERS['calamine'] = read_xlsx_calamine
+DEFAULT_XLSX_READER = os.environ.get('COSTAGG_XLSX_READER') or ('calamine' if CalamineWorkbook is not None else 'xml')
+
+
+def read_xlsx(path, reader=None):
+    return XLSX_READERS[reader or DEFAULT_XLSX_READER](path)
@@ -0,0 +1,163 @@
+import os, sys, io, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pandas as pd
+import pytest
+
+# Run from the repo root: python -m pytest costar/tests
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import export_fetcher
+from export_fetcher import HistoricalExportFetcher, FETCH_OK, FETCH_NO_DATA, FETCH_AUTH, FETCH_FAILED
+
+
+############################################################
+# Local stand-in for the export endpoint. Each property has a script of (status, body, headers) responses served in
+# order (the last one repeats); properties without a script get the xlsx export.
+def xlsx_export():
+    buffer = io.BytesIO()
+    pd.DataFrame({'Period': ['2024 Q1', '2024 Q2'], 'Vacancy Rate': [0.05, 0.06]}).to_excel(buffer, index=False, engine='openpyxl')
+    return buffer.getvalue()
+
+XLSX_EXPORT = xlsx_export()
+LOGIN_PAGE = b'<!DOCTYPE html><HTML><body>Sign in to CoStar</body></HTML>'
+
+class FakeExportServer:
+    def __init__(self, responses=None):
+        self.responses = responses or {}
+        self.requests = []
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                costarID = self.path.rsplit('/', 1)[-1]
+                with fake.lock:
+                    fake.requests.append((costarID, self.headers.get('Cookie'), self.headers.get('User-Agent')))
+                    script = fake.responses.get(costarID, [(200, XLSX_EXPORT, {})])
+                    status, body, headers = script.pop(0) if len(script) > 1 else script[0]
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.export_url = f'http://127.0.0.1:{self.server.server_port}/export/{{costarID}}'
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def requested(self, costarID):
+        return sum(1 for requested_id, _, _ in self.requests if requested_id == costarID)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def fetch(tmp_path, monkeypatch):
+    # Record retry backoff instead of waiting
+    sleeps = []
+    monkeypatch.setattr(export_fetcher.time, 'sleep', sleeps.append)
+    servers, fetchers = [], []
+
+    def start(responses=None, **kwargs):
+        server = FakeExportServer(responses)
+        fetcher = HistoricalExportFetcher([{'name': 'session', 'value': 'abc123'}], 'test-agent', export_url=server.export_url, **kwargs)
+        servers.append(server)
+        fetchers.append(fetcher)
+        return server, fetcher
+
+    yield start, sleeps, tmp_path
+    for fetcher in fetchers:
+        fetcher.close()
+    for server in servers:
+        server.close()
+
+
+############################################################
+def test_export_is_downloaded(fetch):
+    start, sleeps, tmp_path = fetch
+    server, fetcher = start()
+
+    assert fetcher.fetch('101', str(tmp_path / '101.xlsx')) == FETCH_OK
+    # The browser session's cookies and user agent go with the request
+    assert server.requests == [('101', 'session=abc123', 'test-agent')]
+    assert os.listdir(tmp_path) == ['101.xlsx']
+    assert pd.read_excel(tmp_path / '101.xlsx', engine='openpyxl')['Vacancy Rate'].tolist() == [0.05, 0.06]
+
+
+def test_no_content_means_no_data(fetch):
+    start, sleeps, tmp_path = fetch
+    server, fetcher = start({'101': [(204, b'', {})]})
+
+    assert fetcher.fetch('101', str(tmp_path / '101.xlsx')) == FETCH_NO_DATA
+    assert os.listdir(tmp_path) == []
+
+
+def test_not_found_is_a_failure(fetch):
+    # A 404 is more likely a wrong export URL than a property without data, so the browser gets the property
+    start, sleeps, tmp_path = fetch
+    server, fetcher = start({'101': [(404, b'Not Found', {})]})
+
+    assert fetcher.fetch('101', str(tmp_path / '101.xlsx')) == FETCH_FAILED
+    assert server.requested('101') == 1
+
+
+@pytest.mark.parametrize('response', [
+    (401, b'', {}),
+    (403, b'', {}),
+    (302, b'', {'Location': '/login'}),
+    (200, LOGIN_PAGE, {'Content-Type': 'text/html'}),
+], ids=['401', '403', 'login redirect', 'html login page'])
+def test_expired_session_needs_auth(fetch, response):
+    start, sleeps, tmp_path = fetch
+    server, fetcher = start({'101': [response]})
+
+    assert fetcher.fetch('101', str(tmp_path / '101.xlsx')) == FETCH_AUTH
+    assert os.listdir(tmp_path) == []
+
+
+def test_unexpected_body_is_a_failure(fetch):
+    start, sleeps, tmp_path = fetch
+    server, fetcher = start({'101': [(200, b'{"error": "export unavailable"}', {'Content-Type': 'application/json'})]})
+
+    assert fetcher.fetch('101', str(tmp_path / '101.xlsx')) == FETCH_FAILED
+    assert os.listdir(tmp_path) == []
+
+
+def test_unavailable_is_retried_with_backoff(fetch):
+    start, sleeps, tmp_path = fetch
+    server, fetcher = start({'101': [(503, b'', {}), (429, b'', {}), (200, XLSX_EXPORT, {})]}, max_retries=2)
+
+    assert fetcher.fetch('101', str(tmp_path / '101.xlsx')) == FETCH_OK
+    assert server.requested('101') == 3
+    assert sleeps == [1, 2]
+
+
+def test_unavailable_gives_up_after_max_retries(fetch):
+    start, sleeps, tmp_path = fetch
+    server, fetcher = start({'101': [(503, b'', {})]}, max_retries=2)
+
+    assert fetcher.fetch('101', str(tmp_path / '101.xlsx')) == FETCH_FAILED
+    assert server.requested('101') == 3
+    assert os.listdir(tmp_path) == []
+
+
+def test_fetch_many_reports_each_result(fetch):
+    start, sleeps, tmp_path = fetch
+    server, fetcher = start({'102': [(204, b'', {})], '103': [(404, b'', {})], '104': [(302, b'', {'Location': '/login'})]}, workers=4)
+    reported = []
+
+    results = fetcher.fetch_many(['101', '102', '103', '104', '105'], str(tmp_path), on_result=lambda costarID, result: reported.append((costarID, result)))
+
+    assert results == {'101': FETCH_OK, '102': FETCH_NO_DATA, '103': FETCH_FAILED, '104': FETCH_AUTH, '105': FETCH_OK}
+    assert sorted(reported) == sorted(results.items())
+    assert sorted(os.listdir(tmp_path)) == ['101.xlsx', '105.xlsx']
+
+
+def test_export_url_is_required():
+    with pytest.raises(ValueError):
+        HistoricalExportFetcher(export_url=None)
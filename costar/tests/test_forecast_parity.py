@@ -0,0 +1,67 @@
+import os, sys
+import numpy as np
+import pytest
+
+# Run from the repo root: python -m pytest costar/tests
+torch = pytest.importorskip("torch")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import model_definitions
+from model_definitions import ForecastModelRegistry
+
+if model_definitions.FORECAST_RUNTIME != "torch":
+    pytest.skip("torch models are not defined when FORECAST_RUNTIME=numpy", allow_module_level=True)
+
+
+############################################################
+# The NumPy runtime on the committed .npz weights must match the torch checkpoints, for single and batched input
+MODEL_PATH = os.path.join(os.path.dirname(__file__), '..', 'src', 'forecast_models')
+BUCKETS = ["10M-20M", "20M-45M", "45M+"]
+TOLERANCE = 1e-4
+
+
+@pytest.fixture(scope="module")
+def registries():
+    return ForecastModelRegistry(MODEL_PATH, runtime="torch"), ForecastModelRegistry(MODEL_PATH, runtime="numpy")
+
+
+def sample_inputs(batch_size, seed):
+    rng = np.random.default_rng(seed)
+    na_data = rng.normal(0, 5, (batch_size, 24, 2)).astype(np.float32)
+    del_data = rng.normal(0, 5, (batch_size, 24, 2)).astype(np.float32)
+    uc_sf_data = rng.uniform(0, 50, (batch_size, 6)).astype(np.float32)
+    return na_data, del_data, uc_sf_data
+
+
+@pytest.mark.parametrize("bucket", BUCKETS)
+def test_batched_forecasts_match_torch(registries, bucket):
+    torch_registry, numpy_registry = registries
+    torch_na_model, torch_del_model = torch_registry.get_models(bucket)
+    numpy_na_model, numpy_del_model = numpy_registry.get_models(bucket)
+    na_data, del_data, uc_sf_data = sample_inputs(64, seed=0)
+
+    with torch.no_grad():
+        torch_na = torch_na_model(torch.tensor(na_data)).numpy()
+        torch_del = torch_del_model([torch.tensor(del_data), torch.tensor(uc_sf_data)]).numpy()
+
+    np.testing.assert_allclose(numpy_na_model(na_data), torch_na, rtol=0, atol=TOLERANCE)
+    np.testing.assert_allclose(numpy_del_model([del_data, uc_sf_data]), torch_del, rtol=0, atol=TOLERANCE)
+
+
+@pytest.mark.parametrize("bucket", BUCKETS)
+def test_single_forecasts_match_torch(registries, bucket):
+    torch_registry, numpy_registry = registries
+    torch_na_model, torch_del_model = torch_registry.get_models(bucket)
+    numpy_na_model, numpy_del_model = numpy_registry.get_models(bucket)
+    na_data, del_data, uc_sf_data = sample_inputs(4, seed=1)
+
+    for i in range(len(na_data)):
+        with torch.no_grad():
+            torch_na = torch_na_model(torch.tensor(na_data[i])).numpy()
+            torch_del = torch_del_model([torch.tensor(del_data[i]), torch.tensor(uc_sf_data[i])]).numpy()
+
+        numpy_na = numpy_na_model(na_data[i])
+        numpy_del = numpy_del_model([del_data[i], uc_sf_data[i]])
+        assert numpy_na.shape == torch_na.shape == (8,)
+        assert numpy_del.shape == torch_del.shape == (8,)
+        np.testing.assert_allclose(numpy_na, torch_na, rtol=0, atol=TOLERANCE)
+        np.testing.assert_allclose(numpy_del, torch_del, rtol=0, atol=TOLERANCE)
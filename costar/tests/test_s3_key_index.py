@@ -0,0 +1,117 @@
+import os, sys
+import pytest
+
+# Run from the repo root: python -m pytest costar/tests
+boto3 = pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from image_pipeline import S3KeyIndex, ImagePipeline
+
+BUCKET = 'costar-images'
+
+
+############################################################
+# S3KeyIndex and the saved-image checks of ImagePipeline against a moto S3 bucket. S3 calls are counted by
+# operation name through botocore's event hooks.
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with moto.mock_aws():
+        s3_client = boto3.client('s3')
+        s3_client.create_bucket(Bucket=BUCKET)
+        yield s3_client
+
+
+def count_calls(s3_client):
+    calls = []
+    s3_client.meta.events.register('before-call.s3.*', lambda model, **kwargs: calls.append(model.name))
+    return calls
+
+
+def put_images(s3_client, costarIDs, variants=True):
+    for costarID in costarIDs:
+        s3_client.put_object(Bucket=BUCKET, Key=f'{costarID}.jpg', Body=b'jpg')
+        if variants:
+            s3_client.put_object(Bucket=BUCKET, Key=f'variants/{costarID}/full.webp', Body=b'webp')
+
+
+def test_index_lists_every_page(s3):
+    put_images(s3, range(1, 1206), variants=False)
+    put_images(s3, range(1, 11))
+    calls = count_calls(s3)
+    s3_key_index = S3KeyIndex(s3, BUCKET)
+
+    assert s3_key_index.contains('1.jpg') and s3_key_index.contains('1205.jpg')
+    assert not s3_key_index.contains('1206.jpg')
+    # 1205 keys need two pages of 1000; the variants/ keys are left out of the listing
+    assert calls == ['ListObjectsV2', 'ListObjectsV2']
+    assert len(s3_key_index.keys) == 1205
+
+
+def test_added_keys_are_found_without_listing(s3):
+    put_images(s3, [1])
+    s3_key_index = S3KeyIndex(s3, BUCKET)
+    assert not s3_key_index.contains('2.jpg')
+    calls = count_calls(s3)
+
+    s3_key_index.add('2.jpg')
+
+    assert s3_key_index.contains('2.jpg')
+    assert calls == []
+
+
+def test_stale_index_is_listed_again(s3):
+    put_images(s3, [1])
+    s3_key_index = S3KeyIndex(s3, BUCKET, refresh_interval=900)
+    assert s3_key_index.contains('1.jpg')
+
+    # Uploaded by another worker: not seen until the index goes stale
+    put_images(s3, [2])
+    calls = count_calls(s3)
+    assert not s3_key_index.contains('2.jpg')
+    assert calls == []
+
+    s3_key_index.refreshed_at -= 901
+    assert s3_key_index.contains('2.jpg')
+    assert calls == ['ListObjectsV2']
+    assert not s3_key_index.is_stale()
+
+
+def test_keys_missing_from_the_index_are_confirmed_with_head(s3):
+    put_images(s3, [1])
+    image_pipeline = ImagePipeline(print, bucket_name=BUCKET, workers=1)
+    try:
+        assert image_pipeline.check_for_saved_image('1')
+        calls = count_calls(image_pipeline.s3_client)
+
+        # Uploaded by another worker after the index was listed
+        put_images(s3, [2])
+        assert image_pipeline.check_for_saved_image('2')
+        assert not image_pipeline.check_for_saved_image('3')
+        assert calls == ['HeadObject', 'HeadObject']
+
+        # A confirmed key is added to the index, so it isn't checked again
+        assert image_pipeline.check_for_saved_image('2')
+        assert calls == ['HeadObject', 'HeadObject']
+    finally:
+        image_pipeline.close()
+
+
+def test_unlistable_bucket_falls_back_to_head(s3):
+    put_images(s3, [1])
+    logs = []
+    image_pipeline = ImagePipeline(logs.append, bucket_name=BUCKET, workers=1)
+    try:
+        # No list permission: the index is dropped and every check is a HEAD request
+        image_pipeline.s3_key_index.bucket_name = 'no-such-bucket'
+        calls = count_calls(image_pipeline.s3_client)
+
+        assert image_pipeline.check_for_saved_image('1')
+        assert not image_pipeline.check_for_saved_image('2')
+        assert image_pipeline.s3_key_index is None
+        assert calls == ['ListObjectsV2', 'HeadObject', 'HeadObject']
+        assert logs[0].startswith('!!! S3 Image Index Unavailable')
+    finally:
+        image_pipeline.close()
@@ -0,0 +1,50 @@
+import os, sys
+import openpyxl
+import pandas as pd
+import pytest
+
+# Run from the repo root: python -m pytest costar/tests
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from xlsx_reader import XLSX_READERS, read_xlsx
+
+
+############################################################
+# Every backend has to return the same DataFrame as pd.read_excel(engine='openpyxl'), including for Excel error cells,
+# which openpyxl reads as NaN.
+def write_xlsx(path, rows):
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    for row in rows:
+        sheet.append(row)
+    workbook.save(path)
+    return str(path)
+
+
+ERROR_ROWS = [
+    ['Period', 'Vacancy Rate', 'Asking Rent', 'Note'],
+    ['2024 Q1', 0.05, 12.5, 'ok'],
+    ['2024 Q2', '#N/A', 13, '#DIV/0!'],
+    ['2024 Q3', 0.07, '#VALUE!', None, '#REF!'],
+    # A trailing row of nothing but errors is still a row of NaN
+    ['#N/A', '#N/A', '#NAME?', '#NUM!'],
+]
+
+
+@pytest.mark.parametrize('reader', [reader for reader in XLSX_READERS if reader != 'openpyxl'])
+def test_error_cells_match_openpyxl(tmp_path, reader):
+    path = write_xlsx(tmp_path / 'errors.xlsx', ERROR_ROWS)
+    expected = read_xlsx(path, 'openpyxl')
+
+    df = read_xlsx(path, reader)
+
+    pd.testing.assert_frame_equal(expected, df)
+    assert df.shape == (4, 5)
+    assert df.iloc[-1].isna().all()
+    assert df['Vacancy Rate'].dtype == 'float64'
+
+
+@pytest.mark.parametrize('reader', [reader for reader in XLSX_READERS if reader != 'openpyxl'])
+def test_sheet_without_errors_matches_openpyxl(tmp_path, reader):
+    path = write_xlsx(tmp_path / 'export.xlsx', ERROR_ROWS[:2] + [['2024 Q2', 0.06, 13, '#N/A text'], [None, None]])
+
+    pd.testing.assert_frame_equal(read_xlsx(path, 'openpyxl'), read_xlsx(path, reader))